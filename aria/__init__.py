@@ -10,7 +10,17 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 
 from .config import AppConfig, ConfigError, load_config
 from .routes.main import bp as main_bp
+from .routes.metrics import bp as metrics_bp, register_service_collectors
+from .services.admission import AdmissionController
+from .services.catalog import create_track_catalog
+from .services.hedging import configure_request_hedger
+from .services.http import configure_http_session
+from .services.jobs import JobManager, StreamSlots
 from .services.openai_client import create_openai_client
+from .services.prompt_cache import create_prompt_cache
+from .services.rate_limit import configure_rate_limiter
+from .services.search_cache import create_search_cache
+from .services.session_store import ServerSideSessionInterface, create_session_store
 
 
 def create_app() -> Flask:
@@ -48,11 +58,41 @@ def create_app() -> Flask:
     if os.getenv("TRUST_PROXY_HEADERS", "1") == "1":
         app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)  # type: ignore[assignment]
 
+    session_store = create_session_store(config.sessions)
+    app.extensions["session_store"] = session_store
+    if session_store is not None:
+        app.session_interface = ServerSideSessionInterface(session_store)
+
+    app.extensions["http_session"] = configure_http_session(config.http)
+    app.extensions["rate_limiter"] = configure_rate_limiter(config.rate_limit)
+    app.extensions["spotify_hedger"] = configure_request_hedger(config.hedging, app.extensions["rate_limiter"])
     app.extensions["openai_client"] = create_openai_client(config.openai.api_key)
+    app.extensions["search_cache"] = create_search_cache(config.search_cache)
+    app.extensions["prompt_cache"] = create_prompt_cache(config.prompt_cache)
+    app.extensions["track_catalog"] = create_track_catalog(config.catalog.path) if config.catalog.enabled else None
+    app.extensions["admission"] = AdmissionController(
+        max_running=config.jobs.max_workers,
+        max_queued=config.jobs.max_pending,
+        max_per_user=config.jobs.max_per_user,
+        max_wait=config.jobs.max_queue_wait,
+    )
+    app.extensions["stream_slots"] = StreamSlots(config.jobs.max_streams, config.jobs.max_streams_per_user)
+    app.extensions["job_manager"] = JobManager(
+        max_workers=config.jobs.max_workers,
+        max_pending=config.jobs.max_pending,
+        result_ttl=config.jobs.result_ttl,
+        state_store=session_store,
+        admission=app.extensions["admission"],
+    )
 
     app.register_blueprint(main_bp)
+    if config.metrics.enabled:
+        register_service_collectors(app)
+        app.register_blueprint(metrics_bp)
 
     _configure_logging(app)
+    if config.metrics.enabled and not config.metrics.token:
+        app.logger.warning("METRICS_ENABLED is set without METRICS_TOKEN: /metrics is public")
 
     return app
 
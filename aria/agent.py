@@ -1,17 +1,52 @@
 from __future__ import annotations
 
+import contextvars
 import json
 import logging
 import importlib.resources as resources
+import re
+import sqlite3
+import threading
 import unicodedata
-from typing import Any, Dict, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Tuple
 
-from openai import OpenAI
+from openai import BadRequestError, NotFoundError, OpenAI
 import spotipy
 from spotipy.exceptions import SpotifyException
 
+from .encoding import TrackRegistry, encode_search_results
+from .executor import ToolExecutor
+from .config import BudgetSettings
+from .services.budget import RunBudget, budget_scope, budget_step, summary_only, with_budget_state
+from .services.catalog import TrackCatalog, UnsupportedQuery
+from .services.model_routing import ModelRouter
+from .services.metrics import (
+    AGENT_STEP_SECONDS,
+    GENERATION_SECONDS,
+    GENERATION_STEPS,
+    MODEL_REQUEST_SECONDS,
+    MODEL_TOKENS,
+    TOOL_CALL_SECONDS,
+)
+from .services.prompt_cache import CachedResult, PromptCache
+from .services.search_cache import BaseSearchCache, make_search_key
+from .services.tracing import Span, start_span, trace_span
+
 logger = logging.getLogger(__name__)
 
+MAX_BATCHED_QUERIES = 10
+NO_SUMMARY_TEXT = "(no model text)"
+# Playlist id the model passes to add_tracks when the playlist is created speculatively.
+SPECULATIVE_PLAYLIST_ALIAS = "current"
+PROVISIONAL_DESCRIPTION = "Aria is picking the tracks..."
+PLAYLIST_ADD_CHUNK_SIZE = 100
+
+_TRACK_URI_RE = re.compile(r"^spotify:track:([0-9A-Za-z]{22})$")
+_TRACK_URL_RE = re.compile(r"^https?://open\.spotify\.com/(?:intl-[a-z]{2}/)?track/([0-9A-Za-z]{22})(?:[/?#].*)?$")
+
+AgentEventCallback = Callable[[str, Dict[str, Any]], None]
+
 
 def _load_tools_schema() -> List[Dict[str, Any]]:
     with resources.files("aria.data").joinpath("tools.json").open("r", encoding="utf-8") as fp:
@@ -21,6 +56,16 @@ def _load_tools_schema() -> List[Dict[str, Any]]:
 tools_schema = _load_tools_schema()
 
 
+def _emit(on_event: AgentEventCallback | None, event_type: str, **data: Any) -> None:
+    """Forward a progress event to the caller; a failing listener must never break the run."""
+    if on_event is None:
+        return
+    try:
+        on_event(event_type, data)
+    except Exception:  # pragma: no cover - defensive
+        logger.exception("Agent event listener failed on '%s'", event_type)
+
+
 def _truncate_for_log(value: Any, max_chars: int = 400) -> str:
     if value is None:
         return ""
@@ -54,75 +99,364 @@ def _sanitise_arguments(obj: Any) -> Any:
     return obj
 
 
-def build_tool_impls(sp: spotipy.Spotify) -> Dict[str, Any]:
-    me = sp.current_user()
-    user_id = me["id"]
+def build_tool_impls(
+    sp: spotipy.Spotify,
+    search_cache: BaseSearchCache | None = None,
+    user_id: str | None = None,
+    track_registry: TrackRegistry | None = None,
+    catalog: TrackCatalog | None = None,
+    catalog_first: bool = False,
+    track_log: Dict[str, List[str]] | None = None,
+) -> Dict[str, Any]:
+    """
+    Build the Python implementations behind the tools schema. When a `track_registry` is
+    given, search results use the compact tabular encoding and add_tracks accepts row handles.
+    With a `catalog`, every Spotify search feeds the local index and search_local_catalog is
+    offered; `catalog_first` also lets track-only searches be answered from it.
+    `track_log` receives the URIs actually added to each playlist, in playlist order.
+    """
+
+    def resolve_user_id() -> str:
+        nonlocal user_id
+        if user_id is None:
+            user_id = sp.current_user()["id"]
+        return user_id
 
     def create_playlist(name: str, description: str, public: bool) -> Dict[str, Any]:
         playlist = sp.user_playlist_create(
-            user=user_id,
+            user=resolve_user_id(),
             name=name[:100],
             public=public,
             description=description[:300],
         )
-        return {
-            "id": playlist["id"],
-            "url": playlist["external_urls"]["spotify"],
-            "name": playlist["name"],
-            "description": playlist.get("description", ""),
-        }
+        return created_playlist_result(playlist, public)
 
-    def add_tracks(playlist_id: str, uris: List[str]) -> Dict[str, Any]:
-        if not uris:
-            return {"added": 0}
-        limited = uris[:100]
-        sp.playlist_add_items(playlist_id=playlist_id, items=limited)
-        return {"added": len(limited)}
+    added_by_playlist: Dict[str, set] = {}
+    added_lock = threading.Lock()
+
+    def add_tracks(playlist_id: str, uris: List[str], position: int | None = None) -> Dict[str, Any]:
+        with added_lock:
+            adds = TrackAdds(playlist_id, uris, position, added_by_playlist, track_registry, track_log)
+            for chunk, chunk_position in adds.chunks():
+                try:
+                    response = sp.playlist_add_items(playlist_id=playlist_id, items=chunk, position=chunk_position)
+                except SpotifyException as exc:
+                    adds.failed(exc)
+                    break
+                adds.sent(chunk, chunk_position, response)
+        return adds.result()
 
     def search_items(query: str, item_types: List[str], limit: int) -> Dict[str, Any]:
+        return encode_results(_search_catalog(query, item_types, limit), track_registry)
+
+    def search_many(queries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        specs = queries[:MAX_BATCHED_QUERIES]
+        if not specs:
+            return {"queries": 0}
+
+        def run(spec: Dict[str, Any]) -> Dict[str, Any]:
+            return _search_catalog(spec["query"], spec["item_types"], spec["limit"])
+
+        def outcome(future: Future) -> Dict[str, Any] | BaseException:
+            try:
+                return future.result()
+            except Exception as exc:
+                return exc
+
+        with ThreadPoolExecutor(max_workers=len(specs), thread_name_prefix="aria-search") as pool:
+            # One context copy per query, so budgets and spans reach the pool threads.
+            futures = [pool.submit(contextvars.copy_context().run, run, spec) for spec in specs]
+            gathered = [outcome(future) for future in futures]
+
+        return search_many_result(queries, specs, gathered, track_registry)
+
+    def search_local_catalog(query: str, limit: int) -> Dict[str, Any]:
+        try:
+            tracks = catalog.search(query, limit)
+        except (UnsupportedQuery, sqlite3.Error) as exc:
+            return local_search_error(query, exc)
+        return encode_results({"tracks": [local_track(track) for track in tracks]}, track_registry)
+
+    def _search_catalog(query: str, item_types: List[str], limit: int) -> Dict[str, Any]:
+        cache_key = make_search_key(query, item_types, limit) if search_cache is not None else None
+        if cache_key is not None:
+            cached = search_cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Search cache hit for %r", cache_key)
+                return cached
+
+        if serves_locally(catalog, catalog_first, item_types):
+            local = _search_local_only(query, limit)
+            if local is not None:
+                return local
+
         type_param = ",".join(item_types)
         results = sp.search(q=query, type=type_param, limit=limit)
+        if catalog is not None:
+            catalog.index_search_results(results)
+        out = shape_search_results(results)
 
-        out: Dict[str, Any] = {}
-
-        if "tracks" in results and results["tracks"] and "items" in results["tracks"]:
-            tracks_out = []
-            for t in results["tracks"]["items"]:
-                tracks_out.append({
-                    "id": t["id"],
-                    "uri": t["uri"],
-                    "name": t["name"],
-                    "artists": ", ".join(a["name"] for a in t.get("artists", [])),
-                })
-            out["tracks"] = tracks_out
-
-        if "artists" in results and results["artists"] and "items" in results["artists"]:
-            artists_out = []
-            for a in results["artists"]["items"]:
-                artists_out.append({
-                    "id": a["id"],
-                    "name": a["name"],
-                    "genres": a.get("genres", []),
-                })
-            out["artists"] = artists_out
-
-        if "albums" in results and results["albums"] and "items" in results["albums"]:
-            albums_out = []
-            for al in results["albums"]["items"]:
-                albums_out.append({
-                    "id": al["id"],
-                    "name": al["name"],
-                    "artists": ", ".join(a["name"] for a in al.get("artists", [])),
-                })
-            out["albums"] = albums_out
-
+        if cache_key is not None:
+            search_cache.set(cache_key, out)
         return out
 
-    return {
+    def _search_local_only(query: str, limit: int) -> Dict[str, Any] | None:
+        try:
+            tracks = catalog.search(query, limit)
+        except (UnsupportedQuery, sqlite3.Error):
+            return None
+        return local_search_page(query, tracks, limit)
+
+    impls = {
         "create_playlist": create_playlist,
         "add_tracks": add_tracks,
         "search_items": search_items,
+        "search_many": search_many,
     }
+    if catalog is not None:
+        impls["search_local_catalog"] = search_local_catalog
+    return impls
+
+
+def created_playlist_result(playlist: Dict[str, Any], public: bool) -> Dict[str, Any]:
+    return {
+        "id": playlist["id"],
+        "url": playlist["external_urls"]["spotify"],
+        "name": playlist["name"],
+        "description": playlist.get("description", ""),
+        "public": playlist.get("public", public),
+    }
+
+
+def log_added_tracks(
+    track_log: Dict[str, List[str]] | None,
+    playlist_id: str,
+    uris: List[str],
+    position: int | None,
+) -> None:
+    if track_log is None:
+        return
+    tracks = track_log.setdefault(playlist_id, [])
+    at = len(tracks) if position is None else min(position, len(tracks))
+    tracks[at:at] = uris
+
+
+def partition_track_refs(
+    refs: Iterable[str] | None,
+    already_added: set,
+    track_registry: TrackRegistry | None = None,
+) -> Tuple[List[str], List[str], int]:
+    """Split add_tracks input into new valid URIs, invalid references and a duplicate count."""
+    valid: List[str] = []
+    invalid: List[str] = []
+    duplicates = 0
+    for ref in refs or []:
+        resolved = track_registry.resolve(ref) if track_registry is not None else ref
+        uri = normalise_track_uri(resolved)
+        if uri is None:
+            invalid.append(ref)
+        elif uri in already_added or uri in valid:
+            duplicates += 1
+        else:
+            valid.append(uri)
+    return valid, invalid, duplicates
+
+
+def add_tracks_result(
+    added: int,
+    duplicates: int,
+    invalid: List[str],
+    chunks: List[Dict[str, Any]],
+    snapshot_id: str | None,
+) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"added": added}
+    if duplicates:
+        result["skipped_duplicates"] = duplicates
+    if invalid:
+        result["invalid"] = invalid
+    if len(chunks) > 1 or any("error" in chunk for chunk in chunks):
+        result["chunks"] = chunks
+    if snapshot_id:
+        result["snapshot_id"] = snapshot_id
+    return result
+
+
+def failed_chunk(index: int, exc: SpotifyException, not_sent: int) -> Dict[str, Any]:
+    return {
+        "chunk": index,
+        "error": "spotify_api_error",
+        "status": getattr(exc, "http_status", None),
+        "not_sent": not_sent,
+    }
+
+
+class TrackAdds:
+    """
+    Bookkeeping of one add_tracks call: the new valid URIs, the chunks to send and the result
+    reported to the model. The caller sends each chunk and stops at the first failure, since
+    later chunks would land out of order.
+    """
+
+    def __init__(
+        self,
+        playlist_id: str,
+        uris: List[str] | None,
+        position: int | None,
+        added_by_playlist: Dict[str, set],
+        track_registry: TrackRegistry | None,
+        track_log: Dict[str, List[str]] | None,
+    ) -> None:
+        self.playlist_id = playlist_id
+        self.already_added = added_by_playlist.setdefault(playlist_id, set())
+        self.valid, self.invalid, self.duplicates = partition_track_refs(uris, self.already_added, track_registry)
+        self.position = position
+        self.track_log = track_log
+        self.added = 0
+        self.snapshot_id: str | None = None
+        self.chunk_results: List[Dict[str, Any]] = []
+
+    def chunks(self) -> Iterator[Tuple[List[str], int | None]]:
+        for index in range(0, len(self.valid), PLAYLIST_ADD_CHUNK_SIZE):
+            position = self.position + self.added if self.position is not None else None
+            yield self.valid[index:index + PLAYLIST_ADD_CHUNK_SIZE], position
+
+    def sent(self, chunk: List[str], position: int | None, response: Dict[str, Any] | None) -> None:
+        self.snapshot_id = (response or {}).get("snapshot_id", self.snapshot_id)
+        self.already_added.update(chunk)
+        log_added_tracks(self.track_log, self.playlist_id, chunk, position)
+        self.added += len(chunk)
+        self.chunk_results.append({"chunk": len(self.chunk_results), "added": len(chunk), "snapshot_id": self.snapshot_id})
+
+    def failed(self, exc: SpotifyException) -> None:
+        logger.warning("Adding chunk %s to playlist %s failed: %s", len(self.chunk_results), self.playlist_id, exc)
+        self.chunk_results.append(failed_chunk(len(self.chunk_results), exc, len(self.valid) - self.added))
+
+    def result(self) -> Dict[str, Any]:
+        return add_tracks_result(self.added, self.duplicates, self.invalid, self.chunk_results, self.snapshot_id)
+
+
+def local_track(track: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: track[key] for key in ("id", "uri", "name", "artists")}
+
+
+def serves_locally(catalog: TrackCatalog | None, catalog_first: bool, item_types: List[str]) -> bool:
+    return catalog is not None and catalog_first and [t.lower() for t in item_types] == ["track"]
+
+
+def local_search_page(query: str, tracks: List[Dict[str, Any]], limit: int) -> Dict[str, Any] | None:
+    """Serve a track search locally only when the index has a full page of matches."""
+    if len(tracks) < limit:
+        return None
+    logger.debug("Served search %r from the local catalog", query)
+    return {"tracks": [local_track(track) for track in tracks]}
+
+
+def local_search_error(query: str, exc: Exception) -> Dict[str, Any]:
+    """search_local_catalog's result for a failed lookup; call it from the except block."""
+    if isinstance(exc, UnsupportedQuery):
+        return {"error": "unsupported_query", "message": str(exc)}
+    logger.exception("Local catalog search failed for %r", query)
+    return {"error": "local_catalog_unavailable"}
+
+
+def encode_results(out: Dict[str, Any], track_registry: TrackRegistry | None) -> Dict[str, Any]:
+    """Search output as sent to the model: compact tables with a `track_registry`, JSON objects otherwise."""
+    return encode_search_results(out, track_registry) if track_registry is not None else out
+
+
+def shape_search_results(results: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep only the fields of a Spotify /search payload that the model needs."""
+    out: Dict[str, Any] = {}
+
+    if "tracks" in results and results["tracks"] and "items" in results["tracks"]:
+        tracks_out = []
+        for t in results["tracks"]["items"]:
+            tracks_out.append({
+                "id": t["id"],
+                "uri": t["uri"],
+                "name": t["name"],
+                "artists": ", ".join(a["name"] for a in t.get("artists", [])),
+            })
+        out["tracks"] = tracks_out
+
+    if "artists" in results and results["artists"] and "items" in results["artists"]:
+        artists_out = []
+        for a in results["artists"]["items"]:
+            artists_out.append({
+                "id": a["id"],
+                "name": a["name"],
+                "genres": a.get("genres", []),
+            })
+        out["artists"] = artists_out
+
+    if "albums" in results and results["albums"] and "items" in results["albums"]:
+        albums_out = []
+        for al in results["albums"]["items"]:
+            albums_out.append({
+                "id": al["id"],
+                "name": al["name"],
+                "artists": ", ".join(a["name"] for a in al.get("artists", [])),
+            })
+        out["albums"] = albums_out
+
+    return out
+
+
+def normalise_track_uri(ref: str) -> str | None:
+    """Accept spotify:track: URIs and open.spotify.com track links; reject anything else."""
+    if not isinstance(ref, str):
+        return None
+    ref = ref.strip()
+    match = _TRACK_URI_RE.match(ref) or _TRACK_URL_RE.match(ref)
+    if match is None:
+        return None
+    return f"spotify:track:{match.group(1)}"
+
+
+def search_many_result(
+    queries: List[Dict[str, Any]],
+    specs: List[Dict[str, Any]],
+    gathered: List[Dict[str, Any] | BaseException],
+    track_registry: TrackRegistry | None = None,
+) -> Dict[str, Any]:
+    """
+    Merge the outcomes of the batched `specs` (the first queries); a failed Spotify search is
+    reported under "errors", any other exception is raised.
+    """
+    outcomes: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    for spec, outcome in zip(specs, gathered):
+        if isinstance(outcome, SpotifyException):
+            logger.warning("Batched search %r failed: %s", spec.get("query"), outcome)
+            errors.append({"query": spec.get("query"), "status": getattr(outcome, "http_status", None)})
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
+            outcomes.append(outcome)
+    result = encode_results(merge_search_results(outcomes), track_registry)
+    result["queries"] = len(specs)
+    if len(queries) > len(specs):
+        result["skipped_queries"] = len(queries) - len(specs)
+    if errors:
+        result["errors"] = errors
+    return result
+
+
+def merge_search_results(outputs: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Concatenate shaped search outputs, dropping items already returned by an earlier query."""
+    merged: Dict[str, List[Dict[str, Any]]] = {}
+    seen: Dict[str, set] = {}
+    for out in outputs:
+        for kind, items in out.items():
+            bucket = merged.setdefault(kind, [])
+            keys = seen.setdefault(kind, set())
+            for item in items:
+                key = item.get("uri") or item.get("id") or item.get("name")
+                if key in keys:
+                    continue
+                keys.add(key)
+                bucket.append(item)
+    return merged
 
 
 def run_agent_for_user(
@@ -130,6 +464,20 @@ def run_agent_for_user(
     sp: spotipy.Spotify,
     openai_client: OpenAI,
     model_name: str = "gpt-5-mini",
+    tool_concurrency: int = 8,
+    search_cache: BaseSearchCache | None = None,
+    user_id: str | None = None,
+    on_event: AgentEventCallback | None = None,
+    stream_responses: bool = False,
+    chain_responses: bool = False,
+    compact_results: bool = False,
+    catalog: TrackCatalog | None = None,
+    catalog_first: bool = False,
+    prompt_cache: PromptCache | None = None,
+    use_prompt_cache: bool = True,
+    speculative_playlist: bool = False,
+    budget: BudgetSettings | None = None,
+    fast_model_name: str | None = None,
 ) -> Dict[str, str]:
     """
     Generates a playlist via OpenAI tool calling and returns a summary payload:
@@ -138,24 +486,435 @@ def run_agent_for_user(
         "playlist_url": "...",
         "playlist_name": "..."
     }
+    `on_event(type, data)` is called as the run progresses (step_started, tool_requested,
+    tool_finished, playlist_created, text_delta, summary), possibly from tool worker threads.
+    With `stream_responses`, each function call is dispatched as soon as the model finishes
+    its arguments, and text is forwarded as `text_delta` events while it is generated.
+    With `chain_responses`, later steps only send the new tool outputs and point the API at
+    the previous response; the full input is replayed if the chained request is rejected.
+    With `compact_results`, search results are sent as delimited tables with track handles.
+    With a `prompt_cache`, a prompt matching an earlier generation rebuilds that playlist
+    without calling the model (unless `use_prompt_cache` is False), and successful runs are
+    stored for later prompts.
+    With `speculative_playlist`, the playlist is created under a provisional name while the
+    first model request is in flight; the model fills it and names it with name_playlist,
+    the title is patched in at the end and the playlist is deleted if the run fails.
+    With a `budget`, the run is bounded in steps, tokens, wall-clock time and Spotify calls:
+    nearing a limit forces a turn that adds the tracks found so far, then a summary-only turn.
+    The usage is returned under "budget".
+    With a `fast_model_name`, intermediate search turns run on that model and the track
+    selection and summary on `model_name`; a fast turn with invalid tool arguments, or one
+    that stops calling tools, is replayed on `model_name`, which then keeps the rest of the run.
+    """
+
+    record = GenerationRecord(on_event) if prompt_cache is not None else None
+    if record is not None:
+        on_event = record
+    tool_impls = build_tool_impls(
+        sp,
+        search_cache=search_cache,
+        user_id=user_id,
+        track_registry=TrackRegistry() if compact_results else None,
+        catalog=catalog,
+        catalog_first=catalog_first,
+        track_log=record.tracks if record is not None else None,
+    )
+
+    run_budget = RunBudget(budget) if budget is not None else None
+    with trace_span("generation", GENERATION_SECONDS, model=model_name) as span, budget_scope(run_budget):
+        cached = prompt_cache.get(user_prompt) if prompt_cache is not None and use_prompt_cache else None
+        if cached is not None:
+            span.set(outcome="cached")
+            return with_budget_state(_replay_cached_result(cached, tool_impls, on_event), run_budget)
+
+        speculative = SpeculativePlaylist(sp, tool_impls, user_prompt, on_event) if speculative_playlist else None
+        if speculative is not None:
+            tool_impls = speculative.tool_impls(tool_impls)
+
+        def run_call(fc: Any) -> Dict[str, Any]:
+            return _execute_tool_call(fc, tool_impls, on_event)
+
+        try:
+            with ToolExecutor(run_call, max_workers=tool_concurrency) as executor:
+                payload = _run_agent_loop(
+                    user_prompt,
+                    openai_client,
+                    model_name,
+                    executor,
+                    on_event,
+                    stream_responses,
+                    chain_responses,
+                    compact_results,
+                    tools_for(tool_impls),
+                    speculative,
+                    run_budget,
+                    fast_model_name,
+                )
+        except BaseException:
+            if speculative is not None:
+                speculative.discard()
+            raise
+        if run_budget is not None and run_budget.reason:
+            span.set(finalised_early=run_budget.reason)
+    if record is not None:
+        record.store(prompt_cache, user_prompt, payload)
+    return with_budget_state(payload, run_budget)
+
+
+class GenerationRecord:
+    """
+    Event listener wrapper collecting the playlists a run created and the tracks it added,
+    so a finished generation can be stored in the prompt cache.
+    """
+
+    def __init__(self, on_event: AgentEventCallback | None) -> None:
+        self._on_event = on_event
+        self.playlists: List[Dict[str, Any]] = []
+        self.tracks: Dict[str, List[str]] = {}
+
+    def __call__(self, event_type: str, data: Dict[str, Any]) -> None:
+        if event_type == "playlist_created":
+            self.playlists.append(data)
+        elif event_type == "playlist_updated":
+            self.playlists = [data if p.get("id") == data.get("id") else p for p in self.playlists]
+        _emit(self._on_event, event_type, **data)
+
+    def store(self, prompt_cache: PromptCache, user_prompt: str, payload: Dict[str, str]) -> None:
+        if not self.playlists or payload.get("summary") == NO_SUMMARY_TEXT:
+            return
+        playlist = self.playlists[-1]
+        tracks = self.tracks.get(playlist["id"])
+        if not tracks:
+            return
+        prompt_cache.set(
+            user_prompt,
+            CachedResult(
+                name=playlist["name"],
+                description=playlist.get("description", ""),
+                public=bool(playlist.get("public", True)),
+                tracks=list(tracks),
+                summary=payload["summary"],
+                prompt=user_prompt,
+            ),
+        )
+
+
+class SpeculativePlaylist:
+    """
+    Creates the run's playlist under a provisional name on a background thread, so the model
+    can start searching at once instead of spending its first turn on create_playlist.
+    """
+
+    def __init__(
+        self,
+        sp: spotipy.Spotify,
+        tool_impls: Dict[str, Any],
+        user_prompt: str,
+        on_event: AgentEventCallback | None,
+    ) -> None:
+        self._sp = sp
+        self._on_event = on_event
+        self._lock = threading.Lock()
+        self._chosen: Dict[str, str] | None = None
+        self._added = 0
+        self._discarded = False
+        self._future: Future = Future()
+        create = tool_impls["create_playlist"]
+        context = contextvars.copy_context()
+
+        def run() -> None:
+            try:
+                playlist = create(name=provisional_name(user_prompt), description=PROVISIONAL_DESCRIPTION, public=True)
+            except BaseException as exc:
+                self._future.set_exception(exc)
+                return
+            self._future.set_result(playlist)
+            _emit(on_event, "playlist_created", **playlist)
+
+        threading.Thread(target=context.run, args=(run,), name="aria-speculative-playlist", daemon=True).start()
+
+    def tool_impls(self, tool_impls: Dict[str, Any]) -> Dict[str, Any]:
+        """The run's tools: create_playlist is replaced by name_playlist, add_tracks targets this playlist."""
+        add_tracks = tool_impls["add_tracks"]
+
+        def add_tracks_speculative(playlist_id: str, uris: List[str], position: int | None = None) -> Dict[str, Any]:
+            result = add_tracks(playlist_id=self.playlist()["id"], uris=uris, position=position)
+            with self._lock:
+                self._added += result.get("added", 0)
+            return result
+
+        impls = {name: impl for name, impl in tool_impls.items() if name != "create_playlist"}
+        impls["add_tracks"] = add_tracks_speculative
+        impls["name_playlist"] = self.name_playlist
+        return impls
+
+    def playlist(self) -> Dict[str, Any]:
+        return self._future.result()
+
+    def name_playlist(self, name: str, description: str) -> Dict[str, Any]:
+        with self._lock:
+            self._chosen = {"name": name[:100], "description": description[:300]}
+        return {"ok": True, "playlist_id": SPECULATIVE_PLAYLIST_ALIAS, **self._chosen}
+
+    def finish(self) -> Dict[str, Any] | None:
+        """Apply the chosen title; a playlist that never received tracks is deleted instead."""
+        with self._lock:
+            chosen, added = self._chosen, self._added
+        if not added:
+            logger.info("Speculative playlist received no tracks, removing it")
+            self.discard()
+            return None
+        playlist = dict(self.playlist())
+        if chosen:
+            try:
+                self._sp.playlist_change_details(playlist["id"], name=chosen["name"], description=chosen["description"])
+            except SpotifyException as exc:
+                logger.warning("Renaming speculative playlist %s failed: %s", playlist["id"], exc)
+            else:
+                playlist.update(chosen)
+                _emit(self._on_event, "playlist_updated", **playlist)
+        return playlist
+
+    def discard(self) -> None:
+        """Delete (unfollow) the playlist once its creation has finished, if it succeeded."""
+        with self._lock:
+            if self._discarded:
+                return
+            self._discarded = True
+        self._future.add_done_callback(self._delete)
+
+    def _delete(self, future: Future) -> None:
+        if future.exception() is not None:
+            return
+        playlist_id = future.result()["id"]
+        try:
+            self._sp.current_user_unfollow_playlist(playlist_id)
+        except Exception:
+            logger.exception("Could not delete orphaned playlist %s", playlist_id)
+        else:
+            logger.info("Deleted orphaned speculative playlist %s", playlist_id)
+
+
+def provisional_name(user_prompt: str) -> str:
+    words = " ".join(user_prompt.split())
+    return f"Aria - {words[:60].rstrip()}{'...' if len(words) > 60 else ''}"
+
+
+def _replay_cached_result(
+    cached: CachedResult,
+    tool_impls: Dict[str, Any],
+    on_event: AgentEventCallback | None,
+) -> Dict[str, str]:
+    """Recreate a cached generation with the create_playlist and add_tracks tools only."""
+    _emit(on_event, "cache_hit", prompt=cached.prompt, tracks=len(cached.tracks))
+    playlist = tool_impls["create_playlist"](
+        name=cached.name,
+        description=cached.description,
+        public=cached.public,
+    )
+    _emit(on_event, "playlist_created", **playlist)
+    added = tool_impls["add_tracks"](playlist_id=playlist["id"], uris=cached.tracks)
+    return cached_payload(cached, playlist, added, on_event)
+
+
+def cached_payload(
+    cached: CachedResult,
+    playlist: Dict[str, Any],
+    added: Dict[str, Any],
+    on_event: AgentEventCallback | None,
+) -> Dict[str, str]:
+    logger.info(
+        "Rebuilt cached playlist %s with %s/%s track(s)",
+        playlist.get("url"),
+        added.get("added", 0),
+        len(cached.tracks),
+    )
+    payload = {
+        "summary": cached.summary,
+        "playlist_url": playlist.get("url", ""),
+        "playlist_name": playlist.get("name", ""),
+    }
+    _emit(on_event, "summary", **payload)
+    return payload
+
+
+def _run_agent_loop(
+    user_prompt: str,
+    openai_client: OpenAI,
+    model_name: str,
+    executor: ToolExecutor,
+    on_event: AgentEventCallback | None,
+    stream_responses: bool,
+    chain_responses: bool,
+    compact_results: bool,
+    tools: List[Dict[str, Any]],
+    speculative: SpeculativePlaylist | None = None,
+    budget: RunBudget | None = None,
+    fast_model_name: str | None = None,
+) -> Dict[str, str]:
+    loop = AgentLoop(
+        user_prompt, model_name, on_event, chain_responses, compact_results, tools, speculative is not None, budget, fast_model_name
+    )
+
+    def create(request: Dict[str, Any]) -> Tuple[Any, Dict[str, Future]]:
+        return _create_response(openai_client, request, executor, on_event, loop.step_index, stream_responses)
+
+    while True:
+        request = loop.start_step()
+        try:
+            response, dispatched = create(request)
+        except (BadRequestError, NotFoundError) as exc:
+            if not loop.unchain(request, exc):
+                raise
+            response, dispatched = create(request)
+        if loop.replay_on_main_model(request, response):
+            response, dispatched = create(request)
+
+        function_calls, final_text_chunks = loop.accept(request, response, dispatched)
+        if loop.finished(function_calls):
+            if speculative is not None:
+                loop.last_playlist_info = speculative.finish()
+            return final_payload(final_text_chunks, loop.last_playlist_info, on_event)
+
+        late_calls = loop.late_calls(function_calls, dispatched)
+        late_results = dict(zip((fc.call_id for fc in late_calls), executor.run_all(late_calls)))
+        results = [
+            dispatched[fc.call_id].result() if fc.call_id in dispatched
+            else late_results[fc.call_id] if fc.call_id in late_results
+            else loop.refuse(fc)
+            for fc in function_calls
+        ]
+        loop.record_results(function_calls, results)
+
+
+class AgentLoop:
+    """
+    The model loop of one generation without its I/O: input building, per-step routing,
+    response chaining and its fallback, fast-model replays and budget accounting. The sync
+    and asyncio run loops drive it; they only make the model requests and run the tools.
     """
 
-    tool_impls = build_tool_impls(sp)
-    last_playlist_info: Dict[str, Any] | None = None
+    def __init__(
+        self,
+        user_prompt: str,
+        model_name: str,
+        on_event: AgentEventCallback | None,
+        chain_responses: bool,
+        compact_results: bool,
+        tools: List[Dict[str, Any]],
+        speculative: bool = False,
+        budget: RunBudget | None = None,
+        fast_model_name: str | None = None,
+    ) -> None:
+        self.model_name = model_name
+        self.on_event = on_event
+        self.chain_responses = chain_responses
+        self.tools = tools
+        self.budget = budget
+        self.router = ModelRouter(model_name, fast_model_name)
+        self.input_list = initial_input(user_prompt, compact_results, speculative)
+        self.new_input: List[Any] = []
+        self.previous_response_id: str | None = None
+        self.last_playlist_info: Dict[str, Any] | None = None
+        self.step_index = 0
+        self.chained = False
+        self._span: Span | None = None
+        self._step_model = model_name
+        self._step_tools = tools
+        self._routed_tools = tools
+        self._request: Dict[str, Any] = {}
+
+    def start_step(self) -> Dict[str, Any]:
+        """Begin the next step and return its model request."""
+        self.step_index += 1
+        logger.info("Starting agent step %s", self.step_index)
+        _emit(self.on_event, "step_started", step=self.step_index)
+        self._span = start_span("agent_step", AGENT_STEP_SECONDS, step=self.step_index)
 
-    input_list: list[Dict[str, Any]] = [
+        self._step_tools, budget_options = budget_step(self.budget, self.tools, self.input_list, self.new_input)
+        self._step_model, self._routed_tools = self.router.route(self._step_tools, self.budget)
+        self._span.set(model=self._step_model)
+        request = build_request(self._step_model, self._routed_tools, self.input_list)
+        request.update(budget_options)
+        self._request = request
+        self.chained = self.chain_responses and self.previous_response_id is not None
+        if self.chained:
+            request["input"] = self.new_input
+            request["previous_response_id"] = self.previous_response_id
+        return request
+
+    def unchain(self, request: Dict[str, Any], exc: Exception) -> bool:
+        """Turn a rejected chained request into a full replay; False when it was not chained."""
+        if not self.chained:
+            return False
+        logger.warning("Chained request failed in step %s, replaying the full input: %s", self.step_index, exc)
+        self.chain_responses = self.chained = False
+        request["input"] = self.input_list
+        request.pop("previous_response_id")
+        return True
+
+    def replay_on_main_model(self, request: Dict[str, Any], response: Any) -> bool:
+        """Point `request` at the main model when the fast model's response is unusable."""
+        if self._step_model == self.model_name:
+            return False
+        fallback = self.router.fallback_reason(response, self._routed_tools)
+        if fallback is None:
+            return False
+        # The fast turn only offered side-effect-free tools, and calls to other tools were
+        # not dispatched while streaming, so its calls can be dropped.
+        logger.warning("Fast model step %s unusable (%s), replaying it on %s", self.step_index, fallback, self.model_name)
+        if self.budget is not None:
+            self.budget.record_response(response)
+        self._span.set(model=self.model_name, fallback=fallback)
+        request.update(model=self.model_name, tools=self._step_tools)
+        return True
+
+    def accept(self, request: Dict[str, Any], response: Any, dispatched: Dict[str, Any]) -> Tuple[List[Any], List[str]]:
+        """Add the step's response to the conversation; returns its function calls and text."""
+        log_request_size(self.step_index, request["input"], self.input_list, self.chained, response)
+        self.previous_response_id = getattr(response, "id", None)
+        if self.budget is not None:
+            self.budget.record_response(response)
+        self.new_input = []
+
+        new_items = list(response.output)
+        logger.info("Model produced %s new item(s) in step %s", len(new_items), self.step_index)
+        self.input_list += new_items
+        return read_step_output(new_items, dispatched, self.step_index, self.on_event)
+
+    def finished(self, function_calls: List[Any]) -> bool:
+        """Whether the run ends with this step: no tool calls, or the budget's summary-only turn."""
+        if function_calls and not summary_only(self.budget):
+            return False
+        self._span.end()
+        GENERATION_STEPS.observe(self.step_index)
+        return True
+
+    def late_calls(self, function_calls: List[Any], dispatched: Dict[str, Any]) -> List[Any]:
+        """Calls still to run: not dispatched while streaming, and to a tool the step offered."""
+        offered = offered_tools(self._request)
+        return [fc for fc in function_calls if fc.call_id not in dispatched and fc.name in offered]
+
+    def refuse(self, fc: Any) -> Dict[str, Any]:
+        """Result of a call to a tool the step did not offer; it is not run."""
+        logger.warning("Model called %s in step %s, which did not offer it", fc.name, self.step_index)
+        _emit(self.on_event, "tool_finished", name=fc.name, call_id=fc.call_id, ok=False, duration_ms=0)
+        return {"error": f"{fc.name} is not available in this step"}
+
+    def record_results(self, function_calls: List[Any], results: List[Any]) -> None:
+        """Append the step's tool outputs to the conversation and close the step."""
+        self.last_playlist_info = record_tool_results(
+            function_calls, results, self.input_list, self.new_input, self.on_event, self.last_playlist_info
+        )
+        self.router.observe(function_calls, results)
+        self._span.end()
+
+
+def initial_input(user_prompt: str, compact_results: bool, speculative: bool = False) -> List[Dict[str, Any]]:
+    return [
         {
             "role": "system",
-            "content": (
-                "You are Aria, you create Spotify playlists from a user request.\n"
-                "1. Create the Spotify playlist (call create_playlist ONLY once at the start with public=true).\n"
-                "2. Build a coherent selection based on the user's request (~15 to ~20 tracks max) and add these tracks to the playlist using add_tracks.\n"
-                "3. Finish by replying in the request's language with a short mood/scene description.\n"
-                "How to find the right tracks:\n"
-                "- Use search_items to look for tracks, artists, or genres.\n"
-                "- Get the URIs of the relevant tracks.\n"
-                "- Call add_tracks with all the URIs when you're ready.\n"
-            ),
+            "content": _system_prompt(compact_results, speculative),
         },
         {
             "role": "user",
@@ -163,106 +922,353 @@ def run_agent_for_user(
         },
     ]
 
-    step_index = 0
 
-    while True:
-        step_index += 1
-        logger.info("Starting agent step %s", step_index)
-
-        response = openai_client.responses.create(
-            model=model_name,
-            tools=tools_schema,
-            input=input_list,
-            temperature=1,
+def build_request(model_name: str, tools: List[Dict[str, Any]], input_list: List[Any]) -> Dict[str, Any]:
+    return {
+        "model": model_name,
+        "tools": tools,
+        "input": input_list,
+        "temperature": 1,
+    }
+
+
+def read_step_output(
+    new_items: List[Any],
+    dispatched: Dict[str, Any],
+    step_index: int,
+    on_event: AgentEventCallback | None,
+) -> Tuple[List[Any], List[str]]:
+    """Split a step's output into function calls and text, announcing calls not yet dispatched."""
+    function_calls = []
+    final_text_chunks = []
+
+    for item in new_items:
+        if item.type == "function_call":
+            function_calls.append(item)
+            if item.call_id not in dispatched:
+                announce_tool_call(item, step_index, on_event)
+        elif item.type == "message" and getattr(item, "content", None):
+            for block in item.content:
+                if block.type == "output_text":
+                    text_chunk = block.text
+                    final_text_chunks.append(text_chunk)
+                    stripped = text_chunk.strip()
+                    if stripped:
+                        logger.info("Model draft text: %s", _truncate_for_log(stripped))
+
+    if final_text_chunks:
+        logger.debug("Model candidate response: %s", " ".join(chunk.strip() for chunk in final_text_chunks))
+    return function_calls, final_text_chunks
+
+
+def final_payload(
+    final_text_chunks: List[str],
+    last_playlist_info: Dict[str, Any] | None,
+    on_event: AgentEventCallback | None,
+) -> Dict[str, str]:
+    summary_text = "\n".join(final_text_chunks).strip()
+    if summary_text:
+        logger.info("Model final summary: %s", _truncate_for_log(summary_text))
+    else:
+        logger.info("Model finished without generating summary text.")
+    if last_playlist_info:
+        logger.info("Latest playlist details: %s", _truncate_for_log(json.dumps(last_playlist_info)))
+    payload = {
+        "summary": summary_text if summary_text else NO_SUMMARY_TEXT,
+        "playlist_url": (last_playlist_info.get("url") if last_playlist_info else ""),
+        "playlist_name": (last_playlist_info.get("name") if last_playlist_info else ""),
+    }
+    _emit(on_event, "summary", **payload)
+    return payload
+
+
+def record_tool_results(
+    function_calls: List[Any],
+    results: List[Any],
+    input_list: List[Any],
+    new_input: List[Any],
+    on_event: AgentEventCallback | None,
+    last_playlist_info: Dict[str, Any] | None,
+) -> Dict[str, Any] | None:
+    """Append the step's tool outputs to the conversation; returns the latest created playlist."""
+    for fc, result in zip(function_calls, results):
+        if fc.name == "create_playlist" and isinstance(result, dict) and "error" not in result:
+            last_playlist_info = result
+            playlist_url = result.get("url")
+            if playlist_url:
+                logger.info("Created playlist at %s", playlist_url)
+            _emit(on_event, "playlist_created", **result)
+
+        output_item = {
+            "type": "function_call_output",
+            "call_id": fc.call_id,
+            "output": json.dumps(result),
+        }
+        input_list.append(output_item)
+        new_input.append(output_item)
+    return last_playlist_info
+
+
+def tools_for(tool_impls: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Only advertise the tools this run can actually execute."""
+    return [tool for tool in tools_schema if tool["name"] in tool_impls]
+
+
+def _system_prompt(compact_results: bool, speculative: bool = False) -> str:
+    if speculative:
+        first_step = (
+            f"1. The playlist already exists: pass playlist_id \"{SPECULATIVE_PLAYLIST_ALIAS}\" to add_tracks. "
+            "Call name_playlist ONCE with its title and description, alongside your first searches.\n"
+        )
+    else:
+        first_step = "1. Create the Spotify playlist (call create_playlist ONLY once at the start with public=true).\n"
+    prompt = (
+        "You are Aria, you create Spotify playlists from a user request.\n"
+        + first_step
+        + "2. Build a coherent selection based on the user's request (~15 to ~20 tracks max) and add these tracks to the playlist using add_tracks.\n"
+        "3. Finish by replying in the request's language with a short mood/scene description.\n"
+        "How to find the right tracks:\n"
+        "- Use search_items to look for tracks, artists, or genres.\n"
+        "- Prefer search_many to run several searches in a single call.\n"
+        "- Get the URIs of the relevant tracks.\n"
+        "- Call add_tracks once with all the URIs when you're ready (position=null to append).\n"
+    )
+    if compact_results:
+        prompt += (
+            "Search results are tables: a header line then one row per item, fields separated by '|'.\n"
+            "Each track row starts with a handle such as t12; pass these handles to add_tracks instead of URIs.\n"
+            "'already_shown' lists handles of tracks returned by an earlier search.\n"
         )
+    return prompt
 
-        new_items = list(response.output)
-        logger.info("Model produced %s new item(s) in step %s", len(new_items), step_index)
-        input_list += new_items
-
-        function_calls = []
-        final_text_chunks = []
-
-        for item in new_items:
-            if item.type == "function_call":
-                function_calls.append(item)
-                logger.info(
-                    "Model requested tool '%s' (call_id=%s) with args: %s",
-                    getattr(item, "name", "?"),
-                    getattr(item, "call_id", "?"),
-                    _truncate_for_log(getattr(item, "arguments", "")),
-                )
-            elif item.type == "message" and getattr(item, "content", None):
-                for block in item.content:
-                    if block.type == "output_text":
-                        text_chunk = block.text
-                        final_text_chunks.append(text_chunk)
-                        stripped = text_chunk.strip()
-                        if stripped:
-                            logger.info("Model draft text: %s", _truncate_for_log(stripped))
-
-        if final_text_chunks:
-            logger.debug("Model candidate response: %s", " ".join(chunk.strip() for chunk in final_text_chunks))
-
-        if not function_calls:
-            summary_text = "\n".join(final_text_chunks).strip()
-            if summary_text:
-                logger.info("Model final summary: %s", _truncate_for_log(summary_text))
-            else:
-                logger.info("Model finished without generating summary text.")
-            if last_playlist_info:
-                logger.info("Latest playlist details: %s", _truncate_for_log(json.dumps(last_playlist_info)))
-            return {
-                "summary": summary_text if summary_text else "(no model text)",
-                "playlist_url": (last_playlist_info.get("url") if last_playlist_info else ""),
-                "playlist_name": (last_playlist_info.get("name") if last_playlist_info else ""),
-            }
-
-        for fc in function_calls:
-            name = fc.name
-            raw_args = fc.arguments
-            call_id = fc.call_id
-
-            logger.info("Executing tool call '%s' with payload: %s", name, _truncate_for_log(raw_args))
 
-            try:
-                args = json.loads(raw_args) if raw_args else {}
-                args = _sanitise_arguments(args)
-            except json.JSONDecodeError:
-                logger.exception("Invalid JSON payload received from model")
-                args = {}
-
-            if name not in tool_impls:
-                logger.error("Unknown tool requested by model: %s", name)
-                result = {"error": f"unknown function {name}"}
-            else:
-                try:
-                    py_fn = tool_impls[name]
-                    result = py_fn(**args)
-                    if name == "create_playlist" and isinstance(result, dict):
-                        last_playlist_info = result
-                        playlist_url = result.get("url")
-                        if playlist_url:
-                            logger.info("Created playlist at %s", playlist_url)
-                except SpotifyException as exc:
-                    logger.exception("Spotify API error while executing tool '%s'", name)
-                    result = {
-                        "error": "spotify_api_error",
-                        "status": getattr(exc, "http_status", None),
-                        "message": str(exc),
-                    }
-                except Exception as exc:  # pragma: no cover - defensive
-                    logger.exception("Unexpected error while executing tool '%s'", name)
-                    result = {"error": str(exc)}
+def _create_response(
+    openai_client: OpenAI,
+    request: Dict[str, Any],
+    executor: ToolExecutor,
+    on_event: AgentEventCallback | None,
+    step_index: int,
+    stream_responses: bool,
+) -> Tuple[Any, Dict[str, Future]]:
+    with model_request_span(request, stream_responses, step_index) as span:
+        if stream_responses:
+            response, dispatched = _stream_response(openai_client, request, executor, on_event, step_index)
+        else:
+            response, dispatched = openai_client.responses.create(**request), {}
+        record_model_usage(span, request["model"], response)
+    return response, dispatched
 
-            try:
-                result_for_log = json.dumps(result)
-            except TypeError:
-                result_for_log = str(result)
-            logger.info("Tool '%s' output: %s", name, _truncate_for_log(result_for_log))
-
-            input_list.append({
-                "type": "function_call_output",
-                "call_id": call_id,
-                "output": json.dumps(result),
-            })
+
+def model_request_span(request: Dict[str, Any], stream_responses: bool, step_index: int):
+    return trace_span(
+        "model_request",
+        MODEL_REQUEST_SECONDS,
+        model=request["model"],
+        streamed="true" if stream_responses else "false",
+        chained="previous_response_id" in request,
+        step=step_index,
+    )
+
+
+def record_model_usage(span: Span, model_name: str, response: Any) -> None:
+    """Export the token usage reported on the response object."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    tokens = {
+        "input": getattr(usage, "input_tokens", None),
+        "output": getattr(usage, "output_tokens", None),
+        "cached": getattr(getattr(usage, "input_tokens_details", None), "cached_tokens", None),
+    }
+    for kind, value in tokens.items():
+        if value:
+            MODEL_TOKENS.inc(value, model=model_name, kind=kind)
+    span.set(**{f"{kind}_tokens": value for kind, value in tokens.items() if value is not None})
+
+
+def log_request_size(
+    step_index: int,
+    sent: List[Any],
+    full: List[Any],
+    chained: bool,
+    response: Any,
+) -> None:
+    """Compare what was sent with what a full replay of the conversation would have cost."""
+    sent_bytes = _payload_bytes(sent)
+    full_bytes = sent_bytes if sent is full else _payload_bytes(full)
+    usage = getattr(response, "usage", None)
+    input_tokens = getattr(usage, "input_tokens", None)
+    details = getattr(usage, "input_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None)
+    logger.info(
+        "Step %s request: %s, sent %s bytes (full replay %s bytes), input_tokens=%s cached_tokens=%s",
+        step_index,
+        "chained" if chained else "full replay",
+        sent_bytes,
+        full_bytes,
+        input_tokens,
+        cached_tokens,
+    )
+
+
+def _payload_bytes(items: List[Any]) -> int:
+    total = 0
+    for item in items:
+        if hasattr(item, "model_dump"):
+            item = item.model_dump(exclude_none=True)
+        try:
+            total += len(json.dumps(item, ensure_ascii=False, default=str).encode("utf-8"))
+        except (TypeError, ValueError):
+            total += len(str(item).encode("utf-8"))
+    return total
+
+
+def _stream_response(
+    openai_client: OpenAI,
+    request: Dict[str, Any],
+    executor: ToolExecutor,
+    on_event: AgentEventCallback | None,
+    step_index: int,
+) -> Tuple[Any, Dict[str, Future]]:
+    """
+    Consume a streamed response, handing every completed function call to the executor while
+    the model is still generating the rest of its output.
+    """
+    dispatched: Dict[str, Future] = {}
+    final_response = None
+    offered = offered_tools(request)
+
+    def dispatch(item: Any) -> None:
+        # Calls to tools the step did not offer are never run early: the step may be replayed.
+        if item.call_id not in dispatched and item.name in offered:
+            announce_tool_call(item, step_index, on_event)
+            dispatched[item.call_id] = executor.submit(item)
+
+    stream = openai_client.responses.create(stream=True, **request)
+    for event in stream:
+        final_response = handle_stream_event(event, step_index, on_event, dispatch) or final_response
+
+    return check_final_response(final_response, step_index), dispatched
+
+
+def offered_tools(request: Dict[str, Any]) -> FrozenSet[str]:
+    return frozenset(tool["name"] for tool in request["tools"])
+
+
+def handle_stream_event(
+    event: Any,
+    step_index: int,
+    on_event: AgentEventCallback | None,
+    dispatch: Callable[[Any], None],
+) -> Any | None:
+    """Handle one streamed event; completed function calls go to `dispatch`, the final response is returned."""
+    event_type = getattr(event, "type", "")
+    if event_type == "response.output_item.done":
+        if event.item.type == "function_call":
+            dispatch(event.item)
+    elif event_type == "response.output_text.delta":
+        _emit(on_event, "text_delta", step=step_index, delta=event.delta)
+    elif event_type in ("response.completed", "response.incomplete"):
+        return event.response
+    elif event_type in ("response.failed", "error"):
+        failed = getattr(event, "response", None)
+        error = getattr(failed, "error", None) or getattr(event, "message", None)
+        raise RuntimeError(f"OpenAI response stream failed: {error}")
+    return None
+
+
+def check_final_response(final_response: Any, step_index: int) -> Any:
+    if final_response is None:
+        raise RuntimeError("OpenAI response stream ended without a completed response")
+    if final_response.status == "incomplete":
+        logger.warning("Model response incomplete in step %s: %s", step_index, final_response.incomplete_details)
+    return final_response
+
+
+def announce_tool_call(item: Any, step_index: int, on_event: AgentEventCallback | None) -> None:
+    logger.info(
+        "Model requested tool '%s' (call_id=%s) with args: %s",
+        getattr(item, "name", "?"),
+        getattr(item, "call_id", "?"),
+        _truncate_for_log(getattr(item, "arguments", "")),
+    )
+    _emit(
+        on_event,
+        "tool_requested",
+        step=step_index,
+        name=getattr(item, "name", "?"),
+        call_id=getattr(item, "call_id", "?"),
+        arguments=_truncate_for_log(getattr(item, "arguments", "")),
+    )
+
+
+def _execute_tool_call(
+    fc: Any,
+    tool_impls: Dict[str, Any],
+    on_event: AgentEventCallback | None = None,
+) -> Dict[str, Any]:
+    """Run a single model function call and turn any failure into a JSON-serialisable error."""
+    name = fc.name
+    tool_span = start_tool_span(fc, tool_impls)
+    args = parse_tool_arguments(fc)
+
+    if name not in tool_impls:
+        logger.error("Unknown tool requested by model: %s", name)
+        result: Any = {"error": f"unknown function {name}"}
+    else:
+        try:
+            py_fn = tool_impls[name]
+            result = py_fn(**args)
+        except Exception as exc:
+            result = tool_error_result(name, exc)
+
+    finish_tool_call(fc, result, tool_span, on_event)
+    return result
+
+
+def start_tool_span(fc: Any, tool_impls: Dict[str, Any]) -> Span:
+    # Unknown names come from the model, so they are not used as label values.
+    tool = fc.name if fc.name in tool_impls else "unknown"
+    return start_span("tool_call", TOOL_CALL_SECONDS, tool=tool, call_id=fc.call_id)
+
+
+def parse_tool_arguments(fc: Any) -> Dict[str, Any]:
+    raw_args = fc.arguments
+    logger.info("Executing tool call '%s' with payload: %s", fc.name, _truncate_for_log(raw_args))
+    try:
+        args = json.loads(raw_args) if raw_args else {}
+        return _sanitise_arguments(args)
+    except json.JSONDecodeError:
+        logger.exception("Invalid JSON payload received from model")
+        return {}
+
+
+def tool_error_result(name: str, exc: Exception) -> Dict[str, Any]:
+    if isinstance(exc, SpotifyException):
+        logger.exception("Spotify API error while executing tool '%s'", name)
+        return {
+            "error": "spotify_api_error",
+            "status": getattr(exc, "http_status", None),
+            "message": str(exc),
+        }
+    logger.exception("Unexpected error while executing tool '%s'", name)
+    return {"error": str(exc)}
+
+
+def finish_tool_call(fc: Any, result: Any, tool_span: Span, on_event: AgentEventCallback | None) -> None:
+    try:
+        result_for_log = json.dumps(result)
+    except TypeError:
+        result_for_log = str(result)
+    logger.info("Tool '%s' output: %s", fc.name, _truncate_for_log(result_for_log))
+    ok = not (isinstance(result, dict) and "error" in result)
+    tool_span.set(ok="true" if ok else "false")
+    duration = tool_span.end()
+    _emit(
+        on_event,
+        "tool_finished",
+        name=fc.name,
+        call_id=fc.call_id,
+        ok=ok,
+        duration_ms=round(duration * 1000),
+    )
@@ -0,0 +1,372 @@
+from __future__ import annotations
+
+import asyncio
+import hmac
+import json
+import logging
+import urllib.parse
+import uuid
+from http.cookies import SimpleCookie
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from flask import Flask
+from flask.sessions import SecureCookieSession, SessionMixin
+from itsdangerous import BadSignature
+from openai import AsyncOpenAI
+from werkzeug.http import dump_cookie
+
+from . import create_app
+from .async_agent import run_agent_for_user_async
+from .config import AppConfig
+from .services import spotify as spotify_service
+from .services.admission import AdmissionController, AdmissionRejected
+from .routes.metrics import PROMETHEUS_CONTENT_TYPE
+from .services.hedging import get_request_hedger
+from .services.http import create_async_http_client
+from .services.metrics import REGISTRY
+from .services.openai_client import create_async_openai_client
+from .services.rate_limit import get_rate_limiter
+from .services.session_store import ServerSideSession, ServerSideSessionInterface
+from .services.spotify_async import AsyncSpotifyClient
+
+logger = logging.getLogger(__name__)
+
+Scope = Dict[str, Any]
+Receive = Callable[[], Awaitable[Dict[str, Any]]]
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class AsyncGenerationApp:
+    """
+    ASGI entry point running generations on the asyncio agent. It shares the Flask app's
+    configuration, services and session (cookie or server-side store), so a user connected
+    through the Flask routes can call it directly:
+
+        POST /async/generate   prompt=... [fresh=1]   (JSON result, or SSE with Accept: text/event-stream)
+        GET  /async/health
+        GET  /metrics          (this process's registry, when METRICS_ENABLED)
+    """
+
+    def __init__(self, flask_app: Flask) -> None:
+        self.flask_app = flask_app
+        self.config: AppConfig = flask_app.config["APP_CONFIG"]
+        self._http: Optional[httpx.AsyncClient] = None
+        self._openai: Optional[AsyncOpenAI] = None
+        # No wait queue: the event loop takes up to async_max_runs generations, the rest are shed.
+        self.admission = AdmissionController(
+            max_running=self.config.agent.async_max_runs,
+            max_queued=0,
+            max_per_user=self.config.jobs.max_per_user,
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        path = scope.get("path", "")
+        method = scope.get("method", "GET")
+        if path == "/async/health" and method == "GET":
+            await _send_json(send, 200, {"ok": True, "active_runs": self.admission.stats()["running"]})
+        elif path == "/async/generate" and method == "POST":
+            await self._generate(scope, receive, send)
+        elif path == "/metrics" and method == "GET" and self.config.metrics.enabled:
+            await self._metrics(scope, send)
+        else:
+            await _send_json(send, 404, {"error": "not_found"})
+
+    async def startup(self) -> None:
+        if self._http is None:
+            self._http = create_async_http_client(self.config.http)
+        if self._openai is None:
+            self._openai = create_async_openai_client(self.config.openai.api_key)
+
+    async def shutdown(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        if self._openai is not None:
+            await self._openai.close()
+            self._openai = None
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _metrics(self, scope: Scope, send: Send) -> None:
+        token = self.config.metrics.token
+        supplied = _headers(scope).get("authorization", "")
+        if token and not hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+            await _send_json(send, 401, {"error": "unauthorized"})
+            return
+        body = REGISTRY.render().encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", PROMETHEUS_CONTENT_TYPE.encode("ascii")),
+                (b"content-length", str(len(body)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def _generate(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.startup()
+        headers = _headers(scope)
+        fields = _read_fields(headers, await _read_body(receive))
+        prompt = str(fields.get("prompt") or "").strip()
+        if not prompt:
+            await _send_json(send, 400, {"error": "Prompt vide"})
+            return
+
+        session = await asyncio.to_thread(self._load_session, headers)
+        before = dict(session)
+        # Token refresh and the /me probe are rare and reuse the thread-based single-flight logic.
+        client = await asyncio.to_thread(
+            spotify_service.ensure_valid_spotify_client,
+            session,
+            self.config.spotify,
+        )
+        extra_headers = await asyncio.to_thread(self._save_session, session) if dict(session) != before else []
+        if client is None:
+            auth_url = spotify_service.build_authorize_url(self.config.spotify)
+            await _send_json(send, 401, {"need_auth": True, "auth_url": auth_url}, extra_headers)
+            return
+
+        owner = spotify_service.get_session_user_id(session) or str(session.get("sid") or "")
+        ticket = uuid.uuid4().hex
+        try:
+            self.admission.admit(ticket, owner)
+        except AdmissionRejected as exc:
+            error = "too_many_generations" if exc.status == 429 else "busy"
+            await _send_json(
+                send,
+                exc.status,
+                {"error": error, "reason": exc.reason, "retry_after": exc.retry_after},
+                [*extra_headers, (b"retry-after", str(exc.retry_after).encode("ascii"))],
+            )
+            return
+
+        sp = AsyncSpotifyClient(
+            session["access_token"],
+            self._http,
+            rate_limiter=get_rate_limiter(),
+            rate_limit_key=spotify_service.get_session_user_id(session),
+            hedger=get_request_hedger(),
+            api_base=self.config.spotify.api_base,
+            retries=self.config.http.retries,
+            backoff_factor=self.config.http.backoff_factor,
+        )
+        options = self._agent_options(session)
+        options["use_prompt_cache"] = str(fields.get("fresh", "")).strip().lower() not in {"1", "true", "yes", "on"}
+
+        self.admission.start(ticket)
+        try:
+            if "text/event-stream" in headers.get("accept", ""):
+                await self._stream(receive, send, prompt, sp, options, extra_headers)
+            else:
+                try:
+                    result = await run_agent_for_user_async(prompt, sp, **options)
+                except Exception as exc:
+                    logger.exception("Async generation failed")
+                    await _send_json(send, 500, {"error": str(exc) or exc.__class__.__name__}, extra_headers)
+                    return
+                await _send_json(send, 200, {"ok": True, "result": result}, extra_headers)
+        finally:
+            self.admission.finish(ticket)
+
+    async def _stream(
+        self,
+        receive: Receive,
+        send: Send,
+        prompt: str,
+        sp: AsyncSpotifyClient,
+        options: Dict[str, Any],
+        extra_headers: List[Tuple[bytes, bytes]],
+    ) -> None:
+        """
+        Same event names as the Flask SSE feed, ending with `done` or `failed`. The generation
+        is cancelled as soon as the client disconnects.
+        """
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def run() -> None:
+            try:
+                result = await run_agent_for_user_async(
+                    prompt,
+                    sp,
+                    on_event=lambda event_type, data: events.put_nowait((event_type, data)),
+                    **options,
+                )
+            except Exception as exc:
+                logger.exception("Async generation failed")
+                events.put_nowait(("failed", {"error": str(exc) or exc.__class__.__name__}))
+            else:
+                events.put_nowait(("done", result))
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                *extra_headers,
+            ],
+        })
+        task = asyncio.create_task(run())
+        disconnected = asyncio.create_task(_wait_for_disconnect(receive))
+        event_id = 0
+        try:
+            while True:
+                next_event = asyncio.ensure_future(events.get())
+                await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_event.done():
+                    next_event.cancel()
+                    logger.info("Client went away, cancelling the async generation")
+                    break
+                event_type, data = next_event.result()
+                event_id += 1
+                chunk = f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+                if event_type in ("done", "failed"):
+                    break
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.wait({task})
+            if not disconnected.done():
+                disconnected.cancel()
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    def _agent_options(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        config = self.config
+        return {
+            "openai_client": self._openai,
+            "model_name": config.openai.model,
+            "fast_model_name": config.openai.fast_model,
+            "tool_concurrency": config.agent.tool_concurrency,
+            "stream_responses": config.agent.stream_responses,
+            "chain_responses": config.agent.chain_responses,
+            "compact_results": config.agent.compact_results,
+            "speculative_playlist": config.agent.speculative_playlist,
+            "budget": config.budget,
+            "search_cache": self.flask_app.extensions.get("search_cache"),
+            "catalog": self.flask_app.extensions.get("track_catalog"),
+            "catalog_first": config.catalog.serve_searches,
+            "user_id": spotify_service.get_session_user_id(session),
+            "prompt_cache": self.flask_app.extensions.get("prompt_cache"),
+        }
+
+    def _load_session(self, headers: Dict[str, str]) -> SessionMixin:
+        app = self.flask_app
+        cookie = SimpleCookie()
+        cookie.load(headers.get("cookie", ""))
+        morsel = cookie.get(app.config["SESSION_COOKIE_NAME"])
+        interface = app.session_interface
+        if isinstance(interface, ServerSideSessionInterface):
+            return interface.load(app, morsel.value if morsel is not None else None)
+        serializer = interface.get_signing_serializer(app)
+        if serializer is None or morsel is None:
+            return SecureCookieSession()
+        try:
+            max_age = int(app.permanent_session_lifetime.total_seconds())
+            return SecureCookieSession(serializer.loads(morsel.value, max_age=max_age))
+        except BadSignature:
+            return SecureCookieSession()
+
+    def _save_session(self, session: SessionMixin) -> List[Tuple[bytes, bytes]]:
+        """Write refreshed tokens back the way Flask's session interface would."""
+        app = self.flask_app
+        interface = app.session_interface
+        if isinstance(interface, ServerSideSessionInterface) and isinstance(session, ServerSideSession):
+            interface.persist(session)
+            if not session.new:
+                return []
+            cookie_value = interface.cookie_value(app, session)
+        else:
+            serializer = interface.get_signing_serializer(app)
+            if serializer is None:
+                return []
+            cookie_value = serializer.dumps(dict(session))
+        value = dump_cookie(
+            app.config["SESSION_COOKIE_NAME"],
+            cookie_value,
+            expires=interface.get_expiration_time(app, session),
+            path=interface.get_cookie_path(app),
+            domain=interface.get_cookie_domain(app),
+            secure=interface.get_cookie_secure(app),
+            httponly=interface.get_cookie_httponly(app),
+            samesite=interface.get_cookie_samesite(app),
+        )
+        return [(b"set-cookie", value.encode("latin-1"))]
+
+
+def _headers(scope: Scope) -> Dict[str, str]:
+    return {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", [])}
+
+
+async def _read_body(receive: Receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return body
+
+
+async def _wait_for_disconnect(receive: Receive) -> None:
+    """Return once the client closes the connection (the request body has already been read)."""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def _read_fields(headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+    """Request fields from a JSON object or a urlencoded form; values other than str/bool are dropped."""
+    text = body.decode("utf-8", errors="replace")
+    if headers.get("content-type", "").startswith("application/json"):
+        try:
+            payload = json.loads(text or "{}")
+        except ValueError:
+            return {}
+        if not isinstance(payload, dict):
+            return {}
+        return {key: value for key, value in payload.items() if isinstance(value, (str, bool))}
+    return {key: values[0] for key, values in urllib.parse.parse_qs(text).items()}
+
+
+async def _send_json(
+    send: Send,
+    status: int,
+    payload: Dict[str, Any],
+    extra_headers: Optional[List[Tuple[bytes, bytes]]] = None,
+) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("ascii")),
+            *(extra_headers or []),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app(flask_app: Flask | None = None) -> AsyncGenerationApp:
+    """ASGI factory, e.g. `uvicorn --factory aria.asgi:create_asgi_app`."""
+    return AsyncGenerationApp(flask_app or create_app())
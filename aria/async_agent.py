@@ -0,0 +1,452 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+from typing import Any, Dict, List, Set, Tuple
+
+from openai import AsyncOpenAI, BadRequestError, NotFoundError
+from spotipy.exceptions import SpotifyException
+
+from .agent import (
+    MAX_BATCHED_QUERIES,
+    PROVISIONAL_DESCRIPTION,
+    SPECULATIVE_PLAYLIST_ALIAS,
+    AgentEventCallback,
+    AgentLoop,
+    GenerationRecord,
+    TrackAdds,
+    _emit,
+    announce_tool_call,
+    cached_payload,
+    check_final_response,
+    created_playlist_result,
+    encode_results,
+    final_payload,
+    finish_tool_call,
+    handle_stream_event,
+    local_search_error,
+    local_search_page,
+    local_track,
+    model_request_span,
+    offered_tools,
+    parse_tool_arguments,
+    provisional_name,
+    record_model_usage,
+    search_many_result,
+    serves_locally,
+    shape_search_results,
+    start_tool_span,
+    tool_error_result,
+    tools_for,
+)
+from .encoding import TrackRegistry
+from .executor import AsyncToolExecutor
+from .config import BudgetSettings
+from .services.budget import RunBudget, budget_scope, with_budget_state
+from .services.catalog import TrackCatalog, UnsupportedQuery
+from .services.metrics import GENERATION_SECONDS
+from .services.prompt_cache import CachedResult, PromptCache
+from .services.search_cache import BaseSearchCache, make_search_key
+from .services.spotify_async import AsyncSpotifyClient
+from .services.tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+# Cleanup tasks for orphaned playlists, referenced until they finish.
+_cleanup_tasks: Set[asyncio.Task] = set()
+
+
+def build_async_tool_impls(
+    sp: AsyncSpotifyClient,
+    search_cache: BaseSearchCache | None = None,
+    user_id: str | None = None,
+    track_registry: TrackRegistry | None = None,
+    catalog: TrackCatalog | None = None,
+    catalog_first: bool = False,
+    track_log: Dict[str, List[str]] | None = None,
+) -> Dict[str, Any]:
+    """
+    Coroutine versions of build_tool_impls' tools with the same results. Cache and catalog
+    lookups are SQLite-backed, so they run in worker threads to keep the event loop free.
+    """
+
+    async def resolve_user_id() -> str:
+        nonlocal user_id
+        if user_id is None:
+            user_id = (await sp.current_user())["id"]
+        return user_id
+
+    async def create_playlist(name: str, description: str, public: bool) -> Dict[str, Any]:
+        playlist = await sp.user_playlist_create(
+            user=await resolve_user_id(),
+            name=name[:100],
+            public=public,
+            description=description[:300],
+        )
+        return created_playlist_result(playlist, public)
+
+    added_by_playlist: Dict[str, set] = {}
+    added_lock = asyncio.Lock()
+
+    async def add_tracks(playlist_id: str, uris: List[str], position: int | None = None) -> Dict[str, Any]:
+        async with added_lock:
+            adds = TrackAdds(playlist_id, uris, position, added_by_playlist, track_registry, track_log)
+            for chunk, chunk_position in adds.chunks():
+                try:
+                    response = await sp.playlist_add_items(playlist_id=playlist_id, items=chunk, position=chunk_position)
+                except SpotifyException as exc:
+                    adds.failed(exc)
+                    break
+                adds.sent(chunk, chunk_position, response)
+        return adds.result()
+
+    async def search_items(query: str, item_types: List[str], limit: int) -> Dict[str, Any]:
+        return encode_results(await _search_catalog(query, item_types, limit), track_registry)
+
+    async def search_many(queries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        specs = queries[:MAX_BATCHED_QUERIES]
+        if not specs:
+            return {"queries": 0}
+
+        gathered = await asyncio.gather(
+            *(_search_catalog(spec["query"], spec["item_types"], spec["limit"]) for spec in specs),
+            return_exceptions=True,
+        )
+        return search_many_result(queries, specs, gathered, track_registry)
+
+    async def search_local_catalog(query: str, limit: int) -> Dict[str, Any]:
+        try:
+            tracks = await asyncio.to_thread(catalog.search, query, limit)
+        except (UnsupportedQuery, sqlite3.Error) as exc:
+            return local_search_error(query, exc)
+        return encode_results({"tracks": [local_track(track) for track in tracks]}, track_registry)
+
+    async def _search_catalog(query: str, item_types: List[str], limit: int) -> Dict[str, Any]:
+        cache_key = make_search_key(query, item_types, limit) if search_cache is not None else None
+        if cache_key is not None:
+            cached = await asyncio.to_thread(search_cache.get, cache_key)
+            if cached is not None:
+                logger.debug("Search cache hit for %r", cache_key)
+                return cached
+
+        if serves_locally(catalog, catalog_first, item_types):
+            local = await _search_local_only(query, limit)
+            if local is not None:
+                return local
+
+        results = await sp.search(q=query, type=",".join(item_types), limit=limit)
+        if catalog is not None:
+            catalog.index_search_results(results)
+        out = shape_search_results(results)
+
+        if cache_key is not None:
+            await asyncio.to_thread(search_cache.set, cache_key, out)
+        return out
+
+    async def _search_local_only(query: str, limit: int) -> Dict[str, Any] | None:
+        try:
+            tracks = await asyncio.to_thread(catalog.search, query, limit)
+        except (UnsupportedQuery, sqlite3.Error):
+            return None
+        return local_search_page(query, tracks, limit)
+
+    impls = {
+        "create_playlist": create_playlist,
+        "add_tracks": add_tracks,
+        "search_items": search_items,
+        "search_many": search_many,
+    }
+    if catalog is not None:
+        impls["search_local_catalog"] = search_local_catalog
+    return impls
+
+
+async def run_agent_for_user_async(
+    user_prompt: str,
+    sp: AsyncSpotifyClient,
+    openai_client: AsyncOpenAI,
+    model_name: str = "gpt-5-mini",
+    tool_concurrency: int = 8,
+    search_cache: BaseSearchCache | None = None,
+    user_id: str | None = None,
+    on_event: AgentEventCallback | None = None,
+    stream_responses: bool = False,
+    chain_responses: bool = False,
+    compact_results: bool = False,
+    catalog: TrackCatalog | None = None,
+    catalog_first: bool = False,
+    prompt_cache: PromptCache | None = None,
+    use_prompt_cache: bool = True,
+    speculative_playlist: bool = False,
+    budget: BudgetSettings | None = None,
+    fast_model_name: str | None = None,
+) -> Dict[str, str]:
+    """
+    asyncio version of run_agent_for_user, with the same options, events and result payload.
+    Tool calls of a step fan out with asyncio.gather, so a single event loop can drive many
+    generations at once while they wait on OpenAI and Spotify.
+    """
+
+    record = GenerationRecord(on_event) if prompt_cache is not None else None
+    if record is not None:
+        on_event = record
+    tool_impls = build_async_tool_impls(
+        sp,
+        search_cache=search_cache,
+        user_id=user_id,
+        track_registry=TrackRegistry() if compact_results else None,
+        catalog=catalog,
+        catalog_first=catalog_first,
+        track_log=record.tracks if record is not None else None,
+    )
+
+    run_budget = RunBudget(budget) if budget is not None else None
+    with trace_span("generation", GENERATION_SECONDS, model=model_name) as span, budget_scope(run_budget):
+        cached = prompt_cache.get(user_prompt) if prompt_cache is not None and use_prompt_cache else None
+        if cached is not None:
+            span.set(outcome="cached")
+            return with_budget_state(await _replay_cached_result_async(cached, tool_impls, on_event), run_budget)
+
+        speculative = (
+            AsyncSpeculativePlaylist(sp, tool_impls, user_prompt, on_event) if speculative_playlist else None
+        )
+        if speculative is not None:
+            tool_impls = speculative.tool_impls(tool_impls)
+
+        async def run_call(fc: Any) -> Dict[str, Any]:
+            return await _execute_tool_call_async(fc, tool_impls, on_event)
+
+        try:
+            async with AsyncToolExecutor(run_call, max_concurrency=tool_concurrency) as executor:
+                payload = await _run_agent_loop_async(
+                    user_prompt,
+                    openai_client,
+                    model_name,
+                    executor,
+                    on_event,
+                    stream_responses,
+                    chain_responses,
+                    compact_results,
+                    tools_for(tool_impls),
+                    speculative,
+                    run_budget,
+                    fast_model_name,
+                )
+        except BaseException:
+            if speculative is not None:
+                speculative.discard()
+            raise
+        if run_budget is not None and run_budget.reason:
+            span.set(finalised_early=run_budget.reason)
+    if record is not None:
+        record.store(prompt_cache, user_prompt, payload)
+    return with_budget_state(payload, run_budget)
+
+
+class AsyncSpeculativePlaylist:
+    """asyncio version of SpeculativePlaylist: the provisional playlist is created by a task."""
+
+    def __init__(
+        self,
+        sp: AsyncSpotifyClient,
+        tool_impls: Dict[str, Any],
+        user_prompt: str,
+        on_event: AgentEventCallback | None,
+    ) -> None:
+        self._sp = sp
+        self._on_event = on_event
+        self._chosen: Dict[str, str] | None = None
+        self._added = 0
+        self._discarded = False
+        self._task = asyncio.create_task(self._create(tool_impls["create_playlist"], user_prompt))
+
+    async def _create(self, create: Any, user_prompt: str) -> Dict[str, Any]:
+        playlist = await create(name=provisional_name(user_prompt), description=PROVISIONAL_DESCRIPTION, public=True)
+        _emit(self._on_event, "playlist_created", **playlist)
+        return playlist
+
+    def tool_impls(self, tool_impls: Dict[str, Any]) -> Dict[str, Any]:
+        add_tracks = tool_impls["add_tracks"]
+
+        async def add_tracks_speculative(playlist_id: str, uris: List[str], position: int | None = None) -> Dict[str, Any]:
+            playlist = await self.playlist()
+            result = await add_tracks(playlist_id=playlist["id"], uris=uris, position=position)
+            self._added += result.get("added", 0)
+            return result
+
+        impls = {name: impl for name, impl in tool_impls.items() if name != "create_playlist"}
+        impls["add_tracks"] = add_tracks_speculative
+        impls["name_playlist"] = self.name_playlist
+        return impls
+
+    async def playlist(self) -> Dict[str, Any]:
+        return await asyncio.shield(self._task)
+
+    async def name_playlist(self, name: str, description: str) -> Dict[str, Any]:
+        self._chosen = {"name": name[:100], "description": description[:300]}
+        return {"ok": True, "playlist_id": SPECULATIVE_PLAYLIST_ALIAS, **self._chosen}
+
+    async def finish(self) -> Dict[str, Any] | None:
+        if not self._added:
+            logger.info("Speculative playlist received no tracks, removing it")
+            self.discard()
+            return None
+        playlist = dict(await self.playlist())
+        if self._chosen:
+            try:
+                await self._sp.playlist_change_details(playlist["id"], **self._chosen)
+            except SpotifyException as exc:
+                logger.warning("Renaming speculative playlist %s failed: %s", playlist["id"], exc)
+            else:
+                playlist.update(self._chosen)
+                _emit(self._on_event, "playlist_updated", **playlist)
+        return playlist
+
+    def discard(self) -> None:
+        """Delete the playlist from a separate task, so it also runs when the generation was cancelled."""
+        if self._discarded:
+            return
+        self._discarded = True
+        task = asyncio.get_running_loop().create_task(self._delete())
+        _cleanup_tasks.add(task)
+        task.add_done_callback(_cleanup_tasks.discard)
+
+    async def _delete(self) -> None:
+        try:
+            playlist = await self._task
+        except BaseException:
+            return
+        try:
+            await self._sp.current_user_unfollow_playlist(playlist["id"])
+        except Exception:
+            logger.exception("Could not delete orphaned playlist %s", playlist["id"])
+        else:
+            logger.info("Deleted orphaned speculative playlist %s", playlist["id"])
+
+
+async def _replay_cached_result_async(
+    cached: CachedResult,
+    tool_impls: Dict[str, Any],
+    on_event: AgentEventCallback | None,
+) -> Dict[str, str]:
+    _emit(on_event, "cache_hit", prompt=cached.prompt, tracks=len(cached.tracks))
+    playlist = await tool_impls["create_playlist"](
+        name=cached.name,
+        description=cached.description,
+        public=cached.public,
+    )
+    _emit(on_event, "playlist_created", **playlist)
+    added = await tool_impls["add_tracks"](playlist_id=playlist["id"], uris=cached.tracks)
+    return cached_payload(cached, playlist, added, on_event)
+
+
+async def _run_agent_loop_async(
+    user_prompt: str,
+    openai_client: AsyncOpenAI,
+    model_name: str,
+    executor: AsyncToolExecutor,
+    on_event: AgentEventCallback | None,
+    stream_responses: bool,
+    chain_responses: bool,
+    compact_results: bool,
+    tools: List[Dict[str, Any]],
+    speculative: AsyncSpeculativePlaylist | None = None,
+    budget: RunBudget | None = None,
+    fast_model_name: str | None = None,
+) -> Dict[str, str]:
+    loop = AgentLoop(
+        user_prompt, model_name, on_event, chain_responses, compact_results, tools, speculative is not None, budget, fast_model_name
+    )
+
+    async def create(request: Dict[str, Any]) -> Tuple[Any, Dict[str, asyncio.Task]]:
+        return await _create_response_async(openai_client, request, executor, on_event, loop.step_index, stream_responses)
+
+    while True:
+        request = loop.start_step()
+        try:
+            response, dispatched = await create(request)
+        except (BadRequestError, NotFoundError) as exc:
+            if not loop.unchain(request, exc):
+                raise
+            response, dispatched = await create(request)
+        if loop.replay_on_main_model(request, response):
+            response, dispatched = await create(request)
+
+        function_calls, final_text_chunks = loop.accept(request, response, dispatched)
+        if loop.finished(function_calls):
+            if speculative is not None:
+                loop.last_playlist_info = await speculative.finish()
+            return final_payload(final_text_chunks, loop.last_playlist_info, on_event)
+
+        late_calls = loop.late_calls(function_calls, dispatched)
+        late_results = dict(zip((fc.call_id for fc in late_calls), await executor.run_all(late_calls)))
+        results = [
+            await dispatched[fc.call_id] if fc.call_id in dispatched
+            else late_results[fc.call_id] if fc.call_id in late_results
+            else loop.refuse(fc)
+            for fc in function_calls
+        ]
+        loop.record_results(function_calls, results)
+
+
+async def _create_response_async(
+    openai_client: AsyncOpenAI,
+    request: Dict[str, Any],
+    executor: AsyncToolExecutor,
+    on_event: AgentEventCallback | None,
+    step_index: int,
+    stream_responses: bool,
+):
+    with model_request_span(request, stream_responses, step_index) as span:
+        if stream_responses:
+            response, dispatched = await _stream_response_async(openai_client, request, executor, on_event, step_index)
+        else:
+            response, dispatched = await openai_client.responses.create(**request), {}
+        record_model_usage(span, request["model"], response)
+    return response, dispatched
+
+
+async def _stream_response_async(
+    openai_client: AsyncOpenAI,
+    request: Dict[str, Any],
+    executor: AsyncToolExecutor,
+    on_event: AgentEventCallback | None,
+    step_index: int,
+):
+    dispatched: Dict[str, asyncio.Task] = {}
+    final_response = None
+    offered = offered_tools(request)
+
+    def dispatch(item: Any) -> None:
+        if item.call_id not in dispatched and item.name in offered:
+            announce_tool_call(item, step_index, on_event)
+            dispatched[item.call_id] = executor.submit(item)
+
+    stream = await openai_client.responses.create(stream=True, **request)
+    async for event in stream:
+        final_response = handle_stream_event(event, step_index, on_event, dispatch) or final_response
+
+    return check_final_response(final_response, step_index), dispatched
+
+
+async def _execute_tool_call_async(
+    fc: Any,
+    tool_impls: Dict[str, Any],
+    on_event: AgentEventCallback | None = None,
+) -> Dict[str, Any]:
+    name = fc.name
+    tool_span = start_tool_span(fc, tool_impls)
+    args = parse_tool_arguments(fc)
+
+    if name not in tool_impls:
+        logger.error("Unknown tool requested by model: %s", name)
+        result: Any = {"error": f"unknown function {name}"}
+    else:
+        try:
+            result = await tool_impls[name](**args)
+        except Exception as exc:
+            result = tool_error_result(name, exc)
+
+    finish_tool_call(fc, result, tool_span, on_event)
+    return result
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Tuple
 
 
 class ConfigError(RuntimeError):
@@ -14,16 +15,153 @@ class SpotifySettings:
     client_secret: str
     base_redirect_uri: str
     scope: str = "playlist-modify-public playlist-modify-private"
+    api_base: str = "https://api.spotify.com/v1/"
+    accounts_base: str = "https://accounts.spotify.com"
 
     @property
     def redirect_uri(self) -> str:
         return self.base_redirect_uri.rstrip("/") + "/callback"
 
+    @property
+    def authorize_url(self) -> str:
+        return self.accounts_base.rstrip("/") + "/authorize"
+
+    @property
+    def token_url(self) -> str:
+        return self.accounts_base.rstrip("/") + "/api/token"
+
 
 @dataclass(frozen=True)
 class OpenAISettings:
     api_key: str
     model: str = "gpt-5-mini"
+    # Smaller model for intermediate search turns; None keeps every turn on `model`.
+    fast_model: str | None = None
+
+
+@dataclass(frozen=True)
+class AgentSettings:
+    tool_concurrency: int = 8
+    stream_responses: bool = False
+    chain_responses: bool = False
+    compact_results: bool = False
+    async_max_runs: int = 256
+    # Create the playlist under a provisional name while the first model request runs.
+    speculative_playlist: bool = False
+
+
+@dataclass(frozen=True)
+class SearchCacheSettings:
+    backend: str = "memory"
+    path: str = "instance/search_cache.sqlite3"
+    ttl: int = 86400
+    max_entries: int = 2048
+    max_bytes: int = 16 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class SessionSettings:
+    # "sqlite" (shared by the workers of one host), "redis", "memory" (single process) or "cookie".
+    backend: str = "sqlite"
+    path: str = "instance/sessions.sqlite3"
+    redis_url: str = "redis://127.0.0.1:6379/0"
+    ttl: int = 1209600
+    max_entries: int = 10000
+
+
+@dataclass(frozen=True)
+class PromptCacheSettings:
+    # Shared by all users: a hit replays another user's tracks, name and summary.
+    enabled: bool = False
+    ttl: int = 21600
+    max_entries: int = 1024
+    # Minimum shingle Jaccard similarity for a near-duplicate prompt to reuse a result.
+    similarity: float = 0.8
+
+
+@dataclass(frozen=True)
+class CatalogSettings:
+    enabled: bool = True
+    path: str = "instance/catalog.sqlite3"
+    # Answer track searches from the local index (bm25 ranking) when it has a full page.
+    serve_searches: bool = False
+
+
+@dataclass(frozen=True)
+class HttpSettings:
+    pool_connections: int = 4
+    pool_maxsize: int = 32
+    retries: int = 3
+    backoff_factor: float = 0.3
+    timeout: int = 10
+    async_max_connections: int = 100
+
+
+@dataclass(frozen=True)
+class RateLimitSettings:
+    app_rate: float = 20.0
+    app_burst: int = 40
+    user_rate: float = 5.0
+    user_burst: int = 10
+    max_retries: int = 3
+    max_wait: float = 30.0
+
+
+@dataclass(frozen=True)
+class HedgeSettings:
+    """Duplicate slow idempotent Spotify reads; the first answer wins."""
+
+    enabled: bool = False
+    # Endpoint labels (see services.spotify.endpoint_label) whose GET requests may be hedged.
+    endpoints: Tuple[str, ...] = ("search",)
+    # A hedge is sent once a call is slower than this percentile of the endpoint's recent latencies.
+    percentile: float = 95.0
+    min_delay: float = 0.05
+    # Hedges allowed per hedgeable call, on average.
+    max_rate: float = 0.05
+
+
+@dataclass(frozen=True)
+class BudgetSettings:
+    """Per-generation limits; the agent finalises early when the next two steps could cross one."""
+
+    max_steps: int = 10
+    max_tokens: int = 200_000
+    deadline: float = 180.0
+    max_spotify_calls: int = 120
+
+
+@dataclass(frozen=True)
+class MetricsSettings:
+    # Off unless METRICS_TOKEN is set; METRICS_ENABLED=1 without a token serves /metrics to anyone.
+    enabled: bool = False
+    # When set, /metrics requires `Authorization: Bearer <token>`.
+    token: str | None = None
+
+
+@dataclass(frozen=True)
+class CassetteSettings:
+    """Recording of generations for offline replay (`python -m benchmarks.replay`)."""
+
+    # Directory receiving one cassette per recorded run; recording is off when unset.
+    directory: str | None = None
+    # Fraction of generations recorded.
+    sample_rate: float = 1.0
+
+
+@dataclass(frozen=True)
+class JobSettings:
+    max_workers: int = 4
+    max_pending: int = 32
+    result_ttl: int = 3600
+    # Generations one session may have queued or running; 0 disables the cap.
+    max_per_user: int = 2
+    # Refuse new generations whose estimated queue time is above this many seconds; 0 disables it.
+    max_queue_wait: float = 120.0
+    # Progress streams open at once, in total and per session. Each holds a server thread, so
+    # keep max_streams well below the gunicorn --threads count; refused pages poll instead.
+    max_streams: int = 8
+    max_streams_per_user: int = 2
 
 
 @dataclass(frozen=True)
@@ -31,6 +169,18 @@ class AppConfig:
     secret_key: str
     spotify: SpotifySettings
     openai: OpenAISettings
+    jobs: JobSettings = field(default_factory=JobSettings)
+    agent: AgentSettings = field(default_factory=AgentSettings)
+    search_cache: SearchCacheSettings = field(default_factory=SearchCacheSettings)
+    sessions: SessionSettings = field(default_factory=SessionSettings)
+    http: HttpSettings = field(default_factory=HttpSettings)
+    catalog: CatalogSettings = field(default_factory=CatalogSettings)
+    rate_limit: RateLimitSettings = field(default_factory=RateLimitSettings)
+    metrics: MetricsSettings = field(default_factory=MetricsSettings)
+    budget: BudgetSettings = field(default_factory=BudgetSettings)
+    prompt_cache: PromptCacheSettings = field(default_factory=PromptCacheSettings)
+    cassettes: CassetteSettings = field(default_factory=CassetteSettings)
+    hedging: HedgeSettings = field(default_factory=HedgeSettings)
 
 
 def load_config() -> AppConfig:
@@ -54,17 +204,172 @@ def load_config() -> AppConfig:
     base_redirect = os.getenv("SPOTIFY_REDIRECT_URI", "http://127.0.0.1:3000")
     secret_key = os.getenv("SECRET_KEY_FOR_SESSION", "dev-secret-not-secure")
     openai_model = os.getenv("OPENAI_MODEL", "gpt-5-mini")
+    openai_fast_model = os.getenv("OPENAI_FAST_MODEL", "").strip() or None
 
     spotify_cfg = SpotifySettings(
         client_id=client_id,
         client_secret=client_secret,
         base_redirect_uri=base_redirect,
+        api_base=os.getenv("SPOTIFY_API_BASE", SpotifySettings.api_base).rstrip("/") + "/",
+        accounts_base=os.getenv("SPOTIFY_ACCOUNTS_BASE", SpotifySettings.accounts_base),
+    )
+    openai_cfg = OpenAISettings(api_key=openai_key, model=openai_model, fast_model=openai_fast_model)
+    jobs_cfg = JobSettings(
+        max_workers=_int_env("JOB_WORKERS", 4, minimum=1),
+        max_pending=_int_env("JOB_QUEUE_SIZE", 32, minimum=0),
+        result_ttl=_int_env("JOB_RESULT_TTL", 3600, minimum=60),
+        max_per_user=_int_env("JOB_MAX_PER_USER", JobSettings.max_per_user, minimum=0),
+        max_queue_wait=_float_env("JOB_MAX_QUEUE_WAIT", JobSettings.max_queue_wait, minimum=0),
+        max_streams=_int_env("JOB_MAX_STREAMS", JobSettings.max_streams, minimum=0),
+        max_streams_per_user=_int_env("JOB_MAX_STREAMS_PER_USER", JobSettings.max_streams_per_user, minimum=1),
+    )
+    agent_cfg = AgentSettings(
+        tool_concurrency=_int_env("AGENT_TOOL_CONCURRENCY", 8, minimum=1),
+        stream_responses=_bool_env("AGENT_STREAM_RESPONSES", AgentSettings.stream_responses),
+        chain_responses=_bool_env("AGENT_CHAIN_RESPONSES", AgentSettings.chain_responses),
+        compact_results=_bool_env("AGENT_COMPACT_RESULTS", AgentSettings.compact_results),
+        async_max_runs=_int_env("AGENT_ASYNC_MAX_RUNS", AgentSettings.async_max_runs, minimum=1),
+        speculative_playlist=_bool_env("AGENT_SPECULATIVE_PLAYLIST", AgentSettings.speculative_playlist),
+    )
+    cache_backend = os.getenv("SEARCH_CACHE_BACKEND", "memory").strip().lower()
+    if cache_backend not in {"memory", "sqlite", "off"}:
+        raise ConfigError(f"SEARCH_CACHE_BACKEND must be memory, sqlite or off, got {cache_backend!r}")
+    search_cache_cfg = SearchCacheSettings(
+        backend=cache_backend,
+        path=os.getenv("SEARCH_CACHE_PATH", SearchCacheSettings.path),
+        ttl=_int_env("SEARCH_CACHE_TTL", SearchCacheSettings.ttl, minimum=1),
+        max_entries=_int_env("SEARCH_CACHE_MAX_ENTRIES", SearchCacheSettings.max_entries, minimum=1),
+        max_bytes=_int_env("SEARCH_CACHE_MAX_BYTES", SearchCacheSettings.max_bytes, minimum=1024),
+    )
+    session_backend = os.getenv("SESSION_BACKEND", SessionSettings.backend).strip().lower()
+    if session_backend not in {"sqlite", "redis", "memory", "cookie"}:
+        raise ConfigError(f"SESSION_BACKEND must be sqlite, redis, memory or cookie, got {session_backend!r}")
+    sessions_cfg = SessionSettings(
+        backend=session_backend,
+        path=os.getenv("SESSION_PATH", SessionSettings.path),
+        redis_url=os.getenv("SESSION_REDIS_URL", SessionSettings.redis_url),
+        ttl=_int_env("SESSION_TTL", SessionSettings.ttl, minimum=60),
+        max_entries=_int_env("SESSION_MAX_ENTRIES", SessionSettings.max_entries, minimum=1),
+    )
+    http_cfg = HttpSettings(
+        pool_connections=_int_env("HTTP_POOL_CONNECTIONS", HttpSettings.pool_connections, minimum=1),
+        pool_maxsize=_int_env("HTTP_POOL_MAXSIZE", HttpSettings.pool_maxsize, minimum=1),
+        retries=_int_env("HTTP_RETRIES", HttpSettings.retries, minimum=0),
+        timeout=_int_env("HTTP_TIMEOUT", HttpSettings.timeout, minimum=1),
+        async_max_connections=_int_env(
+            "HTTP_ASYNC_MAX_CONNECTIONS", HttpSettings.async_max_connections, minimum=1
+        ),
+    )
+    catalog_cfg = CatalogSettings(
+        enabled=_bool_env("CATALOG_ENABLED", CatalogSettings.enabled),
+        path=os.getenv("CATALOG_PATH", CatalogSettings.path),
+        serve_searches=_bool_env("CATALOG_SERVE_SEARCHES", CatalogSettings.serve_searches),
+    )
+    rate_limit_cfg = RateLimitSettings(
+        app_rate=_float_env("SPOTIFY_RATE_LIMIT_APP", RateLimitSettings.app_rate),
+        app_burst=_int_env("SPOTIFY_RATE_LIMIT_APP_BURST", RateLimitSettings.app_burst, minimum=1),
+        user_rate=_float_env("SPOTIFY_RATE_LIMIT_USER", RateLimitSettings.user_rate),
+        user_burst=_int_env("SPOTIFY_RATE_LIMIT_USER_BURST", RateLimitSettings.user_burst, minimum=1),
+        max_retries=_int_env("SPOTIFY_RATE_LIMIT_RETRIES", RateLimitSettings.max_retries, minimum=0),
+        max_wait=_float_env("SPOTIFY_RATE_LIMIT_MAX_WAIT", RateLimitSettings.max_wait),
+    )
+    hedge_percentile = _float_env("SPOTIFY_HEDGE_PERCENTILE", HedgeSettings.percentile)
+    hedge_rate = _float_env("SPOTIFY_HEDGE_MAX_RATE", HedgeSettings.max_rate)
+    if hedge_percentile >= 100:
+        raise ConfigError(f"SPOTIFY_HEDGE_PERCENTILE must be < 100, got {hedge_percentile}")
+    if hedge_rate > 1:
+        raise ConfigError(f"SPOTIFY_HEDGE_MAX_RATE must be <= 1, got {hedge_rate}")
+    hedge_endpoints = os.getenv("SPOTIFY_HEDGE_ENDPOINTS")
+    hedging_cfg = HedgeSettings(
+        enabled=_bool_env("SPOTIFY_HEDGE_ENABLED", HedgeSettings.enabled),
+        endpoints=(
+            tuple(name.strip() for name in hedge_endpoints.split(",") if name.strip())
+            if hedge_endpoints
+            else HedgeSettings.endpoints
+        ),
+        percentile=hedge_percentile,
+        min_delay=_float_env("SPOTIFY_HEDGE_MIN_DELAY", HedgeSettings.min_delay),
+        max_rate=hedge_rate,
+    )
+    similarity = _float_env("PROMPT_CACHE_SIMILARITY", PromptCacheSettings.similarity)
+    if similarity > 1:
+        raise ConfigError(f"PROMPT_CACHE_SIMILARITY must be <= 1, got {similarity}")
+    prompt_cache_cfg = PromptCacheSettings(
+        enabled=_bool_env("PROMPT_CACHE_ENABLED", PromptCacheSettings.enabled),
+        ttl=_int_env("PROMPT_CACHE_TTL", PromptCacheSettings.ttl, minimum=1),
+        max_entries=_int_env("PROMPT_CACHE_MAX_ENTRIES", PromptCacheSettings.max_entries, minimum=1),
+        similarity=similarity,
+    )
+    budget_cfg = BudgetSettings(
+        max_steps=_int_env("AGENT_MAX_STEPS", BudgetSettings.max_steps, minimum=3),
+        max_tokens=_int_env("AGENT_MAX_TOKENS", BudgetSettings.max_tokens, minimum=1000),
+        deadline=_float_env("AGENT_DEADLINE_SECONDS", BudgetSettings.deadline),
+        max_spotify_calls=_int_env("AGENT_MAX_SPOTIFY_CALLS", BudgetSettings.max_spotify_calls, minimum=10),
+    )
+    sample_rate = _float_env("CASSETTE_SAMPLE_RATE", CassetteSettings.sample_rate)
+    if sample_rate > 1:
+        raise ConfigError(f"CASSETTE_SAMPLE_RATE must be <= 1, got {sample_rate}")
+    cassettes_cfg = CassetteSettings(
+        directory=os.getenv("CASSETTE_DIR") or None,
+        sample_rate=sample_rate,
+    )
+    metrics_token = os.getenv("METRICS_TOKEN") or None
+    metrics_cfg = MetricsSettings(
+        enabled=_bool_env("METRICS_ENABLED", metrics_token is not None),
+        token=metrics_token,
     )
-    openai_cfg = OpenAISettings(api_key=openai_key, model=openai_model)
 
     return AppConfig(
         secret_key=secret_key,
         spotify=spotify_cfg,
         openai=openai_cfg,
+        jobs=jobs_cfg,
+        agent=agent_cfg,
+        search_cache=search_cache_cfg,
+        sessions=sessions_cfg,
+        http=http_cfg,
+        catalog=catalog_cfg,
+        rate_limit=rate_limit_cfg,
+        metrics=metrics_cfg,
+        budget=budget_cfg,
+        prompt_cache=prompt_cache_cfg,
+        cassettes=cassettes_cfg,
+        hedging=hedging_cfg,
     )
 
+
+def _bool_env(name: str, default: bool) -> bool:
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    return raw.strip().lower() in {"1", "true", "yes", "on"}
+
+
+def _float_env(name: str, default: float, minimum: float | None = None) -> float:
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        value = float(raw)
+    except ValueError as exc:
+        raise ConfigError(f"{name} must be a number, got {raw!r}") from exc
+    if minimum is not None:
+        if value < minimum:
+            raise ConfigError(f"{name} must be >= {minimum}, got {value}")
+    elif value <= 0:
+        raise ConfigError(f"{name} must be > 0, got {value}")
+    return value
+
+
+def _int_env(name: str, default: int, minimum: int | None = None) -> int:
+    raw = os.getenv(name)
+    if raw is None or not raw.strip():
+        return default
+    try:
+        value = int(raw)
+    except ValueError as exc:
+        raise ConfigError(f"{name} must be an integer, got {raw!r}") from exc
+    if minimum is not None and value < minimum:
+        raise ConfigError(f"{name} must be >= {minimum}, got {value}")
+    return value
+
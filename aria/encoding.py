@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Dict, List, Tuple
+
+FIELD_SEPARATOR = "|"
+HANDLE_PREFIX = "t"
+
+
+class TrackRegistry:
+    """
+    Per-run mapping between short row handles (t1, t2, ...) and Spotify track URIs.
+    The model only ever sees handles in compact mode; add_tracks maps them back server-side.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._handle_by_uri: Dict[str, str] = {}
+        self._uri_by_handle: Dict[str, str] = {}
+
+    def register(self, uri: str) -> Tuple[str, bool]:
+        """Return the handle for `uri` and whether it was seen for the first time."""
+        with self._lock:
+            handle = self._handle_by_uri.get(uri)
+            if handle is not None:
+                return handle, False
+            handle = f"{HANDLE_PREFIX}{len(self._handle_by_uri) + 1}"
+            self._handle_by_uri[uri] = handle
+            self._uri_by_handle[handle] = uri
+            return handle, True
+
+    def resolve(self, ref: str) -> str:
+        """Map a handle back to its URI; anything else is returned untouched."""
+        with self._lock:
+            return self._uri_by_handle.get(ref.strip(), ref)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._handle_by_uri)
+
+
+def encode_search_results(out: Dict[str, Any], registry: TrackRegistry) -> Dict[str, Any]:
+    """
+    Turn search_items' verbose output into header + delimited rows. Tracks already shown
+    earlier in the run are listed by handle only instead of being repeated.
+    """
+    encoded: Dict[str, Any] = {}
+
+    if "tracks" in out:
+        rows: List[List[str]] = []
+        already_shown: List[str] = []
+        for track in out["tracks"]:
+            handle, is_new = registry.register(track["uri"])
+            if is_new:
+                rows.append([handle, track["name"], track["artists"]])
+            elif handle not in already_shown and all(row[0] != handle for row in rows):
+                already_shown.append(handle)
+        encoded["tracks"] = _table(["handle", "name", "artists"], rows)
+        if already_shown:
+            encoded["already_shown"] = ",".join(already_shown)
+
+    if "artists" in out:
+        encoded["artists"] = _table(
+            ["name", "genres"],
+            [[artist["name"], ", ".join(artist.get("genres", []))] for artist in out["artists"]],
+        )
+
+    if "albums" in out:
+        encoded["albums"] = _table(
+            ["name", "artists"],
+            [[album["name"], album["artists"]] for album in out["albums"]],
+        )
+
+    return encoded
+
+
+def _table(header: List[str], rows: List[List[str]]) -> str:
+    lines = [FIELD_SEPARATOR.join(header)]
+    lines.extend(FIELD_SEPARATOR.join(_cell(value) for value in row) for row in rows)
+    return "\n".join(lines)
+
+
+def _cell(value: Any) -> str:
+    text = "" if value is None else str(value)
+    return " ".join(text.replace(FIELD_SEPARATOR, "/").split())
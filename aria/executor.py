@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_CREATORS = frozenset({"create_playlist"})
+PLAYLIST_WRITERS = frozenset({"add_tracks"})
+
+
+class ToolExecutor:
+    """
+    Runs the tool calls requested by the model on a thread pool.
+    Searches run concurrently; playlist creation and track insertion keep their relative
+    order, and every add_tracks waits for the create_playlist calls submitted before it.
+    """
+
+    def __init__(self, run_call: Callable[[Any], Dict[str, Any]], max_workers: int = 8) -> None:
+        self._run_call = run_call
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="aria-tool")
+        self._lock = threading.Lock()
+        self._creators: List[Future] = []
+        self._last_write: Future | None = None
+
+    def submit(self, call: Any) -> Future:
+        name = getattr(call, "name", "")
+        with self._lock:
+            if name in PLAYLIST_CREATORS:
+                deps = list(self._creators)
+            elif name in PLAYLIST_WRITERS:
+                deps = list(self._creators)
+                if self._last_write is not None:
+                    deps.append(self._last_write)
+            else:
+                deps = []
+
+            # Dependencies are always submitted earlier, so the FIFO pool has already started
+            # them by the time this call runs and waiting on them cannot starve the pool.
+            # Run in a copy of the caller's context so tool spans nest under the current step.
+            context = contextvars.copy_context()
+            future = self._pool.submit(context.run, self._run_after, deps, call)
+
+            if name in PLAYLIST_CREATORS:
+                self._creators.append(future)
+            elif name in PLAYLIST_WRITERS:
+                self._last_write = future
+        return future
+
+    def run_all(self, calls: Iterable[Any]) -> List[Dict[str, Any]]:
+        """Execute a step's calls and return their results in the original call order."""
+        calls = list(calls)
+        futures: Dict[int, Future] = {}
+        ordered = sorted(
+            range(len(calls)),
+            key=lambda idx: 0 if getattr(calls[idx], "name", "") in PLAYLIST_CREATORS else 1,
+        )
+        for idx in ordered:
+            futures[idx] = self.submit(calls[idx])
+        return [futures[idx].result() for idx in range(len(calls))]
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> "ToolExecutor":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def _run_after(self, deps: List[Future], call: Any) -> Dict[str, Any]:
+        for dep in deps:
+            try:
+                dep.result()
+            except Exception:  # pragma: no cover - run_call already turns failures into results
+                logger.debug("Dependency of tool call %s failed", getattr(call, "call_id", "?"))
+        return self._run_call(call)
+
+
+class AsyncToolExecutor:
+    """
+    asyncio counterpart of ToolExecutor with the same ordering rules. Calls run as tasks on
+    the event loop, at most `max_concurrency` at a time.
+    """
+
+    def __init__(self, run_call: Callable[[Any], Awaitable[Dict[str, Any]]], max_concurrency: int = 8) -> None:
+        self._run_call = run_call
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self._tasks: List[asyncio.Task] = []
+        self._creators: List[asyncio.Task] = []
+        self._last_write: asyncio.Task | None = None
+
+    def submit(self, call: Any) -> asyncio.Task:
+        name = getattr(call, "name", "")
+        if name in PLAYLIST_CREATORS:
+            deps = list(self._creators)
+        elif name in PLAYLIST_WRITERS:
+            deps = list(self._creators)
+            if self._last_write is not None:
+                deps.append(self._last_write)
+        else:
+            deps = []
+
+        task = asyncio.ensure_future(self._run_after(deps, call))
+        self._tasks.append(task)
+        if name in PLAYLIST_CREATORS:
+            self._creators.append(task)
+        elif name in PLAYLIST_WRITERS:
+            self._last_write = task
+        return task
+
+    async def run_all(self, calls: Iterable[Any]) -> List[Dict[str, Any]]:
+        """Execute a step's calls and return their results in the original call order."""
+        calls = list(calls)
+        tasks: Dict[int, asyncio.Task] = {}
+        ordered = sorted(
+            range(len(calls)),
+            key=lambda idx: 0 if getattr(calls[idx], "name", "") in PLAYLIST_CREATORS else 1,
+        )
+        for idx in ordered:
+            tasks[idx] = self.submit(calls[idx])
+        return list(await asyncio.gather(*(tasks[idx] for idx in range(len(calls)))))
+
+    async def aclose(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def __aenter__(self) -> "AsyncToolExecutor":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    async def _run_after(self, deps: List[asyncio.Task], call: Any) -> Dict[str, Any]:
+        for dep in deps:
+            try:
+                await dep
+            except Exception:  # pragma: no cover - run_call already turns failures into results
+                logger.debug("Dependency of tool call %s failed", getattr(call, "call_id", "?"))
+        async with self._semaphore:
+            return await self._run_call(call)
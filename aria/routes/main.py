@@ -1,6 +1,9 @@
 from __future__ import annotations
 
-from typing import Any, Dict
+import json
+import logging
+import uuid
+from typing import Any, Dict, Iterator
 
 from flask import (
     Blueprint,
@@ -11,18 +14,30 @@ from flask import (
     render_template,
     request,
     session,
+    stream_with_context,
+    url_for,
 )
 from requests import HTTPError
 
 from ..agent import run_agent_for_user
 from ..config import AppConfig
 from ..services import spotify as spotify_service
+from ..services.admission import AdmissionRejected
+from ..services.cassette import record_generation
+from ..services.jobs import JOB_QUEUED, JOB_SUCCEEDED, Job, JobFunction, JobManager, StreamSlots, flight_key
+from ..services.session_store import BaseSessionStore, regenerate_session, session_key
 
 bp = Blueprint("main", __name__)
 
+logger = logging.getLogger(__name__)
+
 
 @bp.get("/")
 def index() -> str:
+    job = _get_job_manager().latest_for(_session_key())
+    if job is not None:
+        _sync_session_with_job(job)
+
     pending_prompt = session.get("pending_prompt", "")
     result = session.get("last_result")
 
@@ -41,17 +56,29 @@ def generate() -> str | Response:
         return "Prompt vide", 400
 
     session["pending_prompt"] = prompt
+    session["pending_fresh"] = _wants_fresh_result()
+    _session_key()  # pin the job owner before a possible OAuth round trip
 
     spotify_client = _ensure_spotify_client()
     if spotify_client is None:
         return _start_spotify_oauth_flow()
 
-    agent_result = run_agent_for_user(
-        user_prompt=prompt,
-        sp=spotify_client,
-        openai_client=_get_openai_client(),
-        model_name=_get_app_config().openai.model,
-    )
+    owner = _session_key()
+    try:
+        job = _get_job_manager().run(
+            owner=owner,
+            prompt=prompt,
+            fn=_generation_function(prompt, spotify_client),
+            flight_key=flight_key(owner, prompt),
+        )
+    except AdmissionRejected as exc:
+        current_app.logger.warning("Generation refused (%s), retry in %ss", exc.reason, exc.retry_after)
+        message = f"Aria est très sollicitée, réessaie dans {exc.retry_after} s."
+        return Response(message, status=exc.status, headers={"Retry-After": str(exc.retry_after)})
+    session["job_id"] = job.id
+    if job.status != JOB_SUCCEEDED:
+        return "La génération a échoué, réessaie.", 500
+    agent_result = job.result
 
     session["pending_prompt"] = ""
     session["last_result"] = agent_result
@@ -60,6 +87,7 @@ def generate() -> str | Response:
         "home.html",
         connected=spotify_service.is_user_authenticated(session),
         result=agent_result,
+        pending_prompt="",
     )
 
 
@@ -70,27 +98,69 @@ def generate_async() -> Response:
         return jsonify({"error": "Prompt vide"}), 400
 
     session["pending_prompt"] = prompt
+    session["pending_fresh"] = _wants_fresh_result()
+    _session_key()  # pin the job owner before a possible OAuth round trip
 
     spotify_client = _ensure_spotify_client()
     if spotify_client is None:
         auth_url = spotify_service.build_authorize_url(_get_app_config().spotify)
         return jsonify({"need_auth": True, "auth_url": auth_url}), 401
 
-    agent_result = run_agent_for_user(
-        user_prompt=prompt,
-        sp=spotify_client,
-        openai_client=_get_openai_client(),
-        model_name=_get_app_config().openai.model,
-    )
+    try:
+        job = _submit_generation_job(prompt, spotify_client)
+    except AdmissionRejected as exc:
+        return _rejected_response(exc)
 
-    session["pending_prompt"] = ""
-    session["last_result"] = agent_result
+    return _job_accepted_response(job)
+
+
+@bp.get("/jobs/<job_id>")
+def job_status(job_id: str) -> Response:
+    job = _get_job_manager().get(job_id)
+    if job is None or job.owner != _session_key():
+        return jsonify({"error": "unknown_job"}), 404
+
+    _sync_session_with_job(job)
+    return jsonify(_job_payload(job)), 200
 
-    return jsonify(agent_result), 200
+
+@bp.get("/generate/stream")
+def generate_stream() -> Response:
+    """Server-Sent Events feed of a generation job's progress, ending with a `done` or `failed` event."""
+    job_id = request.args.get("job_id") or session.get("job_id")
+    job = _get_job_manager().get(job_id) if job_id else None
+    if job is None or job.owner != _session_key():
+        return jsonify({"error": "unknown_job"}), 404
+
+    try:
+        after = int(request.headers.get("Last-Event-ID") or request.args.get("after") or 0)
+    except ValueError:
+        after = 0
+
+    # Each stream holds a server thread until the job ends; over the cap the page polls /jobs/<id>.
+    slots: StreamSlots = current_app.extensions["stream_slots"]
+    owner = job.owner
+    if not slots.acquire(owner):
+        return jsonify({"error": "too_many_streams", "status_url": url_for("main.job_status", job_id=job.id)}), 429
+
+    response = Response(
+        stream_with_context(_sse_events(job, after)),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+    response.call_on_close(lambda: slots.release(owner))
+    return response
 
 
 @bp.get("/latest_result")
 def latest_result() -> Response:
+    job = _get_job_manager().latest_for(_session_key())
+    if job is not None:
+        _sync_session_with_job(job)
+
     result = session.get("last_result")
     if not result:
         return Response(status=204)
@@ -141,6 +211,8 @@ def callback() -> str | Response:
             error_message=err_message,
         ), 400
 
+    # The session now holds the user's tokens: never under an id that existed before login.
+    regenerate_session(session)
     return render_template(
         "after_auth_loading.html",
         status="success",
@@ -154,21 +226,159 @@ def finish_generation() -> Response:
     if not prompt:
         return jsonify({"error": "no_prompt"}), 400
 
+    job = _get_job_manager().latest_for(_session_key())
+    if job is not None and job.prompt == prompt:
+        if job.status == JOB_SUCCEEDED:
+            _sync_session_with_job(job)
+            return jsonify({"ok": True, "result": job.result}), 200
+        if not job.finished:
+            return _job_accepted_response(job)
+
     spotify_client = _ensure_spotify_client()
     if spotify_client is None:
         return jsonify({"error": "no_spotify_client"}), 401
 
-    agent_result = run_agent_for_user(
-        user_prompt=prompt,
-        sp=spotify_client,
-        openai_client=_get_openai_client(),
-        model_name=_get_app_config().openai.model,
+    try:
+        job = _submit_generation_job(prompt, spotify_client)
+    except AdmissionRejected as exc:
+        return _rejected_response(exc)
+
+    return _job_accepted_response(job)
+
+
+def _submit_generation_job(prompt: str, spotify_client) -> Job:
+    """
+    Hand the generation to the worker pool, or return the job already generating this
+    prompt for this session (a retried submit, or the post-OAuth resume racing it).
+    """
+    owner = _session_key()
+    job = _get_job_manager().submit(
+        owner=owner,
+        prompt=prompt,
+        fn=_generation_function(prompt, spotify_client),
+        flight_key=flight_key(owner, prompt),
     )
+    session["job_id"] = job.id
+    return job
+
+
+def _generation_function(prompt: str, spotify_client) -> JobFunction:
+    """Capture everything the agent needs from the request context, for a job to run."""
+    options = _agent_options()
+    cassettes = _get_app_config().cassettes
+    store = _get_session_store()
+    sid = getattr(session, "sid", None)
+
+    def run(emit) -> Dict[str, Any]:
+        result = record_generation(
+            cassettes,
+            prompt,
+            spotify_client,
+            options,
+            emit,
+            lambda sp, run_options, on_event: run_agent_for_user(
+                user_prompt=prompt,
+                sp=sp,
+                on_event=on_event,
+                **run_options,
+            ),
+        )
+        if store is not None and sid:
+            _store_job_result(store, sid, prompt, result)
+        return result
+
+    return run
+
+
+def _agent_options() -> Dict[str, Any]:
+    """Resolve the app services and session data an agent run needs while still inside the request."""
+    config = _get_app_config()
+    return {
+        "openai_client": _get_openai_client(),
+        "model_name": config.openai.model,
+        "fast_model_name": config.openai.fast_model,
+        "tool_concurrency": config.agent.tool_concurrency,
+        "stream_responses": config.agent.stream_responses,
+        "chain_responses": config.agent.chain_responses,
+        "compact_results": config.agent.compact_results,
+        "speculative_playlist": config.agent.speculative_playlist,
+        "budget": config.budget,
+        "search_cache": current_app.extensions.get("search_cache"),
+        "catalog": current_app.extensions.get("track_catalog"),
+        "catalog_first": config.catalog.serve_searches,
+        "user_id": spotify_service.get_session_user_id(session),
+        "prompt_cache": current_app.extensions.get("prompt_cache"),
+        "use_prompt_cache": not session.get("pending_fresh", False),
+    }
+
+
+def _wants_fresh_result() -> bool:
+    """Per-request opt-out of the prompt cache (`fresh=1`)."""
+    return request.form.get("fresh", "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+def _job_payload(job: Job) -> Dict[str, Any]:
+    payload = job.to_dict()
+    if job.status == JOB_QUEUED:
+        payload["estimated_wait_seconds"] = round(_get_job_manager().estimated_wait(job), 1)
+    return payload
+
+
+def _job_accepted_response(job: Job) -> Response:
+    payload = _job_payload(job)
+    payload["status_url"] = url_for("main.job_status", job_id=job.id)
+    payload["stream_url"] = url_for("main.generate_stream", job_id=job.id)
+    return jsonify(payload), 202
+
+
+def _rejected_response(exc: AdmissionRejected) -> Response:
+    """Fast refusal: 429 when the session has too many generations in flight, 503 when saturated."""
+    current_app.logger.warning("Generation refused (%s), retry in %ss", exc.reason, exc.retry_after)
+    error = "too_many_generations" if exc.status == 429 else "busy"
+    response = jsonify({"error": error, "reason": exc.reason, "retry_after": exc.retry_after})
+    response.status_code = exc.status
+    response.headers["Retry-After"] = str(exc.retry_after)
+    return response
+
+
+def _sse_events(job: Job, after: int) -> Iterator[str]:
+    yield "retry: 3000\n\n"
+    for event in _get_job_manager().iter_events(job, after=after):
+        if event is None:
+            yield ": keep-alive\n\n"
+            continue
+        data = json.dumps(event["data"], ensure_ascii=False)
+        yield f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+def _store_job_result(store: BaseSessionStore, sid: str, prompt: str, result: Dict[str, Any]) -> None:
+    """Write a finished job's result straight into its server-side session, from the job thread."""
+    try:
+        data = store.load(session_key(sid)) or {}
+        changes: Dict[str, Any] = {"last_result": result}
+        if data.get("pending_prompt") == prompt:
+            changes["pending_prompt"] = ""
+        store.apply(session_key(sid), changes)
+    except Exception:
+        logger.exception("Could not store the generation result in the session")
 
-    session["pending_prompt"] = ""
-    session["last_result"] = agent_result
 
-    return jsonify({"ok": True, "result": agent_result}), 200
+def _sync_session_with_job(job: Job) -> None:
+    """Copy a finished job's result into a cookie session, which worker threads cannot write."""
+    if job.status != JOB_SUCCEEDED or session.get("job_id") != job.id:
+        return
+    if session.get("last_result") != job.result:
+        session["last_result"] = job.result
+    if session.get("pending_prompt") == job.prompt:
+        session["pending_prompt"] = ""
+
+
+def _session_key() -> str:
+    key = session.get("sid")
+    if not key:
+        key = getattr(session, "sid", None) or uuid.uuid4().hex
+        session["sid"] = key
+    return key
 
 
 def _ensure_spotify_client():
@@ -187,5 +397,13 @@ def _get_openai_client():
     return current_app.extensions["openai_client"]
 
 
+def _get_session_store() -> BaseSessionStore | None:
+    return current_app.extensions.get("session_store")
+
+
+def _get_job_manager() -> JobManager:
+    return current_app.extensions["job_manager"]
+
+
 def _get_app_config() -> AppConfig:
     return current_app.config["APP_CONFIG"]
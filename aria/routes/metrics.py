@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import hmac
+from typing import Any, Dict, Iterable, List, Tuple
+
+from flask import Blueprint, Flask, Response, current_app, request
+
+from ..config import AppConfig
+from ..services.metrics import REGISTRY, MetricsRegistry
+
+bp = Blueprint("metrics", __name__)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@bp.get("/metrics")
+def metrics() -> Response:
+    token = _get_app_config().metrics.token
+    if token:
+        supplied = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {token}".encode("utf-8")):
+            return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def register_service_collectors(app: Flask, registry: MetricsRegistry = REGISTRY) -> None:
+    """Expose the app's cache, catalog, job and rate limiter state, read at scrape time."""
+    extensions = app.extensions
+
+    def collect() -> Iterable[Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]]:
+        cache = extensions.get("search_cache")
+        if cache is not None:
+            stats = cache.stats()
+            labels = {"backend": str(stats.get("backend", ""))}
+            yield "aria_search_cache_hits", "counter", "Search cache hits.", [
+                ("aria_search_cache_hits_total", labels, stats["hits"]),
+            ]
+            yield "aria_search_cache_misses", "counter", "Search cache misses.", [
+                ("aria_search_cache_misses_total", labels, stats["misses"]),
+            ]
+            yield "aria_search_cache_evictions", "counter", "Search cache evictions.", [
+                ("aria_search_cache_evictions_total", labels, stats["evictions"]),
+            ]
+            yield "aria_search_cache_hit_ratio", "gauge", "Search cache hits / lookups.", [
+                ("aria_search_cache_hit_ratio", labels, stats["hit_rate"]),
+            ]
+            if stats.get("entries") is not None:
+                yield "aria_search_cache_entries", "gauge", "Entries held by the search cache.", [
+                    ("aria_search_cache_entries", labels, stats["entries"]),
+                ]
+
+        prompt_cache = extensions.get("prompt_cache")
+        if prompt_cache is not None:
+            stats = prompt_cache.stats()
+            yield "aria_prompt_cache_lookups", "counter", "Prompt cache lookups by result.", [
+                ("aria_prompt_cache_lookups_total", {"result": "hit"}, stats["hits"]),
+                ("aria_prompt_cache_lookups_total", {"result": "near_hit"}, stats["near_hits"]),
+                ("aria_prompt_cache_lookups_total", {"result": "miss"}, stats["misses"]),
+            ]
+            yield "aria_prompt_cache_entries", "gauge", "Generations held by the prompt cache.", [
+                ("aria_prompt_cache_entries", {}, stats["entries"]),
+            ]
+
+        session_store = extensions.get("session_store")
+        if session_store is not None:
+            stats = session_store.stats()
+            if stats.get("entries") is not None:
+                yield "aria_session_store_entries", "gauge", "Session and job records held by the session store.", [
+                    ("aria_session_store_entries", {"backend": stats["backend"]}, stats["entries"]),
+                ]
+
+        catalog = extensions.get("track_catalog")
+        if catalog is not None:
+            stats = catalog.stats()
+            yield "aria_catalog_tracks", "gauge", "Tracks in the local catalog.", [
+                ("aria_catalog_tracks", {}, stats["tracks"]),
+            ]
+            yield "aria_catalog_pending", "gauge", "Search payloads waiting to be indexed in the local catalog.", [
+                ("aria_catalog_pending", {}, stats["pending"]),
+            ]
+            yield "aria_catalog_dropped", "counter", "Search payloads dropped because the indexing queue was full.", [
+                ("aria_catalog_dropped_total", {}, stats["dropped"]),
+            ]
+
+        job_manager = extensions.get("job_manager")
+        if job_manager is not None:
+            by_status: Dict[str, float] = {"queued": 0, "running": 0}
+            for job in job_manager.active_jobs():
+                by_status[job.status] = by_status.get(job.status, 0) + 1
+            yield "aria_jobs_active", "gauge", "Generation jobs not finished yet.", [
+                ("aria_jobs_active", {"status": status}, count) for status, count in by_status.items()
+            ]
+
+        admission = extensions.get("admission")
+        if admission is not None:
+            stats = admission.stats()
+            yield "aria_admission_slots", "gauge", "Generation run slots, by state.", [
+                ("aria_admission_slots", {"state": state}, stats[state]) for state in ("running", "queued")
+            ]
+            yield "aria_admission_estimated_wait_seconds", "gauge", "Queue time a new generation would get.", [
+                ("aria_admission_estimated_wait_seconds", {}, stats["estimated_wait"]),
+            ]
+
+        slots = extensions.get("stream_slots")
+        if slots is not None:
+            yield "aria_progress_streams", "gauge", "Open Server-Sent Events progress streams.", [
+                ("aria_progress_streams", {}, slots.stats()["open"]),
+            ]
+
+        limiter = extensions.get("rate_limiter")
+        if limiter is not None:
+            snapshot: Dict[str, Any] = limiter.snapshot()
+            yield "aria_spotify_throttled", "counter", "429 responses received from Spotify.", [
+                ("aria_spotify_throttled_total", {}, snapshot["throttled_total"]),
+            ]
+            yield "aria_spotify_retries", "counter", "Spotify calls retried after a 429.", [
+                ("aria_spotify_retries_total", {}, snapshot["retries_total"]),
+            ]
+            yield "aria_spotify_rate_wait_seconds", "counter", "Time spent waiting on the rate limiter.", [
+                ("aria_spotify_rate_wait_seconds_total", {}, snapshot["waited_seconds_total"]),
+            ]
+            yield "aria_spotify_backoff_seconds", "gauge", "Remaining Retry-After backoff.", [
+                ("aria_spotify_backoff_seconds", {}, snapshot["backoff_remaining"]),
+            ]
+
+        hedger = extensions.get("spotify_hedger")
+        if hedger is not None:
+            delays = hedger.stats()["delays"]
+            yield "aria_spotify_hedge_delay_seconds", "gauge", "Latency after which a Spotify read is hedged.", [
+                ("aria_spotify_hedge_delay_seconds", {"endpoint": endpoint}, delay)
+                for endpoint, delay in sorted(delays.items())
+                if delay is not None
+            ]
+
+    registry.add_collector("app_services", collect)
+
+
+def _get_app_config() -> AppConfig:
+    return current_app.config["APP_CONFIG"]
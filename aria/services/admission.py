@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Tuple
+
+from .metrics import ADMISSION_REJECTIONS, GENERATION_QUEUE_SECONDS
+
+# Run duration assumed for queue-time estimates until real runs have been measured.
+DEFAULT_RUN_SECONDS = 30.0
+# Weight of the latest run in the moving average of run durations.
+_DURATION_SMOOTHING = 0.2
+
+REJECT_USER_LIMIT = "user_limit"
+REJECT_QUEUE_FULL = "queue_full"
+REJECT_OVERLOADED = "overloaded"
+
+
+class AdmissionRejected(RuntimeError):
+    """
+    A generation refused before it was queued: `status` is 429 when the user already has
+    `max_per_user` runs in flight, 503 when the service is saturated. `retry_after` is in seconds.
+    """
+
+    def __init__(self, message: str, status: int, reason: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Gate in front of generation runs: at most `max_running` run at once and `max_queued` wait
+    for a slot, with at most `max_per_user` of them (queued or running) per owner. Requests over
+    a cap, or whose estimated queue time exceeds `max_wait`, are refused at once with a
+    Retry-After derived from a moving average of run durations, so a spike is shed instead of
+    piling up until every request times out. `max_per_user` or `max_wait` of 0 disables that check.
+    """
+
+    def __init__(
+        self,
+        max_running: int,
+        max_queued: int,
+        max_per_user: int = 0,
+        max_wait: float = 0.0,
+    ) -> None:
+        self.max_running = max(1, max_running)
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        # ticket -> (owner, queued at); insertion order is the queue order.
+        self._queued: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._running: Dict[str, Tuple[str, float]] = {}
+        self._per_owner: Counter = Counter()
+        self._run_seconds = DEFAULT_RUN_SECONDS
+        self._admitted = 0
+        self._rejected: Counter = Counter()
+
+    def admit(self, ticket: str, owner: str) -> float:
+        """Queue `ticket` for `owner`, returning its estimated wait, or raise AdmissionRejected."""
+        with self._lock:
+            if self.max_per_user and self._per_owner[owner] >= self.max_per_user:
+                raise self._reject_locked(
+                    REJECT_USER_LIMIT,
+                    429,
+                    f"{self._per_owner[owner]} generation(s) already in flight for this user",
+                    self._owner_retry_locked(owner),
+                )
+            wait = self._wait_locked(len(self._queued))
+            # Queued tickets include those about to take a free slot.
+            if len(self._running) + len(self._queued) >= self.max_running + self.max_queued:
+                raise self._reject_locked(
+                    REJECT_QUEUE_FULL,
+                    503,
+                    f"{len(self._running)} generation(s) running and {len(self._queued)} queued",
+                    wait,
+                )
+            if self.max_wait and wait > self.max_wait:
+                raise self._reject_locked(
+                    REJECT_OVERLOADED,
+                    503,
+                    f"estimated queue time {wait:.0f}s is above {self.max_wait:.0f}s",
+                    wait - self.max_wait,
+                )
+            self._queued[ticket] = (owner, time.monotonic())
+            self._per_owner[owner] += 1
+            self._admitted += 1
+            return wait
+
+    def start(self, ticket: str) -> None:
+        """Move `ticket` from the queue to the running set."""
+        with self._lock:
+            entry = self._queued.pop(ticket, None)
+            if entry is None:
+                return
+            owner, queued_at = entry
+            now = time.monotonic()
+            self._running[ticket] = (owner, now)
+        GENERATION_QUEUE_SECONDS.observe(now - queued_at)
+
+    def finish(self, ticket: str) -> None:
+        """Release `ticket`'s slot (queued or running) and fold its run time into the estimates."""
+        with self._lock:
+            entry = self._running.pop(ticket, None)
+            if entry is not None:
+                duration = time.monotonic() - entry[1]
+                self._run_seconds += _DURATION_SMOOTHING * (duration - self._run_seconds)
+            else:
+                entry = self._queued.pop(ticket, None)
+            if entry is None:
+                return
+            owner = entry[0]
+            self._per_owner[owner] -= 1
+            if self._per_owner[owner] <= 0:
+                del self._per_owner[owner]
+
+    def estimated_wait(self, ticket: str) -> float:
+        """Seconds until a queued `ticket` should start; 0 once it runs or is unknown."""
+        with self._lock:
+            if ticket not in self._queued:
+                return 0.0
+            position = list(self._queued).index(ticket)
+            return self._wait_locked(position)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "running": len(self._running),
+                "queued": len(self._queued),
+                "max_running": self.max_running,
+                "max_queued": self.max_queued,
+                "run_seconds": round(self._run_seconds, 3),
+                "estimated_wait": round(self._wait_locked(len(self._queued)), 3),
+                "admitted": self._admitted,
+                "rejected": dict(self._rejected),
+            }
+
+    def _wait_locked(self, position: int) -> float:
+        """Estimated wait of the queue entry at `position`: slots free up every run_seconds / max_running."""
+        ahead = position + 1 - (self.max_running - len(self._running))
+        if ahead <= 0:
+            return 0.0
+        return ahead * self._run_seconds / self.max_running
+
+    def _owner_retry_locked(self, owner: str) -> float:
+        """Time until the owner's earliest run should finish."""
+        now = time.monotonic()
+        remaining = [
+            self._run_seconds - (now - started) for other, started in self._running.values() if other == owner
+        ]
+        if remaining:
+            return min(remaining)
+        queued = [index for index, (other, _) in enumerate(self._queued.values()) if other == owner]
+        return self._wait_locked(queued[0]) + self._run_seconds if queued else self._run_seconds
+
+    def _reject_locked(self, reason: str, status: int, message: str, retry_after: float) -> AdmissionRejected:
+        self._rejected[reason] += 1
+        ADMISSION_REJECTIONS.inc(reason=reason)
+        return AdmissionRejected(message, status, reason, max(1, math.ceil(retry_after)))
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from ..config import BudgetSettings
+from .metrics import BUDGET_FINALISATIONS
+
+PHASE_NORMAL = "normal"
+PHASE_FINALISE = "finalise"
+PHASE_SUMMARY = "summary"
+
+# Model steps kept in reserve: one to add the tracks found so far, one to write the summary.
+RESERVED_STEPS = 2
+# Spotify calls kept for the finalisation turn (track insertion chunks, playlist rename).
+RESERVED_SPOTIFY_CALLS = 5
+# Tools still offered during the finalisation turn.
+FINALISE_TOOLS = frozenset({"create_playlist", "name_playlist", "add_tracks"})
+
+FINALISE_PROMPT = (
+    "Budget almost exhausted ({reason}). Stop searching now. If the selected tracks are not in the "
+    "playlist yet, call add_tracks once with the best tracks you already found (create or name the "
+    "playlist first if that has not been done). Then reply with the summary."
+)
+
+_current_budget: ContextVar[Optional["RunBudget"]] = ContextVar("aria_current_budget", default=None)
+
+
+class RunBudget:
+    """
+    Limits of one generation: model steps, cumulative tokens, wall-clock time and Spotify
+    calls. Once the next two steps could cross a limit, the run switches to a finalisation
+    turn (add what was found) followed by a summary-only turn.
+    """
+
+    def __init__(self, settings: BudgetSettings) -> None:
+        self.settings = settings
+        self.started = time.monotonic()
+        self.steps = 0
+        self.tokens = 0
+        self.phase = PHASE_NORMAL
+        self.reason: Optional[str] = None
+        self._spotify_calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def spotify_calls(self) -> int:
+        with self._lock:
+            return self._spotify_calls
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def record_spotify_call(self) -> None:
+        with self._lock:
+            self._spotify_calls += 1
+
+    def record_response(self, response: Any) -> None:
+        usage = getattr(response, "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if total is None and usage is not None:
+            total = (getattr(usage, "input_tokens", 0) or 0) + (getattr(usage, "output_tokens", 0) or 0)
+        self.tokens += total or 0
+
+    def begin_step(self) -> str:
+        """Count a new model step and return the phase it runs in."""
+        if self.phase == PHASE_NORMAL:
+            self.reason = self._limit_reached()
+            if self.reason is not None:
+                self.phase = PHASE_FINALISE
+                BUDGET_FINALISATIONS.inc(reason=self.reason)
+        elif self.phase == PHASE_FINALISE:
+            self.phase = PHASE_SUMMARY
+        self.steps += 1
+        return self.phase
+
+    def snapshot(self) -> Dict[str, Any]:
+        settings = self.settings
+        return {
+            "steps": self.steps,
+            "tokens": self.tokens,
+            "spotify_calls": self.spotify_calls,
+            "elapsed_seconds": round(self.elapsed(), 3),
+            "limits": {
+                "steps": settings.max_steps,
+                "tokens": settings.max_tokens,
+                "spotify_calls": settings.max_spotify_calls,
+                "seconds": settings.deadline,
+            },
+            "finalised_early": self.reason,
+        }
+
+    def _limit_reached(self) -> Optional[str]:
+        """Name of the first limit the two reserved steps could cross, if any."""
+        settings = self.settings
+        if not self.steps:
+            return None
+        if self.steps + RESERVED_STEPS >= settings.max_steps:
+            return "steps"
+        per_step_tokens = self.tokens / self.steps
+        if self.tokens + RESERVED_STEPS * per_step_tokens >= settings.max_tokens:
+            return "tokens"
+        per_step_seconds = self.elapsed() / self.steps
+        if self.elapsed() + RESERVED_STEPS * per_step_seconds >= settings.deadline:
+            return "deadline"
+        if self.spotify_calls + RESERVED_SPOTIFY_CALLS >= settings.max_spotify_calls:
+            return "spotify_calls"
+        return None
+
+
+def budget_step(
+    budget: Optional[RunBudget],
+    tools: List[Dict[str, Any]],
+    input_list: List[Any],
+    new_input: List[Any],
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Start a step under `budget`: returns the tools to offer and extra request fields. Entering
+    the finalisation turn appends the instruction to the conversation (and the chained input).
+    """
+    if budget is None:
+        return tools, {}
+    phase = budget.begin_step()
+    if phase == PHASE_NORMAL:
+        return tools, {}
+    if phase == PHASE_FINALISE:
+        message = {"role": "system", "content": FINALISE_PROMPT.format(reason=budget.reason)}
+        input_list.append(message)
+        new_input.append(message)
+        return [tool for tool in tools if tool["name"] in FINALISE_TOOLS], {}
+    return [tool for tool in tools if tool["name"] in FINALISE_TOOLS], {"tool_choice": "none"}
+
+
+def with_budget_state(payload: Dict[str, Any], budget: Optional[RunBudget]) -> Dict[str, Any]:
+    """Attach the budget usage to a generation result."""
+    if budget is not None:
+        payload["budget"] = budget.snapshot()
+    return payload
+
+
+def summary_only(budget: Optional[RunBudget]) -> bool:
+    return budget is not None and budget.phase == PHASE_SUMMARY
+
+
+@contextmanager
+def budget_scope(budget: Optional[RunBudget]) -> Iterator[Optional[RunBudget]]:
+    """Make `budget` the current one, so Spotify requests made for the run are counted."""
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        try:
+            _current_budget.reset(token)
+        except ValueError:
+            pass
+
+
+def current_budget() -> Optional[RunBudget]:
+    return _current_budget.get()
@@ -0,0 +1,634 @@
+from __future__ import annotations
+
+import gzip
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+import httpx
+import openai
+from openai.types.responses import Response, ResponseStreamEvent
+from pydantic import TypeAdapter
+from spotipy.exceptions import SpotifyException
+
+from ..config import BudgetSettings, CassetteSettings
+from .catalog import UnsupportedQuery
+from .search_cache import BaseSearchCache
+from .spotify import SpotifyClient, endpoint_label, spotify_request_span
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+CASSETTE_SUFFIX = ".json.gz"
+# Agent options stored with a recording so the replay runs the same code paths.
+RECORDED_OPTIONS = (
+    "model_name",
+    "fast_model_name",
+    "tool_concurrency",
+    "stream_responses",
+    "chain_responses",
+    "compact_results",
+    "speculative_playlist",
+    "catalog_first",
+    "user_id",
+)
+# Streamed events the agent acts on; the others are not kept.
+RECORDED_STREAM_EVENTS = frozenset(
+    {
+        "response.output_item.done",
+        "response.output_text.delta",
+        "response.completed",
+        "response.incomplete",
+        "response.failed",
+        "error",
+    }
+)
+
+_STREAM_EVENT = TypeAdapter(ResponseStreamEvent)
+_OPENAI_ERRORS = {
+    400: openai.BadRequestError,
+    401: openai.AuthenticationError,
+    404: openai.NotFoundError,
+    429: openai.RateLimitError,
+}
+
+T = TypeVar("T")
+
+
+class CassetteMiss(RuntimeError):
+    """The replayed run made a call the cassette holds no answer for."""
+
+
+def spotify_call_key(method: str, url: str, payload: Any, params: Dict[str, Any]) -> str:
+    """Identity of a Spotify call: method, path relative to /v1/, non-empty params and payload."""
+    path = url.split("/v1/", 1)[1] if "/v1/" in url else url
+    params = {key: value for key, value in params.items() if value is not None}
+    return json.dumps([method, path, params, payload], sort_keys=True, default=str)
+
+
+def recorded_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON-safe subset of `run_agent_for_user` options needed to replay a run."""
+    recorded = {name: options[name] for name in RECORDED_OPTIONS if name in options}
+    recorded["catalog"] = options.get("catalog") is not None
+    budget = options.get("budget")
+    if budget is not None:
+        recorded["budget"] = asdict(budget)
+    return recorded
+
+
+def _dump(value: Any) -> Any:
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_unset=True)
+    return value
+
+
+def _request_body(request: Dict[str, Any]) -> str:
+    """The request as the SDK sends it; response output items are pydantic models."""
+    return json.dumps(request, default=_dump)
+
+
+def start_recording(settings: CassetteSettings, prompt: str, options: Dict[str, Any]) -> Optional["CassetteRecorder"]:
+    """A recorder for this run, or None when recording is off or the run is not sampled."""
+    if not settings.directory or random.random() >= settings.sample_rate:
+        return None
+    return CassetteRecorder(prompt, options)
+
+
+def record_generation(
+    settings: CassetteSettings,
+    prompt: str,
+    sp: Any,
+    options: Dict[str, Any],
+    on_event: Optional[Callable[[str, Dict[str, Any]], None]],
+    run: Callable[[Any, Dict[str, Any], Any], Dict[str, Any]],
+) -> Dict[str, Any]:
+    """Call `run(sp, options, on_event)`, recording it to a cassette when sampled."""
+    recorder = start_recording(settings, prompt, options)
+    if recorder is None:
+        return run(sp, options, on_event)
+    sp, options, on_event = recorder.wrap(sp, options, on_event)
+    try:
+        result = run(sp, options, on_event)
+    except Exception as exc:
+        recorder.save(settings.directory, error=exc)
+        raise
+    finally:
+        if isinstance(sp, SpotifyClient):
+            sp.recorder = None
+    recorder.save(settings.directory, result=result)
+    return result
+
+
+class CassetteRecorder:
+    """
+    Captures one generation for offline replay: every Responses API call (the full response,
+    or the streamed events with their offsets), every Spotify HTTP call, search cache hits,
+    local catalog lookups and the agent events, each with its latency. Tokens and headers of
+    successful calls are not kept.
+    """
+
+    def __init__(self, prompt: str, options: Dict[str, Any]) -> None:
+        self.id = uuid.uuid4().hex
+        self.prompt = prompt
+        self.options = recorded_options(options)
+        self.recorded_at = time.time()
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.model_calls: List[Dict[str, Any]] = []
+        self.spotify_calls: List[Dict[str, Any]] = []
+        self.search_cache_hits: Dict[str, Dict[str, Any]] = {}
+        self.catalog_searches: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = []
+
+    def offset(self) -> float:
+        return round(time.perf_counter() - self._started, 6)
+
+    def wrap(self, sp: Any, options: Dict[str, Any], on_event: Any) -> Tuple[Any, Dict[str, Any], Any]:
+        """Route the run's clients and services through the recorder."""
+        if isinstance(sp, SpotifyClient):
+            sp.recorder = self
+        options = dict(options)
+        options["openai_client"] = RecordingOpenAI(options["openai_client"], self)
+        if options.get("search_cache") is not None:
+            options["search_cache"] = RecordingSearchCache(options["search_cache"], self)
+        if options.get("catalog") is not None:
+            options["catalog"] = RecordingCatalog(options["catalog"], self)
+
+        def record_event(event_type: str, data: Dict[str, Any]) -> None:
+            entry = {"at": self.offset(), "type": event_type}
+            if event_type == "tool_requested":
+                entry.update(step=data.get("step"), name=data.get("name"), arguments=data.get("arguments"))
+            elif event_type == "step_started":
+                entry["step"] = data.get("step")
+            self._append(self.events, entry)
+            if on_event is not None:
+                on_event(event_type, data)
+
+        return sp, options, record_event
+
+    def record_spotify(self, method: str, url: str, payload: Any, params: Dict[str, Any], call: Callable[[], T]) -> T:
+        entry: Dict[str, Any] = {
+            "at": self.offset(),
+            "key": spotify_call_key(method, url, payload, params),
+            "endpoint": endpoint_label(url),
+        }
+        started = time.perf_counter()
+        try:
+            result = call()
+        except SpotifyException as exc:
+            entry["error"] = {
+                "status": exc.http_status,
+                "code": exc.code,
+                "msg": exc.msg,
+                "reason": exc.reason,
+                "headers": dict(exc.headers or {}),
+            }
+            raise
+        else:
+            entry["body"] = json.dumps(result)
+        finally:
+            entry["seconds"] = round(time.perf_counter() - started, 6)
+            self._append(self.spotify_calls, entry)
+        return result
+
+    def record_cache_hit(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self.search_cache_hits[key] = value
+
+    def record_catalog_search(self, query: str, limit: int, tracks: Optional[List[Dict[str, Any]]], error: str = "") -> None:
+        entry: Dict[str, Any] = {"query": query, "limit": limit}
+        if tracks is None:
+            entry["unsupported"] = error
+        else:
+            entry["tracks"] = tracks
+        self._append(self.catalog_searches, entry)
+
+    def save(self, directory: str, result: Any = None, error: Optional[BaseException] = None) -> Optional[str]:
+        """Write the cassette (gzipped JSON) and return its path; recording never fails the run."""
+        if not self.model_calls:
+            # Served from the prompt cache: nothing to replay.
+            return None
+        cassette = {
+            "version": CASSETTE_VERSION,
+            "id": self.id,
+            "recorded_at": self.recorded_at,
+            "duration": self.offset(),
+            "prompt": self.prompt,
+            "options": self.options,
+            "outcome": "failed" if error is not None else "succeeded",
+            "error": repr(error) if error is not None else None,
+            "result": result,
+            "model_calls": self.model_calls,
+            "spotify_calls": self.spotify_calls,
+            "search_cache_hits": self.search_cache_hits,
+            "catalog_searches": self.catalog_searches,
+            "events": self.events,
+        }
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(self.recorded_at))
+        path = Path(directory) / f"{stamp}-{self.id[:8]}{CASSETTE_SUFFIX}"
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + ".tmp")
+            with gzip.open(tmp, "wt", encoding="utf-8") as fh:
+                json.dump(cassette, fh, separators=(",", ":"), default=_dump)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError):
+            logger.exception("Could not write cassette %s", path)
+            return None
+        logger.info("Recorded cassette %s", path)
+        return str(path)
+
+    def _append(self, entries: List[Dict[str, Any]], entry: Dict[str, Any]) -> None:
+        with self._lock:
+            entries.append(entry)
+
+
+class RecordingOpenAI:
+    """OpenAI client proxy recording `responses.create` calls."""
+
+    def __init__(self, client: Any, recorder: CassetteRecorder) -> None:
+        self._client = client
+        self.responses = _RecordingResponses(client.responses, recorder)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+class _RecordingResponses:
+    def __init__(self, responses: Any, recorder: CassetteRecorder) -> None:
+        self._responses = responses
+        self._recorder = recorder
+
+    def create(self, **request: Any) -> Any:
+        entry: Dict[str, Any] = {
+            "at": self._recorder.offset(),
+            "request": {
+                "model": request.get("model"),
+                "stream": bool(request.get("stream")),
+                "chained": bool(request.get("previous_response_id")),
+                "tools": [tool.get("name") for tool in request.get("tools") or ()],
+                "input_items": len(request.get("input") or ()),
+            },
+        }
+        started = time.perf_counter()
+        try:
+            result = self._responses.create(**request)
+        except openai.APIStatusError as exc:
+            entry["error"] = {"status": exc.status_code, "message": exc.message}
+            entry["seconds"] = round(time.perf_counter() - started, 6)
+            self._recorder._append(self._recorder.model_calls, entry)
+            raise
+        if not request.get("stream"):
+            entry["seconds"] = round(time.perf_counter() - started, 6)
+            entry["response"] = _dump(result)
+            self._recorder._append(self._recorder.model_calls, entry)
+            return result
+        # Appended on creation so the call order is kept while the stream is read.
+        entry["events"] = []
+        self._recorder._append(self._recorder.model_calls, entry)
+        return self._record_stream(result, entry, started)
+
+    @staticmethod
+    def _record_stream(stream: Any, entry: Dict[str, Any], started: float) -> Iterator[Any]:
+        try:
+            for event in stream:
+                if getattr(event, "type", "") in RECORDED_STREAM_EVENTS:
+                    entry["events"].append([round(time.perf_counter() - started, 6), _dump(event)])
+                yield event
+        finally:
+            entry["seconds"] = round(time.perf_counter() - started, 6)
+
+
+class RecordingSearchCache(BaseSearchCache):
+    """Search cache proxy recording hits: the replay has to serve the same queries from cache."""
+
+    def __init__(self, cache: BaseSearchCache, recorder: CassetteRecorder) -> None:
+        super().__init__()
+        self._cache = cache
+        self._recorder = recorder
+        self.backend = cache.backend
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._cache.get(key)
+        if value is not None:
+            self._recorder.record_cache_hit(key, value)
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        self._cache.set(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._cache.stats()
+
+
+class RecordingCatalog:
+    """Track catalog proxy recording local searches."""
+
+    def __init__(self, catalog: Any, recorder: CassetteRecorder) -> None:
+        self._catalog = catalog
+        self._recorder = recorder
+
+    def search(self, query: str, limit: int) -> List[Dict[str, Any]]:
+        try:
+            tracks = self._catalog.search(query, limit)
+        except UnsupportedQuery as exc:
+            self._recorder.record_catalog_search(query, limit, None, str(exc))
+            raise
+        self._recorder.record_catalog_search(query, limit, tracks)
+        return tracks
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._catalog, name)
+
+
+def load_cassette(path: str) -> Dict[str, Any]:
+    with gzip.open(path, "rt", encoding="utf-8") as fh:
+        cassette = json.load(fh)
+    if cassette.get("version") != CASSETTE_VERSION:
+        raise ValueError(f"{path}: unsupported cassette version {cassette.get('version')!r}")
+    return cassette
+
+
+def replay_options(cassette: Dict[str, Any]) -> Dict[str, Any]:
+    """`run_agent_for_user` options of a recorded run, minus the clients the player provides."""
+    options = {key: value for key, value in cassette["options"].items() if key not in ("budget", "catalog")}
+    budget = cassette["options"].get("budget")
+    if budget is not None:
+        known = {item.name for item in fields(BudgetSettings)}
+        options["budget"] = BudgetSettings(**{key: value for key, value in budget.items() if key in known})
+    return options
+
+
+@dataclass
+class StepProfile:
+    """Where one agent step spent its time during a replay."""
+
+    step: int
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    serialise_seconds: float = 0.0
+    model_wait_seconds: float = 0.0
+    spotify_wait_seconds: float = 0.0
+    model_calls: int = 0
+    spotify_calls: int = 0
+    tool_calls: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: round(value, 6) if isinstance(value, float) else value for key, value in asdict(self).items()}
+
+
+class ReplayProfiler:
+    """
+    Splits a replay into agent steps (on `step_started` events). Wall and process CPU time are
+    taken between steps; serialisation and simulated waits are added by the replay clients.
+    Work done before the first step (speculative playlist creation) is counted as step 0.
+    """
+
+    def __init__(self) -> None:
+        self.steps: List[StepProfile] = []
+        self._lock = threading.Lock()
+        self._current = StepProfile(step=0)
+        self._marks = (time.perf_counter(), time.process_time())
+
+    def on_event(self, event_type: str, data: Dict[str, Any]) -> None:
+        if event_type == "step_started":
+            with self._lock:
+                self._close_locked()
+                self._current = StepProfile(step=int(data.get("step") or len(self.steps)))
+        elif event_type == "tool_requested":
+            self.add("tool_calls", 1)
+
+    def add(self, name: str, amount: float) -> None:
+        with self._lock:
+            setattr(self._current, name, getattr(self._current, name) + amount)
+
+    def finish(self) -> List[StepProfile]:
+        with self._lock:
+            self._close_locked()
+        return self.steps
+
+    def _close_locked(self) -> None:
+        wall, cpu = time.perf_counter(), time.process_time()
+        step = self._current
+        step.wall_seconds += wall - self._marks[0]
+        step.cpu_seconds += cpu - self._marks[1]
+        self._marks = (wall, cpu)
+        if step.step or step.spotify_calls or step.model_calls:
+            self.steps.append(step)
+
+
+class CassettePlayer:
+    """
+    Serves a cassette's recorded answers in recording order: model calls one after the other,
+    Spotify calls per request key. Latencies are slept for `time_scale` times their recorded
+    duration (0 replays at full speed).
+    """
+
+    def __init__(self, cassette: Dict[str, Any], time_scale: float = 1.0) -> None:
+        self.cassette = cassette
+        self.time_scale = max(0.0, time_scale)
+        self.profiler = ReplayProfiler()
+        self.misses: List[str] = []
+        self.mismatches: List[str] = []
+        self._lock = threading.Lock()
+        self._model_calls: Deque[Dict[str, Any]] = deque(cassette["model_calls"])
+        self._spotify_calls: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        for entry in cassette["spotify_calls"]:
+            self._spotify_calls[entry["key"]].append(entry)
+        self._catalog: Dict[Tuple[str, int], Deque[Dict[str, Any]]] = defaultdict(deque)
+        for entry in cassette.get("catalog_searches", ()):
+            self._catalog[(entry["query"], entry["limit"])].append(entry)
+
+    def next_model_call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            if not self._model_calls:
+                self.misses.append(f"responses.create(model={request.get('model')})")
+                raise CassetteMiss("the run made more model calls than were recorded")
+            entry = self._model_calls.popleft()
+        recorded = entry["request"]["model"]
+        if recorded != request.get("model"):
+            self.mismatches.append(f"model call {entry['at']:.3f}s: recorded {recorded}, replayed {request.get('model')}")
+        self.profiler.add("model_calls", 1)
+        return entry
+
+    def next_spotify_call(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            queue = self._spotify_calls.get(key)
+            if not queue:
+                self.misses.append(key)
+                return None
+            entry = queue.popleft()
+            # A throttled attempt the rate limiter retried: replay as one slower call.
+            waited = 0.0
+            while queue and entry.get("error", {}).get("status") == 429:
+                waited += entry["seconds"]
+                entry = queue.popleft()
+        self.profiler.add("spotify_calls", 1)
+        return dict(entry, seconds=entry["seconds"] + waited) if waited else entry
+
+    def next_catalog_search(self, query: str, limit: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            queue = self._catalog.get((query, limit))
+            if not queue:
+                self.misses.append(f"catalog.search({query!r}, {limit})")
+                return None
+            return queue.popleft()
+
+    def wait(self, seconds: float, name: str) -> None:
+        delay = max(0.0, seconds) * self.time_scale
+        if delay <= 0:
+            return
+        started = time.perf_counter()
+        time.sleep(delay)
+        self.profiler.add(name, time.perf_counter() - started)
+
+    def serialise(self, work: Callable[[], T]) -> T:
+        """Run an encoding or decoding step, charging its time to serialisation."""
+        started = time.perf_counter()
+        try:
+            return work()
+        finally:
+            self.profiler.add("serialise_seconds", time.perf_counter() - started)
+
+    def unused(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "model_calls": len(self._model_calls),
+                "spotify_calls": sum(len(queue) for queue in self._spotify_calls.values()),
+            }
+
+
+class ReplayOpenAI:
+    """Stand-in OpenAI client answering `responses.create` from a cassette."""
+
+    def __init__(self, player: CassettePlayer) -> None:
+        self.responses = _ReplayResponses(player)
+
+
+class _ReplayResponses:
+    def __init__(self, player: CassettePlayer) -> None:
+        self._player = player
+
+    def create(self, **request: Any) -> Any:
+        player = self._player
+        entry = player.next_model_call(request)
+        player.serialise(lambda: _request_body(request))
+        if "error" in entry:
+            player.wait(entry["seconds"], "model_wait_seconds")
+            raise _openai_error(entry["error"])
+        if request.get("stream") and "events" in entry:
+            return self._stream(entry)
+        player.wait(entry["seconds"], "model_wait_seconds")
+        data = entry.get("response") or _final_response(entry)
+        return player.serialise(lambda: Response.model_validate(data))
+
+    def _stream(self, entry: Dict[str, Any]) -> Iterator[Any]:
+        player = self._player
+        elapsed = 0.0
+        for offset, data in entry["events"]:
+            player.wait(offset - elapsed, "model_wait_seconds")
+            elapsed = max(elapsed, offset)
+            yield player.serialise(lambda: _STREAM_EVENT.validate_python(data))
+        player.wait(entry["seconds"] - elapsed, "model_wait_seconds")
+
+
+def _final_response(entry: Dict[str, Any]) -> Dict[str, Any]:
+    for _, event in reversed(entry.get("events", ())):
+        if event.get("response") is not None:
+            return event["response"]
+    raise CassetteMiss("recorded stream holds no final response")
+
+
+def _openai_error(error: Dict[str, Any]) -> openai.APIStatusError:
+    status = int(error.get("status") or 500)
+    response = httpx.Response(status, request=httpx.Request("POST", "https://api.openai.com/v1/responses"))
+    cls = _OPENAI_ERRORS.get(status, openai.InternalServerError if status >= 500 else openai.APIStatusError)
+    return cls(error.get("message") or "", response=response, body=None)
+
+
+class ReplaySpotifyClient(SpotifyClient):
+    """
+    SpotifyClient whose HTTP layer is the cassette. Spans and budget accounting are those of a
+    live call; the recorded body is decoded like spotipy decodes a response.
+    """
+
+    def __init__(self, player: CassettePlayer) -> None:
+        super().__init__(auth="cassette")
+        self._player = player
+
+    def _traced_call(self, method, url, payload, params):
+        with spotify_request_span(method, endpoint_label(url)) as span:
+            entry = self._player.next_spotify_call(spotify_call_key(method, url, payload, params))
+            if entry is None:
+                span.set(status="404")
+                raise SpotifyException(404, -1, f"{method} {url}: not in cassette")
+            self._player.wait(entry["seconds"], "spotify_wait_seconds")
+            error = entry.get("error")
+            if error is not None:
+                span.set(status=str(error["status"]))
+                raise SpotifyException(
+                    error["status"], error["code"], error["msg"], reason=error.get("reason"), headers=error.get("headers")
+                )
+            span.set(status="200")
+            return self._player.serialise(lambda: json.loads(entry["body"]))
+
+
+class ReplaySearchCache(BaseSearchCache):
+    """Search cache serving the hits of the recorded run and nothing else."""
+
+    backend = "cassette"
+
+    def __init__(self, hits: Dict[str, Dict[str, Any]]) -> None:
+        super().__init__()
+        self._hits = hits
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._hits.get(key)
+        self._record(value is not None)
+        return json.loads(json.dumps(value)) if value is not None else None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        pass
+
+
+class ReplayCatalog:
+    """Track catalog answering local searches from the cassette."""
+
+    def __init__(self, player: CassettePlayer) -> None:
+        self._player = player
+
+    def search(self, query: str, limit: int) -> List[Dict[str, Any]]:
+        entry = self._player.next_catalog_search(query, limit)
+        if entry is None:
+            raise UnsupportedQuery("not in cassette")
+        if "unsupported" in entry:
+            raise UnsupportedQuery(entry["unsupported"])
+        return entry["tracks"]
+
+    def index_search_results(self, results: Dict[str, Any]) -> None:
+        pass
+
+
+def replay_clients(player: CassettePlayer) -> Dict[str, Any]:
+    """`run_agent_for_user` arguments wiring a run to `player`."""
+    cassette = player.cassette
+    clients: Dict[str, Any] = {
+        "user_prompt": cassette["prompt"],
+        "sp": ReplaySpotifyClient(player),
+        "openai_client": ReplayOpenAI(player),
+        "on_event": player.profiler.on_event,
+        "use_prompt_cache": False,
+    }
+    if cassette.get("search_cache_hits"):
+        clients["search_cache"] = ReplaySearchCache(cassette["search_cache_hits"])
+    if cassette["options"].get("catalog"):
+        clients["catalog"] = ReplayCatalog(player)
+    return clients
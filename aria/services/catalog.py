@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Spotify field filters the local index can answer, mapped to FTS columns.
+_FIELD_COLUMNS = {
+    "artist": "artists",
+    "track": "name",
+    "album": "album",
+    "genre": "genres",
+}
+_FILTER_RE = re.compile(r'(\w+):(?:"([^"]*)"|(\S+))')
+# Search payloads waiting for the background writer; further ones are dropped.
+MAX_PENDING = 256
+# Payloads written per transaction.
+WRITE_BATCH = 32
+
+
+class UnsupportedQuery(ValueError):
+    """Raised when a query uses Spotify filters the local catalog cannot evaluate (year, tag, isrc...)."""
+
+
+def build_fts_query(query: str) -> str:
+    """Translate a Spotify-style search string into an FTS5 MATCH expression."""
+    clauses: List[str] = []
+
+    def replace_filter(match: re.Match) -> str:
+        field = match.group(1).lower()
+        value = match.group(2) if match.group(2) is not None else match.group(3)
+        column = _FIELD_COLUMNS.get(field)
+        if column is None:
+            raise UnsupportedQuery(f"filter '{field}:' is not indexed locally")
+        if value.strip():
+            clauses.append(f"{column} : {_phrase(value)}")
+        return " "
+
+    remainder = _FILTER_RE.sub(replace_filter, query)
+    for term in remainder.split():
+        term = term.strip('"')
+        if term:
+            clauses.append(_phrase(term))
+
+    if not clauses:
+        raise UnsupportedQuery("empty query")
+    return " AND ".join(clauses)
+
+
+def _phrase(text: str) -> str:
+    return '"' + " ".join(text.split()).replace('"', '""') + '"'
+
+
+class TrackCatalog:
+    """
+    On-disk catalog of every track seen in Spotify search results, indexed with SQLite FTS5
+    over title, artists, album and the genres of the track's artists. Search results are
+    indexed by a background writer, so searches never wait for the index.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._local = threading.local()
+        self._pending: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=MAX_PENDING)
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        self._dropped = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                uri TEXT PRIMARY KEY,
+                id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                artists TEXT NOT NULL,
+                artist_list TEXT NOT NULL,
+                album TEXT NOT NULL,
+                seen_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS artists (
+                name_key TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                genres TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS track_artists (
+                name_key TEXT NOT NULL,
+                track_rowid INTEGER NOT NULL,
+                PRIMARY KEY (name_key, track_rowid)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS track_artists_track ON track_artists (track_rowid);
+            CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+                name,
+                artists,
+                album,
+                genres,
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+            """
+        )
+        conn.commit()
+
+    def index_search_results(self, results: Dict[str, Any]) -> None:
+        """Queue the artists and tracks of a raw Spotify /search payload for indexing."""
+        if not _items(results, "artists") and not _items(results, "tracks"):
+            return
+        self._ensure_writer()
+        try:
+            self._pending.put_nowait(results)
+        except queue.Full:
+            self._dropped += 1
+            logger.debug("Catalog indexing queue full, dropping a search payload")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until queued payloads are indexed; False when `timeout` ran out first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._pending.all_tasks_done:
+            while self._pending.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._pending.all_tasks_done.wait(remaining)
+        return True
+
+    def search(self, query: str, limit: int) -> List[Dict[str, Any]]:
+        """Return up to `limit` tracks matching `query`; raises UnsupportedQuery when it cannot answer."""
+        match = build_fts_query(query)
+        rows = self._conn().execute(
+            "SELECT t.id, t.uri, t.name, t.artists, t.album, f.genres"
+            " FROM tracks_fts f JOIN tracks t ON t.rowid = f.rowid"
+            " WHERE tracks_fts MATCH ?"
+            " ORDER BY bm25(tracks_fts) LIMIT ?",
+            (match, max(1, int(limit))),
+        ).fetchall()
+        return [
+            {"id": row[0], "uri": row[1], "name": row[2], "artists": row[3], "album": row[4], "genres": row[5]}
+            for row in rows
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._conn()
+        return {
+            "tracks": conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0],
+            "artists": conn.execute("SELECT COUNT(*) FROM artists").fetchone()[0],
+            "pending": self._pending.qsize(),
+            "dropped": self._dropped,
+        }
+
+    def _ensure_writer(self) -> None:
+        # Started lazily, so a catalog created before a fork gets its writer in the child.
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="aria-catalog-indexer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._index(batch)
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _index(self, batch: List[Dict[str, Any]]) -> None:
+        """Store a batch of search payloads in one transaction."""
+        now = time.time()
+        conn = self._conn()
+        try:
+            stale: Set[int] = set()
+            for results in batch:
+                touched_artists = []
+                for artist in _items(results, "artists"):
+                    genres = artist.get("genres") or []
+                    if not genres:
+                        continue
+                    name_key = artist["name"].casefold()
+                    conn.execute(
+                        "INSERT OR REPLACE INTO artists (name_key, name, genres) VALUES (?, ?, ?)",
+                        (name_key, artist["name"], json.dumps(genres)),
+                    )
+                    touched_artists.append(name_key)
+
+                for track in _items(results, "tracks"):
+                    stale.add(self._store_track(conn, track, now))
+
+                # Genres learned from artist results also apply to tracks indexed earlier.
+                for name_key in touched_artists:
+                    rows = conn.execute("SELECT track_rowid FROM track_artists WHERE name_key = ?", (name_key,))
+                    stale.update(rowid for (rowid,) in rows)
+
+            for rowid in stale:
+                self._reindex(conn, rowid)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logger.exception("Failed to index search results in the local catalog")
+
+    def _store_track(self, conn: sqlite3.Connection, track: Dict[str, Any], now: float) -> int:
+        names = [a["name"] for a in track.get("artists", []) if a.get("name")]
+        # An upsert keeps the track's rowid, which keys its FTS row and artist links.
+        conn.execute(
+            "INSERT INTO tracks (uri, id, name, artists, artist_list, album, seen_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (uri) DO UPDATE SET id = excluded.id, name = excluded.name,"
+            " artists = excluded.artists, artist_list = excluded.artist_list,"
+            " album = excluded.album, seen_at = excluded.seen_at",
+            (
+                track["uri"],
+                track["id"],
+                track["name"],
+                ", ".join(names),
+                json.dumps(names),
+                (track.get("album") or {}).get("name", ""),
+                now,
+            ),
+        )
+        (rowid,) = conn.execute("SELECT rowid FROM tracks WHERE uri = ?", (track["uri"],)).fetchone()
+        self._link_artists(conn, rowid, names)
+        return rowid
+
+    def _link_artists(self, conn: sqlite3.Connection, rowid: int, names: List[str]) -> None:
+        conn.execute("DELETE FROM track_artists WHERE track_rowid = ?", (rowid,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO track_artists (name_key, track_rowid) VALUES (?, ?)",
+            [(name.casefold(), rowid) for name in names],
+        )
+
+    def _reindex(self, conn: sqlite3.Connection, rowid: int) -> None:
+        row = conn.execute("SELECT name, artists, artist_list, album FROM tracks WHERE rowid = ?", (rowid,)).fetchone()
+        if row is None:
+            return
+        name, artists, artist_list, album = row
+        genres: List[str] = []
+        for artist_name in json.loads(artist_list):
+            found = conn.execute("SELECT genres FROM artists WHERE name_key = ?", (artist_name.casefold(),)).fetchone()
+            if found:
+                genres.extend(g for g in json.loads(found[0]) if g not in genres)
+        conn.execute("DELETE FROM tracks_fts WHERE rowid = ?", (rowid,))
+        conn.execute(
+            "INSERT INTO tracks_fts (rowid, name, artists, album, genres) VALUES (?, ?, ?, ?, ?)",
+            (rowid, name, artists, album, ", ".join(genres)),
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+def _items(results: Dict[str, Any], kind: str) -> List[Dict[str, Any]]:
+    section = results.get(kind) or {}
+    return [item for item in section.get("items") or [] if item]
+
+
+def create_track_catalog(path: Optional[str]) -> Optional[TrackCatalog]:
+    if not path:
+        return None
+    try:
+        return TrackCatalog(path)
+    except sqlite3.Error:
+        logger.exception("Local track catalog unavailable at %s", path)
+        return None
@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from ..config import HedgeSettings
+from .metrics import SPOTIFY_HEDGES
+from .rate_limit import RateLimiter
+
+T = TypeVar("T")
+
+# Latencies kept per endpoint for the hedge delay percentile.
+LATENCY_WINDOW = 512
+# Samples needed before an endpoint is hedged at all.
+MIN_SAMPLES = 20
+# Hedge credits that may accumulate, so a quiet period does not allow a burst of hedges.
+MAX_CREDITS = 3.0
+# Share of each rate-limit bucket a hedge must leave untouched: hedges only use spare capacity.
+RATE_HEADROOM = 0.5
+# Threads running hedged calls; when all are busy, calls run unhedged in the caller's thread.
+MAX_WORKERS = 32
+
+HEDGE_WON = "won"
+HEDGE_LOST = "lost"
+HEDGE_CAPPED = "capped"
+
+_hedger_lock = threading.Lock()
+_shared_hedger: Optional["RequestHedger"] = None
+
+
+class RequestHedger:
+    """
+    Hedged reads: an idempotent request still unanswered after the `percentile` latency of its
+    endpoint (never less than `min_delay`) is sent a second time, and the first answer wins.
+    Hedges are capped at `max_rate` of hedgeable calls and only go out while the rate limiter
+    buckets are at least half full, so they never wait for, or crowd out, first attempts.
+    Clients call in once the rate limiter granted the first attempt, so only request time is
+    measured. A losing thread-pool attempt runs to completion in the background (its result
+    is dropped); a losing asyncio attempt is cancelled.
+    """
+
+    def __init__(self, settings: HedgeSettings, rate_limiter: Optional[RateLimiter] = None) -> None:
+        self.settings = settings
+        self.rate_limiter = rate_limiter
+        self._endpoints = frozenset(settings.endpoints)
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._credits = 0.0
+        self._outcomes: Dict[str, int] = {HEDGE_WON: 0, HEDGE_LOST: 0, HEDGE_CAPPED: 0}
+        self._slots = threading.BoundedSemaphore(MAX_WORKERS)
+        self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="spotify-hedge")
+
+    def hedges(self, method: str, endpoint: str) -> bool:
+        return method == "GET" and endpoint in self._endpoints
+
+    def delay(self, endpoint: str) -> Optional[float]:
+        """Time after which a call to `endpoint` is hedged; None until enough calls were measured."""
+        with self._lock:
+            samples = self._latencies.get(endpoint)
+            if samples is None or len(samples) < MIN_SAMPLES:
+                return None
+            ordered = sorted(samples)
+        rank = min(len(ordered) - 1, int(len(ordered) * self.settings.percentile / 100))
+        return max(self.settings.min_delay, ordered[rank])
+
+    def call(
+        self,
+        endpoint: str,
+        primary: Callable[[], T],
+        hedge: Callable[[], T],
+        user_key: Optional[str] = None,
+    ) -> T:
+        """
+        Run `primary`, then `hedge` as well if `primary` is slower than the endpoint's hedge
+        delay; returns the first successful result. Neither goes through the rate limiter:
+        the caller holds the first attempt's token, the hedge's is taken here.
+        """
+        self._earn_credit()
+        delay = self.delay(endpoint)
+        if delay is None or not self._slots.acquire(blocking=False):
+            return self._timed(endpoint, primary)
+        first = self._submit(endpoint, primary)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeout:
+            pass
+        if not self._slots.acquire(blocking=False):
+            return first.result()
+        if not self._admit_hedge(endpoint, user_key):
+            self._slots.release()
+            return first.result()
+        second = self._submit(endpoint, hedge)
+
+        pending = {first, second}
+        errors: Dict[bool, BaseException] = {}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # The first attempt wins ties.
+            for future in sorted(done, key=lambda f: f is second):
+                error = future.exception()
+                if error is None:
+                    self._record(endpoint, HEDGE_WON if future is second else HEDGE_LOST)
+                    return future.result()
+                errors[future is second] = error
+        self._record(endpoint, HEDGE_LOST)
+        raise errors.get(False) or errors[True]
+
+    async def call_async(
+        self,
+        endpoint: str,
+        primary: Callable[[], Awaitable[T]],
+        hedge: Callable[[], Awaitable[T]],
+        user_key: Optional[str] = None,
+    ) -> T:
+        """`call` for coroutines; the losing attempt is cancelled."""
+        self._earn_credit()
+        delay = self.delay(endpoint)
+        if delay is None:
+            return await self._timed_async(endpoint, primary)
+        first = asyncio.ensure_future(self._timed_async(endpoint, primary))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not self._admit_hedge(endpoint, user_key):
+            return await first
+        second = asyncio.ensure_future(self._timed_async(endpoint, hedge))
+
+        pending = {first, second}
+        errors: Dict[bool, BaseException] = {}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: t is second):
+                    error = task.exception()
+                    if error is None:
+                        self._record(endpoint, HEDGE_WON if task is second else HEDGE_LOST)
+                        return task.result()
+                    errors[task is second] = error
+        finally:
+            for task in pending:
+                task.cancel()
+        self._record(endpoint, HEDGE_LOST)
+        raise errors.get(False) or errors[True]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = list(self._latencies)
+            outcomes = dict(self._outcomes)
+        return {
+            "outcomes": outcomes,
+            "delays": {endpoint: self.delay(endpoint) for endpoint in endpoints},
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def _submit(self, endpoint: str, fn: Callable[[], T]) -> "Future[T]":
+        """Run `fn` on the pool (in a copy of the caller's context, for spans and budgets); the caller holds a slot."""
+        context = contextvars.copy_context()
+
+        def run() -> T:
+            try:
+                return self._timed(endpoint, fn)
+            finally:
+                self._slots.release()
+
+        return self._executor.submit(context.run, run)
+
+    def _timed(self, endpoint: str, fn: Callable[[], T]) -> T:
+        started = time.perf_counter()
+        result = fn()
+        self._observe(endpoint, time.perf_counter() - started)
+        return result
+
+    async def _timed_async(self, endpoint: str, fn: Callable[[], Awaitable[T]]) -> T:
+        started = time.perf_counter()
+        result = await fn()
+        self._observe(endpoint, time.perf_counter() - started)
+        return result
+
+    def _observe(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._latencies.get(endpoint)
+            if samples is None:
+                samples = self._latencies[endpoint] = deque(maxlen=LATENCY_WINDOW)
+            samples.append(seconds)
+
+    def _earn_credit(self) -> None:
+        with self._lock:
+            self._credits = min(MAX_CREDITS, self._credits + self.settings.max_rate)
+
+    def _admit_hedge(self, endpoint: str, user_key: Optional[str]) -> bool:
+        """Spend a hedge credit and a rate-limit token, or count the hedge as capped."""
+        with self._lock:
+            admitted = self._credits >= 1
+            if admitted:
+                self._credits -= 1
+        if admitted and self.rate_limiter is not None and not self.rate_limiter.try_acquire(user_key, RATE_HEADROOM):
+            with self._lock:
+                self._credits += 1
+            admitted = False
+        if not admitted:
+            self._record(endpoint, HEDGE_CAPPED)
+        return admitted
+
+    def _record(self, endpoint: str, outcome: str) -> None:
+        with self._lock:
+            self._outcomes[outcome] += 1
+        SPOTIFY_HEDGES.inc(endpoint=endpoint, outcome=outcome)
+
+
+def configure_request_hedger(settings: HedgeSettings, rate_limiter: Optional[RateLimiter] = None) -> Optional[RequestHedger]:
+    """Install the process-wide hedger (None when hedging is off); called once from the application factory."""
+    global _shared_hedger
+    hedger = RequestHedger(settings, rate_limiter) if settings.enabled else None
+    with _hedger_lock:
+        previous, _shared_hedger = _shared_hedger, hedger
+    if previous is not None:
+        previous.shutdown()
+    return hedger
+
+
+def get_request_hedger() -> Optional[RequestHedger]:
+    with _hedger_lock:
+        return _shared_hedger
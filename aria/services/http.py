@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..config import HttpSettings
+
+logger = logging.getLogger(__name__)
+
+# Only idempotent verbs are retried on error statuses; POSTs (playlist creation, token calls)
+# are retried on connection failures only, where the request never reached Spotify.
+# 429s are left to the rate limiter so every caller backs off together.
+RETRY_METHODS = frozenset({"GET", "PUT", "DELETE"})
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_session_lock = threading.Lock()
+_shared_session: Optional[requests.Session] = None
+_request_timeout: int = HttpSettings.timeout
+
+
+def create_http_session(settings: HttpSettings) -> requests.Session:
+    """Build a keep-alive session whose connection pools are shared by every Spotify call."""
+    retry = Retry(
+        total=settings.retries,
+        connect=settings.retries,
+        read=False,
+        status=settings.retries,
+        allowed_methods=RETRY_METHODS,
+        status_forcelist=RETRY_STATUSES,
+        backoff_factor=settings.backoff_factor,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.pool_connections,
+        pool_maxsize=settings.pool_maxsize,
+        pool_block=False,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def create_async_http_client(settings: HttpSettings) -> httpx.AsyncClient:
+    """
+    Build the pooled client used by the asyncio agent. Connection failures are retried by the
+    transport; status retries happen in the async Spotify client.
+    """
+    limits = httpx.Limits(
+        max_connections=settings.async_max_connections,
+        max_keepalive_connections=settings.pool_maxsize,
+    )
+    transport = httpx.AsyncHTTPTransport(retries=settings.retries, limits=limits)
+    return httpx.AsyncClient(transport=transport, timeout=settings.timeout)
+
+
+def configure_http_session(settings: HttpSettings) -> requests.Session:
+    """Install the process-wide session; called once from the application factory."""
+    global _shared_session, _request_timeout
+    session = create_http_session(settings)
+    with _session_lock:
+        previous, _shared_session = _shared_session, session
+        _request_timeout = settings.timeout
+    if previous is not None:
+        previous.close()
+    return session
+
+
+def get_http_session() -> requests.Session:
+    global _shared_session
+    with _session_lock:
+        if _shared_session is None:
+            logger.debug("No HTTP session configured, creating one with default settings")
+            _shared_session = create_http_session(HttpSettings())
+        return _shared_session
+
+
+def get_request_timeout() -> int:
+    return _request_timeout
@@ -0,0 +1,423 @@
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .admission import AdmissionController, AdmissionRejected
+from .metrics import GENERATIONS_ATTACHED
+
+if TYPE_CHECKING:
+    from .session_store import BaseSessionStore
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+_FINISHED_STATUSES = {JOB_SUCCEEDED, JOB_FAILED}
+# How often a worker streaming a job run by another process re-reads its shared state.
+_SHARED_POLL_SECONDS = 0.5
+# Lifetime of a shared single-flight claim, in case the process holding it dies mid-run.
+_FLIGHT_TTL = 900
+_FLIGHT_LOCK_STRIPES = 64
+
+EventCallback = Callable[[str, Dict[str, Any]], None]
+JobFunction = Callable[[EventCallback], Dict[str, Any]]
+
+
+def flight_key(owner: str, prompt: str) -> str:
+    """Identifies one user intent: the same session asking for the same (case/space-normalised) prompt."""
+    normalised = " ".join((prompt or "").casefold().split())
+    return f"{owner}:{hashlib.sha256(normalised.encode('utf-8')).hexdigest()[:32]}"
+
+
+@dataclass
+class Job:
+    id: str
+    owner: str
+    prompt: str
+    status: str = JOB_QUEUED
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    events: List[Dict[str, Any]] = field(default_factory=list)
+    flight_key: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in _FINISHED_STATUSES
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def to_record(self) -> Dict[str, Any]:
+        record = self.to_dict()
+        record["owner"] = self.owner
+        record["prompt"] = self.prompt
+        record["flight_key"] = self.flight_key
+        return record
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "Job":
+        return cls(
+            id=record["job_id"],
+            owner=record["owner"],
+            prompt=record["prompt"],
+            status=record["status"],
+            result=record.get("result"),
+            error=record.get("error"),
+            created_at=record["created_at"],
+            started_at=record.get("started_at"),
+            finished_at=record.get("finished_at"),
+            flight_key=record.get("flight_key"),
+        )
+
+
+class StreamSlots:
+    """
+    Caps the Server-Sent Events streams open at once. Under a threaded WSGI server each stream
+    holds a worker thread for the whole generation, so streams beyond `max_streams` (or beyond
+    `max_per_owner` for one session, e.g. several tabs or a reconnect racing the old connection)
+    are refused and the page polls the job status instead.
+    """
+
+    def __init__(self, max_streams: int, max_per_owner: int) -> None:
+        self.max_streams = max_streams
+        self.max_per_owner = max_per_owner
+        self._lock = threading.Lock()
+        self._per_owner: Dict[str, int] = {}
+        self._open = 0
+
+    def acquire(self, owner: str) -> bool:
+        with self._lock:
+            if self._open >= self.max_streams or self._per_owner.get(owner, 0) >= self.max_per_owner:
+                return False
+            self._open += 1
+            self._per_owner[owner] = self._per_owner.get(owner, 0) + 1
+            return True
+
+    def release(self, owner: str) -> None:
+        with self._lock:
+            count = self._per_owner.get(owner, 0)
+            if count <= 0:
+                return
+            self._open -= 1
+            if count == 1:
+                del self._per_owner[owner]
+            else:
+                self._per_owner[owner] = count - 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"open": self._open, "max_streams": self.max_streams}
+
+
+class JobManager:
+    """
+    Runs agent generations on a bounded thread pool so HTTP workers return immediately.
+    Jobs are kept in memory until `result_ttl` seconds after they finish. With a `state_store`,
+    job status and results are also published there, so other worker processes can report
+    them; progress events stay with the process running the job.
+
+    Runs given a `flight_key` are single-flight: while one is queued or running, later
+    requests with the same key get that job back instead of starting another generation.
+
+    New runs go through an AdmissionController (by default one sized to the pool, with
+    `max_pending` queued jobs); a refused run raises AdmissionRejected.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_pending: int = 32,
+        result_ttl: int = 3600,
+        state_store: Optional["BaseSessionStore"] = None,
+        admission: Optional[AdmissionController] = None,
+    ) -> None:
+        self._max_workers = max_workers
+        self.admission = admission or AdmissionController(max_workers, max_pending)
+        self._result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aria-job")
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._jobs: Dict[str, Job] = {}
+        self._latest_by_owner: Dict[str, str] = {}
+        self._flights: Dict[str, str] = {}
+        # Starts with the same flight key are serialised on one of these (striped by key hash).
+        self._flight_locks = [threading.Lock() for _ in range(_FLIGHT_LOCK_STRIPES)]
+        self._state_store = state_store
+
+    def submit(self, owner: str, prompt: str, fn: JobFunction, flight_key: Optional[str] = None) -> Job:
+        """`fn` receives a callback it can use to publish progress events for the job."""
+        job, leader = self._start(owner, prompt, flight_key)
+        if leader:
+            self._executor.submit(self._run, job, fn)
+        return job
+
+    def run(self, owner: str, prompt: str, fn: JobFunction, flight_key: Optional[str] = None) -> Job:
+        """
+        Like `submit`, but blocks until the job (or, for a duplicate, the run in flight)
+        finishes, and returns it. The run still takes a pool slot, so blocking requests count
+        against the same concurrency cap as background ones.
+        """
+        return self.wait(self.submit(owner, prompt, fn, flight_key))
+
+    def wait(self, job: Job, poll: float = _SHARED_POLL_SECONDS) -> Job:
+        """Block until `job` finishes; jobs run by another process are polled in the shared store."""
+        with self._changed:
+            local = self._jobs.get(job.id) is job
+            while local and not job.finished:
+                self._changed.wait()
+        while not job.finished:
+            time.sleep(poll)
+            job = self._shared_job(job.id) or job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self._shared_job(job_id)
+        return job
+
+    def latest_for(self, owner: str) -> Optional[Job]:
+        shared = self._load_shared(f"job-owner:{owner}")
+        if shared is not None:
+            return self.get(shared["job_id"])
+        with self._lock:
+            job_id = self._latest_by_owner.get(owner)
+            return self._jobs.get(job_id) if job_id else None
+
+    def active_jobs(self) -> List[Job]:
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.finished]
+
+    def publish(self, job: Job, event_type: str, data: Dict[str, Any]) -> None:
+        with self._changed:
+            self._append_event_locked(job, event_type, data)
+
+    def iter_events(self, job: Job, after: int = 0, heartbeat: float = 15.0) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        Yield the job's events with an id greater than `after`, waiting for new ones until
+        the job finishes. Yields None every `heartbeat` seconds without activity.
+        """
+        with self._lock:
+            local = self._jobs.get(job.id) is job
+        if not local:
+            yield from self._iter_shared_events(job, after, heartbeat)
+            return
+
+        cursor = after
+        while True:
+            with self._changed:
+                if len(job.events) <= cursor and not job.finished:
+                    self._changed.wait(timeout=heartbeat)
+                pending = job.events[cursor:]
+                finished = job.finished
+            if pending:
+                cursor += len(pending)
+                yield from pending
+            elif finished:
+                return
+            else:
+                yield None
+
+    def estimated_wait(self, job: Job) -> float:
+        """Estimated seconds before a queued job starts (0 once it runs, or if run elsewhere)."""
+        return self.admission.estimated_wait(job.id)
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _run(self, job: Job, fn: JobFunction) -> None:
+        self.admission.start(job.id)
+        with self._lock:
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+        self._share(job)
+        logger.info("Generation job %s started", job.id)
+
+        def emit(event_type: str, data: Dict[str, Any]) -> None:
+            self.publish(job, event_type, data)
+
+        try:
+            result = fn(emit)
+        except Exception as exc:  # pragma: no cover - defensive, surfaced through the job status
+            logger.exception("Generation job %s failed", job.id)
+            self.admission.finish(job.id)
+            with self._changed:
+                job.status = JOB_FAILED
+                job.error = str(exc) or exc.__class__.__name__
+                job.finished_at = time.time()
+                self._append_event_locked(job, "failed", {"error": job.error})
+            self._share(job)
+            self._release_flight(job)
+            return
+
+        self.admission.finish(job.id)
+        with self._changed:
+            job.status = JOB_SUCCEEDED
+            job.result = result
+            job.finished_at = time.time()
+            self._append_event_locked(job, "done", result)
+        self._share(job)
+        self._release_flight(job)
+        logger.info("Generation job %s finished in %.1fs", job.id, job.finished_at - (job.started_at or job.created_at))
+
+    def _append_event_locked(self, job: Job, event_type: str, data: Dict[str, Any]) -> None:
+        job.events.append({"id": len(job.events) + 1, "type": event_type, "data": data})
+        self._changed.notify_all()
+
+    def _start(self, owner: str, prompt: str, key: Optional[str]) -> Tuple[Job, bool]:
+        """
+        Register a new job, or return the one already in flight for `key` (second item False).
+        Other processes are coordinated through an atomic claim on the shared `flight:` record.
+        Only new jobs go through admission control; joining a run in flight costs nothing.
+        """
+        job = Job(id=uuid.uuid4().hex, owner=owner, prompt=prompt, flight_key=key)
+        flight_lock = self._flight_locks[hash(key) % _FLIGHT_LOCK_STRIPES] if key else contextlib.nullcontext()
+        with flight_lock:
+            with self._lock:
+                existing = self._jobs.get(self._flights.get(key, "")) if key else None
+            if existing is not None and not existing.finished:
+                return self._attach(existing), False
+
+            existing = self._claim_flight(job) if key else None
+            if existing is not None:
+                return self._attach(existing), False
+
+            try:
+                wait = self.admission.admit(job.id, owner)
+            except AdmissionRejected:
+                self._release_flight(job)
+                self._unshare(job)
+                raise
+            with self._lock:
+                self._prune_locked()
+                self._jobs[job.id] = job
+                self._latest_by_owner[owner] = job.id
+                if key:
+                    self._flights[key] = job.id
+
+        logger.info("Queued generation job %s (estimated wait %.1fs)", job.id, wait)
+        self._share(job, latest=True)
+        return job, True
+
+    def _attach(self, job: Job) -> Job:
+        GENERATIONS_ATTACHED.inc()
+        logger.info("Attached to in-flight generation job %s", job.id)
+        return job
+
+    def _claim_flight(self, job: Job) -> Optional[Job]:
+        """The job another process is running for this flight, after trying to claim it for `job`."""
+        if self._state_store is None:
+            return None
+        key = f"flight:{job.flight_key}"
+        try:
+            self._share(job)
+            holder = self._state_store.claim(key, "job_id", job.id, ttl=_FLIGHT_TTL)
+            if holder == job.id:
+                return None
+            other = self._shared_job(holder)
+            if other is not None and not other.finished:
+                return other
+            # The holder finished without releasing the flight (e.g. its process died).
+            self._state_store.apply(key, {"job_id": job.id}, ttl=_FLIGHT_TTL)
+        except Exception:
+            logger.exception("Could not coordinate generation job %s through the shared store", job.id)
+        return None
+
+    def _release_flight(self, job: Job) -> None:
+        if not job.flight_key:
+            return
+        with self._lock:
+            if self._flights.get(job.flight_key) == job.id:
+                del self._flights[job.flight_key]
+        if self._state_store is None:
+            return
+        key = f"flight:{job.flight_key}"
+        try:
+            record = self._state_store.load(key)
+            if record is not None and record.get("job_id") == job.id:
+                self._state_store.delete(key)
+        except Exception:
+            logger.exception("Could not release the flight of generation job %s", job.id)
+
+    def _iter_shared_events(self, job: Job, after: int, heartbeat: float) -> Iterator[Optional[Dict[str, Any]]]:
+        """Poll a job run by another process and yield its final `done` or `failed` event."""
+        waited = 0.0
+        while not job.finished:
+            time.sleep(_SHARED_POLL_SECONDS)
+            waited += _SHARED_POLL_SECONDS
+            job = self._shared_job(job.id) or job
+            if waited >= heartbeat and not job.finished:
+                waited = 0.0
+                yield None
+        if job.status == JOB_SUCCEEDED:
+            yield {"id": after + 1, "type": "done", "data": job.result}
+        else:
+            yield {"id": after + 1, "type": "failed", "data": {"error": job.error}}
+
+    def _share(self, job: Job, latest: bool = False) -> None:
+        if self._state_store is None:
+            return
+        with self._lock:
+            record = job.to_record()
+        try:
+            self._state_store.apply(f"job:{job.id}", record, ttl=self._result_ttl)
+            if latest:
+                self._state_store.apply(f"job-owner:{job.owner}", {"job_id": job.id}, ttl=self._result_ttl)
+        except Exception:
+            logger.exception("Could not publish generation job %s", job.id)
+
+    def _unshare(self, job: Job) -> None:
+        if self._state_store is None or not job.flight_key:
+            return
+        try:
+            self._state_store.delete(f"job:{job.id}")
+        except Exception:
+            logger.exception("Could not withdraw generation job %s", job.id)
+
+    def _shared_job(self, job_id: str) -> Optional[Job]:
+        record = self._load_shared(f"job:{job_id}")
+        return Job.from_record(record) if record is not None else None
+
+    def _load_shared(self, key: str) -> Optional[Dict[str, Any]]:
+        if self._state_store is None:
+            return None
+        try:
+            return self._state_store.load(key)
+        except Exception:
+            logger.exception("Could not read shared job state %s", key)
+            return None
+
+    def _prune_locked(self) -> None:
+        cutoff = time.time() - self._result_ttl
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished and (job.finished_at or 0) < cutoff
+        ]
+        for job_id in expired:
+            job = self._jobs.pop(job_id)
+            if self._latest_by_owner.get(job.owner) == job_id:
+                self._latest_by_owner.pop(job.owner, None)
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Request-scale buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+STEP_COUNT_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name + "_total", dict(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # Per-bucket counts followed by +Inf count and sum.
+            series = self._series.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        out: List[Sample] = []
+        for key, series in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                out.append((self.name + "_bucket", dict(labels, le=_format_value(bound)), cumulative))
+            out.append((self.name + "_bucket", dict(labels, le="+Inf"), series[-2]))
+            out.append((self.name + "_count", labels, series[-2]))
+            out.append((self.name + "_sum", labels, series[-1]))
+        return out
+
+
+class MetricsRegistry:
+    """Holds metrics and scrape-time collectors, rendered in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: Dict[str, Collector] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, key: str, collector: Collector) -> None:
+        """`collector()` yields (name, type, help, samples) for values read at scrape time."""
+        with self._lock:
+            self._collectors[key] = collector
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.values())
+
+        families = [(m.name, m.kind, m.documentation, m.samples()) for m in metrics]
+        for collector in collectors:
+            families.extend(collector())
+
+        lines: List[str] = []
+        for name, kind, documentation, samples in families:
+            lines.append(f"# HELP {name} {_escape_help(documentation)}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape_label(str(value))}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = MetricsRegistry()
+
+GENERATION_SECONDS = REGISTRY.histogram(
+    "aria_generation_seconds",
+    "Wall-clock duration of a playlist generation.",
+    ("outcome",),
+)
+GENERATION_STEPS = REGISTRY.histogram(
+    "aria_generation_steps",
+    "Model round trips needed by a generation.",
+    buckets=STEP_COUNT_BUCKETS,
+)
+AGENT_STEP_SECONDS = REGISTRY.histogram(
+    "aria_agent_step_seconds",
+    "Duration of one agent step: model response plus the tool calls it requested.",
+    ("model",),
+)
+MODEL_REQUEST_SECONDS = REGISTRY.histogram(
+    "aria_model_request_seconds",
+    "Latency of a Responses API call, until the full response was received.",
+    ("model", "streamed"),
+)
+MODEL_TOKENS = REGISTRY.counter(
+    "aria_model_tokens",
+    "Tokens reported in Responses API usage.",
+    ("model", "kind"),
+)
+MODEL_FALLBACKS = REGISTRY.counter(
+    "aria_model_fallbacks",
+    "Fast model steps replayed on the primary model, by reason.",
+    ("model", "reason"),
+)
+TOOL_CALL_SECONDS = REGISTRY.histogram(
+    "aria_tool_call_seconds",
+    "Duration of a tool call requested by the model.",
+    ("tool", "ok"),
+)
+BUDGET_FINALISATIONS = REGISTRY.counter(
+    "aria_budget_finalisations",
+    "Generations finalised early, by the budget limit that was approaching.",
+    ("reason",),
+)
+GENERATIONS_ATTACHED = REGISTRY.counter(
+    "aria_generations_attached",
+    "Generation requests that joined an identical run already in flight instead of starting one.",
+)
+ADMISSION_REJECTIONS = REGISTRY.counter(
+    "aria_admission_rejections",
+    "Generation requests refused by admission control, by reason.",
+    ("reason",),
+)
+GENERATION_QUEUE_SECONDS = REGISTRY.histogram(
+    "aria_generation_queue_seconds",
+    "Time an admitted generation waited for a run slot.",
+)
+SPOTIFY_REQUEST_SECONDS = REGISTRY.histogram(
+    "aria_spotify_request_seconds",
+    "Latency of a Spotify HTTP request, per endpoint and status.",
+    ("endpoint", "method", "status"),
+)
+SPOTIFY_HEDGES = REGISTRY.counter(
+    "aria_spotify_hedges",
+    "Duplicate Spotify reads sent after a slow first attempt, by outcome (won, lost, capped).",
+    ("endpoint", "outcome"),
+)
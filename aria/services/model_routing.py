@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from .budget import PHASE_NORMAL, RunBudget
+from .metrics import MODEL_FALLBACKS
+
+# Tools offered to the fast model: searches, plus naming the prepared playlist. None of them
+# has a side effect that matters if the fast turn is thrown away and replayed.
+SEARCH_TOOLS = frozenset({"search_items", "search_many", "search_local_catalog"})
+FAST_TOOLS = SEARCH_TOOLS | {"name_playlist"}
+# Distinct tracks found after which the selection is close: later steps use the primary model.
+SELECTION_CANDIDATES = 40
+# Fast turns with invalid tool arguments tolerated before the primary model keeps the run.
+MAX_INVALID_TURNS = 2
+
+FALLBACK_INVALID_ARGUMENTS = "invalid_arguments"
+FALLBACK_HANDOFF = "handoff"
+
+_JSON_TYPES: Dict[str, Tuple[type, ...]] = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "array": (list,),
+    "object": (dict,),
+    "null": (type(None),),
+}
+
+
+class ModelRouter:
+    """
+    Picks the model of each agent step. Search turns go to the fast model; playlist creation,
+    track selection and the summary stay on the primary model. An unusable fast turn is
+    replayed on the primary model, which keeps the rest of the run once the fast model stops
+    calling tools (it wants to select or finish) or keeps emitting invalid arguments.
+    """
+
+    def __init__(self, primary: str, fast: Optional[str] = None) -> None:
+        self.primary = primary
+        self.fast = fast if fast and fast != primary else None
+        self.pinned = self.fast is None
+        self.invalid_turns = 0
+        self._playlist_created = False
+        self._track_uris: Set[str] = set()
+        self._track_rows = 0
+
+    @property
+    def candidates(self) -> int:
+        return len(self._track_uris) + self._track_rows
+
+    def route(
+        self,
+        tools: List[Dict[str, Any]],
+        budget: Optional[RunBudget] = None,
+    ) -> Tuple[str, List[Dict[str, Any]]]:
+        """Model and tools of the next step, given the tools the budget left for it."""
+        if self.pinned or self.candidates >= SELECTION_CANDIDATES:
+            return self.primary, tools
+        if budget is not None and budget.phase != PHASE_NORMAL:
+            return self.primary, tools
+        names = {tool["name"] for tool in tools}
+        if "create_playlist" in names and not self._playlist_created:
+            return self.primary, tools
+        fast_tools = [tool for tool in tools if tool["name"] in FAST_TOOLS]
+        if not any(tool["name"] in SEARCH_TOOLS for tool in fast_tools):
+            return self.primary, tools
+        return self.fast, fast_tools
+
+    def fallback_reason(self, response: Any, tools: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Check a fast step's response against the tools it was offered; returns why it must be
+        replayed on the primary model, or None when the response can be used.
+        """
+        calls = [item for item in response.output if item.type == "function_call"]
+        if not calls:
+            reason = FALLBACK_HANDOFF
+            self.pinned = True
+        elif not all(valid_tool_call(call, tools) for call in calls):
+            reason = FALLBACK_INVALID_ARGUMENTS
+            self.invalid_turns += 1
+            self.pinned = self.invalid_turns >= MAX_INVALID_TURNS
+        else:
+            return None
+        MODEL_FALLBACKS.inc(model=self.fast, reason=reason)
+        return reason
+
+    def observe(self, function_calls: Iterable[Any], results: Iterable[Any]) -> None:
+        """Count the candidate tracks a step's searches returned."""
+        for fc, result in zip(function_calls, results):
+            if fc.name == "add_tracks":
+                self.pinned = True
+            elif fc.name == "create_playlist" and isinstance(result, dict) and "error" not in result:
+                self._playlist_created = True
+            elif fc.name in SEARCH_TOOLS and isinstance(result, dict):
+                tracks = result.get("tracks")
+                if isinstance(tracks, list):
+                    self._track_uris.update(track.get("uri") for track in tracks if isinstance(track, dict))
+                elif isinstance(tracks, str):
+                    # Compact tables only list tracks not shown before, under a header line.
+                    self._track_rows += max(len(tracks.splitlines()) - 1, 0)
+
+
+def valid_tool_call(call: Any, tools: List[Dict[str, Any]]) -> bool:
+    """Whether a function call names an offered tool and its arguments match that tool's schema."""
+    schema = next((tool.get("parameters") for tool in tools if tool["name"] == call.name), None)
+    if schema is None:
+        return False
+    try:
+        arguments = json.loads(call.arguments or "{}")
+    except (TypeError, ValueError):
+        return False
+    return matches_schema(arguments, schema)
+
+
+def matches_schema(value: Any, schema: Dict[str, Any]) -> bool:
+    """Structural check of a value against the JSON schema subset the tool definitions use."""
+    types = schema.get("type")
+    if types is not None:
+        names = [types] if isinstance(types, str) else list(types)
+        accepted = tuple(kind for name in names for kind in _JSON_TYPES.get(name, (object,)))
+        if not isinstance(value, accepted):
+            return False
+        if isinstance(value, bool) and "boolean" not in names:
+            return False
+    if "enum" in schema and value not in schema["enum"]:
+        return False
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        if any(key not in value for key in schema.get("required", ())):
+            return False
+        if schema.get("additionalProperties") is False and any(key not in properties for key in value):
+            return False
+        return all(matches_schema(item, properties[key]) for key, item in value.items() if key in properties)
+    if isinstance(value, list) and "items" in schema:
+        return all(matches_schema(item, schema["items"]) for item in value)
+    return True
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 
 
 def create_openai_client(api_key: str) -> OpenAI:
     """Create a configured OpenAI client."""
     return OpenAI(api_key=api_key)
 
+
+def create_async_openai_client(api_key: str) -> AsyncOpenAI:
+    """Create the asyncio OpenAI client used by the async agent."""
+    return AsyncOpenAI(api_key=api_key)
@@ -0,0 +1,284 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from ..config import PromptCacheSettings
+
+logger = logging.getLogger(__name__)
+
+# Words that only say "make me a playlist" and would otherwise dominate short prompts.
+_FILLER_WORDS = frozenset(
+    """
+    a an and any de des du et for give i la le les me moi my of ou playlist playlists please pour
+    some something song songs chanson chansons musique music make create fais cree creer une un the
+    tracks with avec to stp svp
+    """.split()
+)
+_WORD_RE = re.compile(r"[^\W_]+")
+# Minimum trigram Jaccard similarity for two words to count as misspellings of each other.
+TYPO_SIMILARITY = 0.4
+# Mersenne prime for the universal hash family used by the MinHash permutations.
+_PRIME = (1 << 61) - 1
+
+
+def normalise_prompt(prompt: str) -> Tuple[str, ...]:
+    """Casefolded, accent-free content words: `"Workout music!"` -> `("workout",)`."""
+    text = unicodedata.normalize("NFKD", prompt or "").casefold()
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    words = _WORD_RE.findall(text)
+    content = tuple(word for word in words if word not in _FILLER_WORDS)
+    return content or tuple(words)
+
+
+def prompt_shingles(words: Tuple[str, ...]) -> FrozenSet[str]:
+    """Words plus character trigrams, so reordered words and small typos still overlap."""
+    shingles = set(words)
+    for word in words:
+        padded = f" {word} "
+        shingles.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(shingles)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def same_intent(a: Tuple[str, ...], b: Tuple[str, ...]) -> bool:
+    """
+    Whether two normalised prompts only differ by word order or typos: every word of one
+    must appear in the other, or pair with a misspelling of itself. An added or dropped word
+    ("without rain"), or a different number ("1985"/"1986"), is a different request.
+    """
+    only_a = sorted(set(a) - set(b))
+    only_b = sorted(set(b) - set(a))
+    if len(only_a) != len(only_b):
+        return False
+    for word in only_a:
+        match = next((other for other in only_b if _is_typo(word, other)), None)
+        if match is None:
+            return False
+        only_b.remove(match)
+    return True
+
+
+def _is_typo(a: str, b: str) -> bool:
+    """One edit apart (a transposition counts as one) and still sharing most trigrams: "wrkout", not "unhappy" or "mad"."""
+    if any(ch.isdigit() for ch in a + b) or _edit_distance(a, b) > 1:
+        return False
+    return jaccard(prompt_shingles((a,)) - {a}, prompt_shingles((b,)) - {b}) >= TYPO_SIMILARITY
+
+
+def _edit_distance(a: str, b: str) -> int:
+    """Optimal string alignment distance: insertions, deletions, substitutions and adjacent transpositions."""
+    previous: List[int] = []
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, row = previous, row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[-1]
+
+
+class MinHasher:
+    """MinHash signatures split into LSH bands; prompts sharing any band become candidates."""
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, seed: int = 1) -> None:
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        rng = random.Random(seed)
+        self.rows = num_perm // bands
+        self.bands = bands
+        self._perms = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+
+    def signature(self, shingles: FrozenSet[str]) -> Tuple[int, ...]:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+            for s in shingles
+        ] or [0]
+        return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in self._perms)
+
+    def band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+
+@dataclass
+class CachedResult:
+    """What a generation chose, enough to rebuild the playlist without the model."""
+
+    name: str
+    description: str
+    public: bool
+    tracks: List[str]
+    summary: str
+    prompt: str = ""
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "description": self.description,
+            "public": self.public,
+            "tracks": list(self.tracks),
+            "summary": self.summary,
+            "prompt": self.prompt,
+        }
+
+
+@dataclass
+class _Entry:
+    key: str
+    result: CachedResult
+    shingles: FrozenSet[str]
+    bands: List[Tuple[int, Tuple[int, ...]]]
+    expires_at: float
+
+
+class PromptCache:
+    """
+    In-process cache of generation results keyed on the normalised prompt, with a MinHash
+    LSH index to also serve near-duplicates whose shingle similarity reaches `similarity`
+    and that only differ by word order or typos (see `same_intent`).
+    Entries expire after `ttl` seconds; the least recently used go first past `max_entries`.
+    """
+
+    def __init__(
+        self,
+        ttl: int = 21600,
+        max_entries: int = 1024,
+        similarity: float = 0.8,
+        num_perm: int = 64,
+        bands: int = 16,
+    ) -> None:
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._similarity = similarity
+        self._hasher = MinHasher(num_perm=num_perm, bands=bands)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], set] = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, prompt: str) -> Optional[CachedResult]:
+        words = normalise_prompt(prompt)
+        if not words:
+            return None
+        key = " ".join(words)
+        shingles = prompt_shingles(words)
+        bands = self._hasher.band_keys(self._hasher.signature(shingles))
+        now = time.time()
+        with self._lock:
+            self._expire_locked(now)
+            entry = self._entries.get(key)
+            near = False
+            if entry is None:
+                entry = self._nearest_locked(words, shingles, bands)
+                near = entry is not None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry.key)
+            if near:
+                self.near_hits += 1
+            else:
+                self.hits += 1
+            logger.info(
+                "Prompt cache %s hit for %r (cached prompt %r)",
+                "near" if near else "exact",
+                prompt,
+                entry.result.prompt,
+            )
+            return entry.result
+
+    def set(self, prompt: str, result: CachedResult) -> None:
+        words = normalise_prompt(prompt)
+        if not words or not result.tracks:
+            return
+        key = " ".join(words)
+        shingles = prompt_shingles(words)
+        entry = _Entry(
+            key=key,
+            result=result,
+            shingles=shingles,
+            bands=self._hasher.band_keys(self._hasher.signature(shingles)),
+            expires_at=time.time() + self._ttl,
+        )
+        with self._lock:
+            if key in self._entries:
+                self._drop_locked(key)
+            self._entries[key] = entry
+            for band in entry.bands:
+                self._buckets.setdefault(band, set()).add(key)
+            while len(self._entries) > self._max_entries:
+                self._drop_locked(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": ((self.hits + self.near_hits) / lookups) if lookups else 0.0,
+            }
+
+    def _nearest_locked(
+        self,
+        words: Tuple[str, ...],
+        shingles: FrozenSet[str],
+        bands: List[Tuple[int, Tuple[int, ...]]],
+    ) -> Optional[_Entry]:
+        candidates = set()
+        for band in bands:
+            candidates.update(self._buckets.get(band, ()))
+        best: Optional[_Entry] = None
+        best_score = self._similarity
+        for key in candidates:
+            entry = self._entries[key]
+            score = jaccard(shingles, entry.shingles)
+            if score >= best_score and same_intent(words, tuple(key.split())):
+                best, best_score = entry, score
+        return best
+
+    def _expire_locked(self, now: float) -> None:
+        expired = [key for key, entry in self._entries.items() if entry.expires_at <= now]
+        for key in expired:
+            self._drop_locked(key)
+        self.evictions += len(expired)
+
+    def _drop_locked(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        for band in entry.bands:
+            keys = self._buckets.get(band)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[band]
+
+
+def create_prompt_cache(settings: PromptCacheSettings) -> Optional[PromptCache]:
+    if not settings.enabled:
+        return None
+    return PromptCache(
+        ttl=settings.ttl,
+        max_entries=settings.max_entries,
+        similarity=settings.similarity,
+    )
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, TypeVar
+
+from spotipy.exceptions import SpotifyException
+
+from ..config import RateLimitSettings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAX_TRACKED_USERS = 4096
+
+_limiter_lock = threading.Lock()
+_shared_limiter: Optional["RateLimiter"] = None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token, returning how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def try_take(self, headroom: float = 0.0) -> bool:
+        """Take one token only if it is available right away and `headroom` of the bucket stays full."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < max(1.0, headroom * self.capacity + 1):
+                return False
+            self._tokens -= 1
+            return True
+
+    def refund(self) -> None:
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            elapsed = time.monotonic() - self._updated
+            return min(self.capacity, self._tokens + elapsed * self.rate)
+
+
+class RateLimiter:
+    """
+    App-wide and per-user token buckets in front of every Spotify call. A 429 pauses all
+    callers for its Retry-After (Spotify's limit is per application) and the call is retried
+    transparently, up to `max_retries` times and `max_wait` seconds per pause.
+    """
+
+    def __init__(self, settings: RateLimitSettings) -> None:
+        self._settings = settings
+        self._app_bucket = TokenBucket(settings.app_rate, settings.app_burst)
+        self._user_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._backoff_until = 0.0
+        self._throttled_total = 0
+        self._retries_total = 0
+        self._waited_seconds = 0.0
+
+    def call(self, fn: Callable[[], T], user_key: Optional[str] = None) -> T:
+        """
+        Run `fn` under the limits. `fn` may raise a SpotifyException or return a requests
+        response; either one carrying a 429 status triggers a back-off and a retry.
+        """
+        attempt = 0
+        while True:
+            self.acquire(user_key)
+            try:
+                result = fn()
+            except SpotifyException as exc:
+                if exc.http_status != 429 or not self._should_retry(exc.headers, attempt):
+                    raise
+            else:
+                if getattr(result, "status_code", None) != 429:
+                    return result
+                if not self._should_retry(getattr(result, "headers", None), attempt):
+                    return result
+            attempt += 1
+
+    async def call_async(self, fn: Callable[[], Awaitable[T]], user_key: Optional[str] = None) -> T:
+        """Same as `call` for coroutines; waiting yields to the event loop instead of sleeping."""
+        attempt = 0
+        while True:
+            await self.acquire_async(user_key)
+            try:
+                result = await fn()
+            except SpotifyException as exc:
+                if exc.http_status != 429 or not self._should_retry(exc.headers, attempt):
+                    raise
+            else:
+                if getattr(result, "status_code", None) != 429:
+                    return result
+                if not self._should_retry(getattr(result, "headers", None), attempt):
+                    return result
+            attempt += 1
+
+    def acquire(self, user_key: Optional[str] = None) -> None:
+        """Block until the current back-off has elapsed and both buckets grant a token."""
+        waited = 0.0
+        while True:
+            pause = self._backoff_remaining()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+            waited += pause
+
+        wait = self._reserve(user_key)
+        if wait > 0:
+            time.sleep(wait)
+            waited += wait
+        self._note_waited(waited)
+
+    async def acquire_async(self, user_key: Optional[str] = None) -> None:
+        waited = 0.0
+        while True:
+            pause = self._backoff_remaining()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+            waited += pause
+
+        wait = self._reserve(user_key)
+        if wait > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        self._note_waited(waited)
+
+    def try_acquire(self, user_key: Optional[str] = None, headroom: float = 0.0) -> bool:
+        """
+        Take a token from both buckets without waiting, leaving at least `headroom` (a share of
+        the burst) in each; False during a back-off or when a bucket is too low.
+        """
+        if self._backoff_remaining() > 0 or not self._app_bucket.try_take(headroom):
+            return False
+        if user_key and not self._user_bucket(user_key).try_take(headroom):
+            self._app_bucket.refund()
+            return False
+        return True
+
+    def note_throttled(self, headers: Optional[Mapping[str, str]]) -> None:
+        """Record a 429 from a call made outside `call`, so every caller backs off."""
+        self._note_throttled(_retry_after_seconds(headers))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            backoff = max(0.0, self._backoff_until - time.monotonic())
+            users = len(self._user_buckets)
+            return {
+                "backoff_remaining": round(backoff, 3),
+                "app_tokens": round(self._app_bucket.tokens, 3),
+                "tracked_users": users,
+                "throttled_total": self._throttled_total,
+                "retries_total": self._retries_total,
+                "waited_seconds_total": round(self._waited_seconds, 3),
+            }
+
+    def _should_retry(self, headers: Optional[Mapping[str, str]], attempt: int) -> bool:
+        """Record a 429 and decide whether the call gets another attempt."""
+        delay = _retry_after_seconds(headers)
+        self._note_throttled(delay)
+        if attempt >= self._settings.max_retries or delay > self._settings.max_wait:
+            return False
+        with self._lock:
+            self._retries_total += 1
+        logger.warning("Spotify rate limit hit, retrying in %.1fs (attempt %s)", delay, attempt + 1)
+        return True
+
+    def _backoff_remaining(self) -> float:
+        with self._lock:
+            return self._backoff_until - time.monotonic()
+
+    def _reserve(self, user_key: Optional[str]) -> float:
+        wait = self._app_bucket.reserve()
+        if user_key:
+            wait = max(wait, self._user_bucket(user_key).reserve())
+        return wait
+
+    def _note_waited(self, waited: float) -> None:
+        if waited:
+            with self._lock:
+                self._waited_seconds += waited
+
+    def _note_throttled(self, delay: float) -> None:
+        with self._lock:
+            self._throttled_total += 1
+            self._backoff_until = max(self._backoff_until, time.monotonic() + min(delay, self._settings.max_wait))
+
+    def _user_bucket(self, user_key: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._user_buckets.get(user_key)
+            if bucket is None:
+                bucket = TokenBucket(self._settings.user_rate, self._settings.user_burst)
+                self._user_buckets[user_key] = bucket
+                while len(self._user_buckets) > MAX_TRACKED_USERS:
+                    self._user_buckets.popitem(last=False)
+            else:
+                self._user_buckets.move_to_end(user_key)
+            return bucket
+
+
+def _retry_after_seconds(headers: Optional[Mapping[str, str]], default: float = 1.0) -> float:
+    raw = (headers or {}).get("Retry-After")
+    if raw is None:
+        return default
+    try:
+        return max(0.0, float(raw))
+    except (TypeError, ValueError):
+        return default
+
+
+def configure_rate_limiter(settings: RateLimitSettings) -> RateLimiter:
+    """Install the process-wide limiter; called once from the application factory."""
+    global _shared_limiter
+    limiter = RateLimiter(settings)
+    with _limiter_lock:
+        _shared_limiter = limiter
+    return limiter
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _shared_limiter
+    with _limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter(RateLimitSettings())
+        return _shared_limiter
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from ..config import SearchCacheSettings
+
+logger = logging.getLogger(__name__)
+
+
+def make_search_key(query: str, item_types: Iterable[str], limit: int) -> str:
+    """Catalog results do not depend on the user, so the key only covers the request shape."""
+    normalised = " ".join(unicodedata.normalize("NFKC", query or "").casefold().split())
+    types = ",".join(sorted({t.strip().lower() for t in item_types if t and t.strip()}))
+    return f"{types}|{int(limit)}|{normalised}"
+
+
+class BaseSearchCache:
+    backend = "none"
+
+    def __init__(self) -> None:
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": self.backend,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+    def _record(self, hit: bool) -> None:
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _record_evictions(self, count: int) -> None:
+        if count:
+            with self._stats_lock:
+                self.evictions += count
+
+
+class SearchCache(BaseSearchCache):
+    """In-process LRU cache with a TTL and an approximate memory cap (size of the JSON payloads)."""
+
+    backend = "memory"
+
+    def __init__(self, ttl: int = 86400, max_entries: int = 2048, max_bytes: int = 16 * 1024 * 1024) -> None:
+        super().__init__()
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._drop_locked(key)
+                self._record_evictions(1)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        self._record(entry is not None)
+        return json.loads(entry[1]) if entry is not None else None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        payload = json.dumps(value, separators=(",", ":"))
+        size = len(payload)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop_locked(key)
+            self._entries[key] = (time.time() + self._ttl, payload)
+            self._bytes += size
+            evicted = 0
+            while self._entries and (len(self._entries) > self._max_entries or self._bytes > self._max_bytes):
+                oldest = next(iter(self._entries))
+                self._drop_locked(oldest)
+                evicted += 1
+        self._record_evictions(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        data = super().stats()
+        with self._lock:
+            data["entries"] = len(self._entries)
+            data["bytes"] = self._bytes
+        return data
+
+    def _drop_locked(self, key: str) -> None:
+        _, payload = self._entries.pop(key)
+        self._bytes -= len(payload)
+
+
+class SqliteSearchCache(BaseSearchCache):
+    """
+    SQLite-backed variant so several gunicorn workers (and restarts) share cached searches.
+    Each thread keeps its own connection; WAL mode lets readers run alongside a writer.
+    Entry count and total size are kept in a one-row table by triggers, so a write never
+    rescans the cache, and hits only refresh the LRU timestamp every TOUCH_INTERVAL seconds.
+    """
+
+    backend = "sqlite"
+    # Granularity of the LRU order: a hit within this many seconds of the last touch is not written.
+    TOUCH_INTERVAL = 300.0
+
+    def __init__(
+        self,
+        path: str,
+        ttl: int = 86400,
+        max_entries: int = 20000,
+        max_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        super().__init__()
+        self._path = path
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(
+            """
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS search_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS search_cache_accessed ON search_cache (accessed_at);
+            CREATE INDEX IF NOT EXISTS search_cache_expires ON search_cache (expires_at);
+            CREATE TABLE IF NOT EXISTS search_cache_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                entries INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO search_cache_totals (id, entries, bytes)
+                SELECT 1, COUNT(*), COALESCE(SUM(size), 0) FROM search_cache;
+            CREATE TRIGGER IF NOT EXISTS search_cache_added AFTER INSERT ON search_cache BEGIN
+                UPDATE search_cache_totals SET entries = entries + 1, bytes = bytes + new.size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS search_cache_removed AFTER DELETE ON search_cache BEGIN
+                UPDATE search_cache_totals SET entries = entries - 1, bytes = bytes - old.size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS search_cache_resized AFTER UPDATE OF size ON search_cache BEGIN
+                UPDATE search_cache_totals SET bytes = bytes - old.size + new.size;
+            END;
+            COMMIT;
+            """
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value, accessed_at FROM search_cache WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+            if row is not None and now - row[1] >= self.TOUCH_INTERVAL:
+                conn.execute("UPDATE search_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                conn.commit()
+        except sqlite3.Error:
+            logger.exception("Search cache lookup failed")
+            row = None
+        self._record(row is not None)
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        payload = json.dumps(value, separators=(",", ":"))
+        if len(payload) > self._max_bytes:
+            return
+        now = time.time()
+        try:
+            conn = self._conn()
+            # An upsert rather than INSERT OR REPLACE: the implicit delete of a REPLACE skips triggers.
+            conn.execute(
+                "INSERT INTO search_cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size,"
+                " expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                (key, payload, len(payload), now + self._ttl, now),
+            )
+            evicted = self._evict(conn, now)
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception("Search cache write failed")
+            return
+        self._record_evictions(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        data = super().stats()
+        try:
+            count, total = self._totals(self._conn())
+        except sqlite3.Error:
+            count, total = None, None
+        data["entries"] = count
+        data["bytes"] = total
+        return data
+
+    def _totals(self, conn: sqlite3.Connection) -> Tuple[int, int]:
+        return conn.execute("SELECT entries, bytes FROM search_cache_totals WHERE id = 1").fetchone()
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> int:
+        evicted = conn.execute("DELETE FROM search_cache WHERE expires_at <= ?", (now,)).rowcount
+        count, total = self._totals(conn)
+        if count <= self._max_entries and total <= self._max_bytes:
+            return evicted
+        doomed = []
+        rows = conn.execute("SELECT key, size FROM search_cache ORDER BY accessed_at ASC")
+        for key, size in rows:
+            if count <= self._max_entries and total <= self._max_bytes:
+                break
+            doomed.append((key,))
+            count -= 1
+            total -= size
+        rows.close()
+        conn.executemany("DELETE FROM search_cache WHERE key = ?", doomed)
+        return evicted + len(doomed)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+def create_search_cache(settings: SearchCacheSettings) -> Optional[BaseSearchCache]:
+    if settings.backend == "off":
+        return None
+    if settings.backend == "sqlite":
+        logger.info("Using SQLite search cache at %s", settings.path)
+        return SqliteSearchCache(
+            settings.path,
+            ttl=settings.ttl,
+            max_entries=settings.max_entries,
+            max_bytes=settings.max_bytes,
+        )
+    return SearchCache(ttl=settings.ttl, max_entries=settings.max_entries, max_bytes=settings.max_bytes)
@@ -0,0 +1,548 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from flask import Flask, Request, Response
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from ..config import SessionSettings
+
+logger = logging.getLogger(__name__)
+
+Record = Dict[str, str]
+
+
+def session_key(sid: str) -> str:
+    """Store key of a session's record; job records live next to them under `job:`."""
+    return f"session:{sid}"
+
+
+class BaseSessionStore:
+    """
+    Key/value records whose fields are JSON documents. Writes go through `apply`, which only
+    touches the fields given, so a request and a background job writing different fields of
+    the same session do not overwrite each other.
+    """
+
+    backend = "none"
+
+    def __init__(self, ttl: int) -> None:
+        self.ttl = ttl
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        record = self._load(key)
+        if record is None:
+            return None
+        return {field: json.loads(value) for field, value in record.items()}
+
+    def apply(
+        self,
+        key: str,
+        changes: Mapping[str, Any],
+        removed: Iterable[str] = (),
+        ttl: Optional[int] = None,
+    ) -> None:
+        encoded = {field: json.dumps(value, separators=(",", ":")) for field, value in changes.items()}
+        self._apply(key, encoded, [field for field in removed if field not in encoded], ttl or self.ttl)
+
+    def claim(self, key: str, field: str, value: Any, ttl: Optional[int] = None) -> Any:
+        """Atomically set `field` unless it is already set; returns the value it holds afterwards."""
+        current = self._claim(key, field, json.dumps(value, separators=(",", ":")), ttl or self.ttl)
+        return json.loads(current)
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "entries": None}
+
+    def _load(self, key: str) -> Optional[Record]:
+        raise NotImplementedError
+
+    def _claim(self, key: str, field: str, value: str, ttl: int) -> str:
+        raise NotImplementedError
+
+    def _apply(self, key: str, changes: Record, removed: List[str], ttl: int) -> None:
+        raise NotImplementedError
+
+
+class MemorySessionStore(BaseSessionStore):
+    """In-process LRU store. Only suitable for a single worker process."""
+
+    backend = "memory"
+
+    def __init__(self, ttl: int = 1209600, max_entries: int = 10000) -> None:
+        super().__init__(ttl)
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._records: "OrderedDict[str, Tuple[float, Record]]" = OrderedDict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._records.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"backend": self.backend, "entries": len(self._records)}
+
+    def _load(self, key: str) -> Optional[Record]:
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._records[key]
+                return None
+            self._records.move_to_end(key)
+            return dict(entry[1])
+
+    def _apply(self, key: str, changes: Record, removed: List[str], ttl: int) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._records.pop(key, None)
+            record = dict(entry[1]) if entry is not None and entry[0] > now else {}
+            record.update(changes)
+            for field in removed:
+                record.pop(field, None)
+            if not record:
+                return
+            self._records[key] = (now + ttl, record)
+            while len(self._records) > self._max_entries:
+                self._records.popitem(last=False)
+
+    def _claim(self, key: str, field: str, value: str, ttl: int) -> str:
+        now = time.time()
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None and entry[0] > now and field in entry[1]:
+                return entry[1][field]
+            record = dict(entry[1]) if entry is not None and entry[0] > now else {}
+            record[field] = value
+            self._records.pop(key, None)
+            self._records[key] = (now + ttl, record)
+            return value
+
+
+class SqliteSessionStore(BaseSessionStore):
+    """
+    SQLite-backed store shared by every worker process on the host. Field updates run in an
+    immediate transaction so concurrent writers merge instead of overwriting each other.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str, ttl: int = 1209600) -> None:
+        super().__init__(ttl)
+        self._path = path
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Records hold Spotify refresh tokens in plaintext: keep the file (and its WAL, which
+        # SQLite creates with the same mode) readable by the app's user only.
+        try:
+            Path(path).touch(mode=0o600, exist_ok=True)
+            os.chmod(path, 0o600)
+        except OSError:
+            logger.warning("Could not restrict permissions of session store %s", path)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " key TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires_at)")
+        conn.commit()
+
+    def delete(self, key: str) -> None:
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception("Session delete failed")
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            (count,) = self._conn().execute(
+                "SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)
+            ).fetchone()
+        except sqlite3.Error:
+            count = None
+        return {"backend": self.backend, "entries": count}
+
+    def _load(self, key: str) -> Optional[Record]:
+        row = self._conn().execute(
+            "SELECT data FROM sessions WHERE key = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _apply(self, key: str, changes: Record, removed: List[str], ttl: int) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+            record = json.loads(row[0]) if row is not None else {}
+            record.update(changes)
+            for field in removed:
+                record.pop(field, None)
+            if record:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (key, data, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(record, separators=(",", ":")), now + ttl),
+                )
+            else:
+                conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _claim(self, key: str, field: str, value: str, ttl: int) -> str:
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+            record = json.loads(row[0]) if row is not None else {}
+            if field in record:
+                conn.rollback()
+                return record[field]
+            record[field] = value
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (key, data, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(record, separators=(",", ":")), now + ttl),
+            )
+            conn.commit()
+            return value
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+class RespError(RuntimeError):
+    """Error reply from a Redis-protocol server."""
+
+
+class RespClient:
+    """
+    Minimal RESP2 client (one connection per thread) for the handful of commands the session
+    store needs, so any Redis-protocol server works without an extra dependency.
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0) -> None:
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"Unsupported session store URL {url!r}, expected redis://host:port/db")
+        self._address = (parsed.hostname or "127.0.0.1", parsed.port or 6379)
+        self._password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self._username = urllib.parse.unquote(parsed.username) if parsed.username else None
+        self._db = int(parsed.path.strip("/") or 0)
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def execute(self, *args: Any) -> Any:
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands: List[Tuple[Any, ...]]) -> List[Any]:
+        """Send the commands in one write and read their replies; reconnects once on a dropped socket."""
+        for attempt in (0, 1):
+            try:
+                conn = self._connection()
+                conn.sendall(b"".join(_encode_command(command) for command in commands))
+                replies = [_read_reply(self._local.reader) for _ in commands]
+                break
+            except (OSError, EOFError):
+                self._close()
+                if attempt:
+                    raise
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def _connection(self) -> socket.socket:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        conn = socket.create_connection(self._address, timeout=self._timeout)
+        self._local.conn = conn
+        self._local.reader = conn.makefile("rb")
+        setup: List[Tuple[Any, ...]] = []
+        if self._password is not None:
+            setup.append(("AUTH", self._username, self._password) if self._username else ("AUTH", self._password))
+        if self._db:
+            setup.append(("SELECT", self._db))
+        if setup:
+            conn.sendall(b"".join(_encode_command(command) for command in setup))
+            for _ in setup:
+                reply = _read_reply(self._local.reader)
+                if isinstance(reply, RespError):
+                    self._close()
+                    raise reply
+        return conn
+
+    def _close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+
+def _encode_command(args: Tuple[Any, ...]) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode("ascii")]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+def _read_reply(reader: Any) -> Any:
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise EOFError("connection closed by the session store")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode("utf-8")
+    if kind == b"-":
+        return RespError(body.decode("utf-8", errors="replace"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise EOFError("connection closed by the session store")
+        return data[:-2].decode("utf-8")
+    if kind == b"*":
+        count = int(body)
+        return None if count < 0 else [_read_reply(reader) for _ in range(count)]
+    raise RespError(f"Unexpected reply type {kind!r}")
+
+
+class RedisSessionStore(BaseSessionStore):
+    """Records kept as Redis hashes (one field per session key), shared by every process."""
+
+    backend = "redis"
+
+    def __init__(self, url: str, ttl: int = 1209600, prefix: str = "aria:") -> None:
+        super().__init__(ttl)
+        self._client = RespClient(url)
+        self._prefix = prefix
+
+    def delete(self, key: str) -> None:
+        try:
+            self._client.execute("DEL", self._prefix + key)
+        except (OSError, EOFError, RespError):
+            logger.exception("Session delete failed")
+
+    def _load(self, key: str) -> Optional[Record]:
+        reply = self._client.execute("HGETALL", self._prefix + key)
+        if not reply:
+            return None
+        return dict(zip(reply[::2], reply[1::2]))
+
+    def _apply(self, key: str, changes: Record, removed: List[str], ttl: int) -> None:
+        name = self._prefix + key
+        commands: List[Tuple[Any, ...]] = [("MULTI",)]
+        if changes:
+            commands.append(("HSET", name, *[part for item in changes.items() for part in item]))
+        if removed:
+            commands.append(("HDEL", name, *removed))
+        commands.append(("EXPIRE", name, ttl))
+        commands.append(("EXEC",))
+        self._client.pipeline(commands)
+
+    def _claim(self, key: str, field: str, value: str, ttl: int) -> str:
+        name = self._prefix + key
+        _, _, _, (won, current) = self._client.pipeline(
+            [("MULTI",), ("HSETNX", name, field, value), ("HGET", name, field), ("EXEC",)]
+        )
+        if won:
+            self._client.execute("EXPIRE", name, ttl)
+        return current
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data loaded from a store; only the fields changed during the request are written back."""
+
+    def __init__(self, initial: Optional[Mapping[str, Any]] = None, sid: str = "", new: bool = False) -> None:
+        def on_update(session: "ServerSideSession") -> None:
+            session.modified = True
+            session.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self.previous_sid: Optional[str] = None
+        self._saved = {key: _fingerprint(value) for key, value in (initial or {}).items()}
+
+    def regenerate(self) -> None:
+        """
+        Move the data to a new random id, e.g. once the user authenticated, so an id planted
+        in the browser beforehand never carries tokens. The old record is deleted on save.
+        """
+        if not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+        self._saved = {}
+
+    def changes(self) -> Tuple[Dict[str, Any], List[str]]:
+        """Fields added or changed (including in-place edits) and fields removed since loading."""
+        changed = {key: value for key, value in self.items() if self._saved.get(key) != _fingerprint(value)}
+        removed = [key for key in self._saved if key not in self]
+        return changed, removed
+
+    def mark_saved(self) -> None:
+        self._saved = {key: _fingerprint(value) for key, value in self.items()}
+
+
+def _fingerprint(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Keeps session data in a `BaseSessionStore`; the cookie only carries a random session id,
+    signed with the app's secret key.
+    """
+
+    salt = "aria-session-id"
+
+    def __init__(self, store: BaseSessionStore) -> None:
+        self.store = store
+
+    def open_session(self, app: Flask, request: Request) -> ServerSideSession:
+        return self.load(app, request.cookies.get(self.get_cookie_name(app)))
+
+    def save_session(self, app: Flask, session: ServerSideSession, response: Response) -> None:  # type: ignore[override]
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if session.previous_sid is not None:
+            self.store.delete(session_key(session.previous_sid))
+            session.previous_sid = None
+
+        if not session:
+            if not session.new:
+                self.store.delete(session_key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add("Cookie")
+            return
+
+        self.persist(session)
+        if session.new or self.should_set_cookie(app, session):
+            response.vary.add("Cookie")
+            response.set_cookie(
+                name,
+                self.cookie_value(app, session),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    def load(self, app: Flask, cookie_value: Optional[str]) -> ServerSideSession:
+        """The session named by a cookie value, or a new empty one when it is missing, forged or expired."""
+        sid = self._unsign(app, cookie_value)
+        if sid:
+            try:
+                data = self.store.load(session_key(sid))
+            except Exception:
+                logger.exception("Session load failed")
+                data = None
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def persist(self, session: ServerSideSession) -> bool:
+        """Write the session's changed fields; returns whether anything was written."""
+        changed, removed = session.changes()
+        if not changed and not removed:
+            return False
+        self.store.apply(session_key(session.sid), changed, removed)
+        session.mark_saved()
+        return True
+
+    def cookie_value(self, app: Flask, session: ServerSideSession) -> str:
+        return self._signer(app).sign(session.sid).decode("ascii")
+
+    def _unsign(self, app: Flask, cookie_value: Optional[str]) -> Optional[str]:
+        if not cookie_value or not app.secret_key:
+            return None
+        try:
+            return self._signer(app).unsign(cookie_value).decode("ascii")
+        except BadSignature:
+            return None
+
+    def _signer(self, app: Flask) -> Signer:
+        return Signer(app.secret_key, salt=self.salt, key_derivation="hmac")
+
+
+def regenerate_session(session: Any) -> None:
+    """Give a server-side session a new id; Flask's cookie sessions have none to fix."""
+    if isinstance(session, ServerSideSession):
+        session.regenerate()
+
+
+def create_session_store(settings: SessionSettings) -> Optional[BaseSessionStore]:
+    """`None` for the `cookie` backend, which keeps Flask's signed cookie sessions."""
+    if settings.backend == "cookie":
+        return None
+    if settings.backend == "sqlite":
+        logger.info("Using SQLite session store at %s", settings.path)
+        return SqliteSessionStore(settings.path, ttl=settings.ttl)
+    if settings.backend == "redis":
+        logger.info("Using Redis session store at %s", _redact(settings.redis_url))
+        return RedisSessionStore(settings.redis_url, ttl=settings.ttl)
+    return MemorySessionStore(ttl=settings.ttl, max_entries=settings.max_entries)
+
+
+def _redact(url: str) -> str:
+    parsed = urllib.parse.urlparse(url)
+    if parsed.password is None:
+        return url
+    return parsed._replace(netloc=f"***@{parsed.hostname}:{parsed.port or 6379}").geturl()
@@ -1,20 +1,144 @@
 from __future__ import annotations
 
 import logging
+import threading
+import time
+import re
 import urllib.parse
-from typing import Any, MutableMapping, Optional
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, MutableMapping, Optional, Tuple
 
 import requests
 import spotipy
 from spotipy.exceptions import SpotifyException
 
 from ..config import SpotifySettings
-
-AUTH_URL = "https://accounts.spotify.com/authorize"
-TOKEN_URL = "https://accounts.spotify.com/api/token"
+from .budget import current_budget
+from .hedging import RequestHedger, get_request_hedger
+from .http import get_http_session, get_request_timeout
+from .metrics import SPOTIFY_REQUEST_SECONDS
+from .rate_limit import RateLimiter, get_rate_limiter
+from .tracing import Span, trace_span
+
+# Refresh a little before Spotify's advertised expiry so in-flight agent runs keep a valid token.
+TOKEN_REFRESH_MARGIN = 300
+# Concurrent requests holding the same refresh token reuse a refresh made within this window.
+REFRESH_REUSE_WINDOW = 60
 
 logger = logging.getLogger(__name__)
 
+# Path segments followed by an id; the id is replaced so metric labels stay low-cardinality.
+_ID_COLLECTIONS = {"users", "playlists", "tracks", "albums", "artists", "episodes", "shows"}
+_API_PREFIX = re.compile(r"^https?://[^/]+/v1/")
+
+
+@dataclass
+class _RefreshCall:
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Optional[Dict[str, Any]] = None
+
+
+_refresh_lock = threading.Lock()
+_refresh_inflight: Dict[str, _RefreshCall] = {}
+_recent_refreshes: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
+class SpotifyClient(spotipy.Spotify):
+    """
+    spotipy client bound to the shared pooled HTTP session, the process rate limiter and,
+    when enabled, the request hedger.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        rate_limiter: Optional[RateLimiter] = None,
+        rate_limit_key: Optional[str] = None,
+        hedger: Optional[RequestHedger] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+        self.rate_limit_key = rate_limit_key
+        self.hedger = hedger
+        # Set while a generation is recorded to a cassette (see services.cassette).
+        self.recorder: Any = None
+
+    def _internal_call(self, method, url, payload, params):
+        if self.rate_limiter is None:
+            return self._hedged_call(method, url, payload, params)
+        # spotipy pops keys from `params`, so every attempt gets its own copy.
+        return self.rate_limiter.call(
+            lambda: self._hedged_call(method, url, payload, dict(params)),
+            user_key=self.rate_limit_key,
+        )
+
+    def _hedged_call(self, method, url, payload, params):
+        """One attempt, made after the rate limiter granted it; slow idempotent reads may be hedged."""
+        endpoint = endpoint_label(url)
+        if self.hedger is None or not self.hedger.hedges(method, endpoint):
+            return self._traced_call(method, url, payload, params)
+        return self.hedger.call(
+            endpoint,
+            lambda: self._traced_call(method, url, payload, dict(params)),
+            lambda: self._hedge_call(method, url, payload, dict(params)),
+            user_key=self.rate_limit_key,
+        )
+
+    def _hedge_call(self, method, url, payload, params):
+        """Duplicate of a slow read: the hedger took its rate-limit token, and a 429 is not retried."""
+        try:
+            return self._traced_call(method, url, payload, params)
+        except SpotifyException as exc:
+            if exc.http_status == 429 and self.rate_limiter is not None:
+                self.rate_limiter.note_throttled(exc.headers)
+            raise
+
+    def _traced_call(self, method, url, payload, params):
+        with spotify_request_span(method, endpoint_label(url)) as span:
+            send = super()._internal_call
+            try:
+                if self.recorder is not None:
+                    result = self.recorder.record_spotify(
+                        method, url, payload, params, lambda: send(method, url, payload, params)
+                    )
+                else:
+                    result = send(method, url, payload, params)
+            except SpotifyException as exc:
+                span.set(status=str(exc.http_status))
+                raise
+            span.set(status="200")
+            return result
+
+    def __del__(self) -> None:
+        # spotipy closes its session on garbage collection, which would drop the shared pool.
+        pass
+
+
+def endpoint_label(url: str) -> str:
+    """`https://api.spotify.com/v1/playlists/abc/items` -> `playlists/{id}/items`."""
+    path = _API_PREFIX.sub("", url).split("?", 1)[0].strip("/")
+    segments = path.split("/")
+    for index in range(1, len(segments)):
+        if segments[index - 1] in _ID_COLLECTIONS and segments[index] != "{id}":
+            segments[index] = "{id}"
+    return "/".join(segments)
+
+
+@contextmanager
+def spotify_request_span(method: str, endpoint: str) -> Iterator[Span]:
+    """One HTTP attempt against Spotify; callers set `status` once the response is known."""
+    budget = current_budget()
+    if budget is not None:
+        budget.record_spotify_call()
+    with trace_span("spotify_request", SPOTIFY_REQUEST_SECONDS, endpoint=endpoint, method=method) as span:
+        try:
+            yield span
+        except BaseException:
+            span.attributes.setdefault("status", "error")
+            raise
+
 
 def build_authorize_url(settings: SpotifySettings, state: str | None = None) -> str:
     params = {
@@ -27,22 +151,39 @@ def build_authorize_url(settings: SpotifySettings, state: str | None = None) ->
     if state:
         params["state"] = state
 
-    return f"{AUTH_URL}?{urllib.parse.urlencode(params)}"
+    return f"{settings.authorize_url}?{urllib.parse.urlencode(params)}"
 
 
 def set_session_tokens(
     session_store: MutableMapping[str, Any],
     access_token: str,
     refresh_token: str | None = None,
+    expires_in: int | None = None,
 ) -> None:
     session_store["access_token"] = access_token
     if refresh_token:
         session_store["refresh_token"] = refresh_token
+    if expires_in:
+        session_store["token_expires_at"] = time.time() + int(expires_in)
+    else:
+        session_store.pop("token_expires_at", None)
+
+
+def set_session_profile(session_store: MutableMapping[str, Any], profile: Dict[str, Any]) -> None:
+    session_store["spotify_user_id"] = profile["id"]
+    session_store["spotify_display_name"] = profile.get("display_name") or ""
 
 
 def clear_session_tokens(session_store: MutableMapping[str, Any]) -> None:
     session_store.pop("access_token", None)
     session_store.pop("refresh_token", None)
+    session_store.pop("token_expires_at", None)
+    session_store.pop("spotify_user_id", None)
+    session_store.pop("spotify_display_name", None)
+
+
+def get_session_user_id(session_store: MutableMapping[str, Any]) -> Optional[str]:
+    return session_store.get("spotify_user_id")
 
 
 def exchange_code_for_token(
@@ -50,20 +191,12 @@ def exchange_code_for_token(
     session_store: MutableMapping[str, Any],
     settings: SpotifySettings,
 ) -> None:
-    auth = (settings.client_id, settings.client_secret)
     data = {
         "grant_type": "authorization_code",
         "code": code,
         "redirect_uri": settings.redirect_uri,
     }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    resp = requests.post(
-        TOKEN_URL,
-        data=data,
-        headers=headers,
-        auth=auth,
-        timeout=30,
-    )
+    resp = _post_token_request(settings, data)
     try:
         resp.raise_for_status()
     except requests.HTTPError:
@@ -78,7 +211,12 @@ def exchange_code_for_token(
     access_token = token_json["access_token"]
     refresh_token = token_json.get("refresh_token")
 
-    set_session_tokens(session_store, access_token, refresh_token)
+    set_session_tokens(session_store, access_token, refresh_token, token_json.get("expires_in"))
+    try:
+        _record_profile(session_store, settings=settings)
+    except SpotifyException:
+        # The profile is fetched again on the next request; the login itself succeeded.
+        logger.warning("Could not fetch the Spotify profile after login", exc_info=True)
 
 
 def attempt_refresh_token(
@@ -88,20 +226,60 @@ def attempt_refresh_token(
     refresh_token = session_store.get("refresh_token")
     if not refresh_token:
         return False
-    auth = (settings.client_id, settings.client_secret)
 
+    token_json = _refresh_single_flight(refresh_token, settings)
+    if token_json is None:
+        return False
+
+    new_access_token = token_json["access_token"]
+    new_refresh_token = token_json.get("refresh_token", refresh_token)
+
+    set_session_tokens(session_store, new_access_token, new_refresh_token, token_json.get("expires_in"))
+    return True
+
+
+def _refresh_single_flight(refresh_token: str, settings: SpotifySettings) -> Optional[Dict[str, Any]]:
+    """
+    Only one request per refresh token talks to the accounts service; the others wait for
+    its answer. Spotify may rotate refresh tokens, so a parallel second refresh could fail.
+    """
+    now = time.time()
+    with _refresh_lock:
+        recent = _recent_refreshes.get(refresh_token)
+        if recent is not None and recent[0] > now - REFRESH_REUSE_WINDOW:
+            return recent[1]
+        call = _refresh_inflight.get(refresh_token)
+        leader = call is None
+        if leader:
+            call = _RefreshCall()
+            _refresh_inflight[refresh_token] = call
+
+    if not leader:
+        call.done.wait(timeout=35)
+        return call.result
+
+    result = None
+    try:
+        result = _request_token_refresh(refresh_token, settings)
+    finally:
+        with _refresh_lock:
+            _refresh_inflight.pop(refresh_token, None)
+            cutoff = time.time() - REFRESH_REUSE_WINDOW
+            for key in [key for key, (ts, _) in _recent_refreshes.items() if ts <= cutoff]:
+                _recent_refreshes.pop(key, None)
+            if result is not None:
+                _recent_refreshes[refresh_token] = (time.time(), result)
+        call.result = result
+        call.done.set()
+    return result
+
+
+def _request_token_refresh(refresh_token: str, settings: SpotifySettings) -> Optional[Dict[str, Any]]:
     data = {
         "grant_type": "refresh_token",
         "refresh_token": refresh_token,
     }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    resp = requests.post(
-        TOKEN_URL,
-        data=data,
-        headers=headers,
-        auth=auth,
-        timeout=30,
-    )
+    resp = _post_token_request(settings, data)
 
     if resp.status_code != 200:
         logger.warning(
@@ -109,23 +287,48 @@ def attempt_refresh_token(
             resp.status_code,
             resp.text,
         )
-        return False
+        return None
 
-    token_json = resp.json()
-    new_access_token = token_json["access_token"]
-    new_refresh_token = token_json.get("refresh_token", refresh_token)
+    return resp.json()
 
-    set_session_tokens(session_store, new_access_token, new_refresh_token)
-    return True
+
+def _post_token_request(settings: SpotifySettings, data: Dict[str, str]) -> requests.Response:
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    auth = (settings.client_id, settings.client_secret)
+
+    def post() -> requests.Response:
+        with spotify_request_span("POST", "accounts/token") as span:
+            resp = get_http_session().post(
+                settings.token_url,
+                data=data,
+                headers=headers,
+                auth=auth,
+                timeout=get_request_timeout(),
+            )
+            span.set(status=str(resp.status_code))
+            return resp
+
+    return get_rate_limiter().call(post)
 
 
 def build_spotify_client_from_session(
     session_store: MutableMapping[str, Any],
+    settings: Optional[SpotifySettings] = None,
 ) -> Optional[spotipy.Spotify]:
     access_token = session_store.get("access_token")
     if not access_token:
         return None
-    return spotipy.Spotify(auth=access_token)
+    client = SpotifyClient(
+        auth=access_token,
+        requests_session=get_http_session(),
+        requests_timeout=get_request_timeout(),
+        rate_limiter=get_rate_limiter(),
+        rate_limit_key=session_store.get("spotify_user_id"),
+        hedger=get_request_hedger(),
+    )
+    if settings is not None:
+        client.prefix = settings.api_base
+    return client
 
 
 def ensure_valid_spotify_client(
@@ -134,14 +337,47 @@ def ensure_valid_spotify_client(
 ) -> Optional[spotipy.Spotify]:
     """
     Returns a Spotify client if the session contains a valid token.
-    Attempts a refresh when needed, otherwise clears the session.
+    Tokens are refreshed shortly before their recorded expiry; sessions created before expiry
+    tracking fall back to a /me probe. Otherwise clears the session.
     """
-    client = build_spotify_client_from_session(session_store)
+    if not session_store.get("access_token"):
+        return None
+
+    expires_at = session_store.get("token_expires_at")
+    if expires_at is None:
+        return _probe_spotify_client(session_store, settings)
+
+    if time.time() >= expires_at - TOKEN_REFRESH_MARGIN:
+        logger.info("Spotify token about to expire, refreshing")
+        if not attempt_refresh_token(session_store, settings):
+            clear_session_tokens(session_store)
+            return None
+
+    client = build_spotify_client_from_session(session_store, settings)
+    if client is None:
+        return None
+
+    if not get_session_user_id(session_store):
+        try:
+            _record_profile(session_store, client)
+        except SpotifyException as exc:
+            if exc.http_status != 401:
+                raise
+            clear_session_tokens(session_store)
+            return None
+    return client
+
+
+def _probe_spotify_client(
+    session_store: MutableMapping[str, Any],
+    settings: SpotifySettings,
+) -> Optional[spotipy.Spotify]:
+    client = build_spotify_client_from_session(session_store, settings)
     if client is None:
         return None
 
     try:
-        client.current_user()
+        set_session_profile(session_store, client.current_user())
         return client
     except SpotifyException as exc:
         if exc.http_status != 401:
@@ -152,17 +388,27 @@ def ensure_valid_spotify_client(
             clear_session_tokens(session_store)
             return None
 
-        refreshed_client = build_spotify_client_from_session(session_store)
+        refreshed_client = build_spotify_client_from_session(session_store, settings)
         if refreshed_client is None:
             return None
 
         try:
-            refreshed_client.current_user()
+            set_session_profile(session_store, refreshed_client.current_user())
             return refreshed_client
         except SpotifyException:
             clear_session_tokens(session_store)
             return None
 
 
+def _record_profile(
+    session_store: MutableMapping[str, Any],
+    client: Optional[spotipy.Spotify] = None,
+    settings: Optional[SpotifySettings] = None,
+) -> None:
+    client = client or build_spotify_client_from_session(session_store, settings)
+    if client is not None:
+        set_session_profile(session_store, client.current_user())
+
+
 def is_user_authenticated(session_store: MutableMapping[str, Any]) -> bool:
     return "access_token" in session_store
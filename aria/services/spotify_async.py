@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+from spotipy.exceptions import SpotifyException
+
+from ..config import HttpSettings
+from .hedging import RequestHedger
+from .http import RETRY_METHODS, RETRY_STATUSES
+from .rate_limit import RateLimiter
+from .spotify import endpoint_label, spotify_request_span
+
+API_BASE = "https://api.spotify.com/v1/"
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSpotifyClient:
+    """
+    httpx-based client for the Web API endpoints the agent tools use. Method names and
+    return values mirror spotipy, and failures raise SpotifyException like spotipy does.
+    """
+
+    def __init__(
+        self,
+        access_token: str,
+        http: httpx.AsyncClient,
+        rate_limiter: Optional[RateLimiter] = None,
+        rate_limit_key: Optional[str] = None,
+        hedger: Optional[RequestHedger] = None,
+        api_base: str = API_BASE,
+        retries: int = HttpSettings.retries,
+        backoff_factor: float = HttpSettings.backoff_factor,
+    ) -> None:
+        self._http = http
+        self._headers = {"Authorization": f"Bearer {access_token}"}
+        self.rate_limiter = rate_limiter
+        self.rate_limit_key = rate_limit_key
+        self.hedger = hedger
+        self._api_base = api_base.rstrip("/") + "/"
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+
+    async def current_user(self) -> Dict[str, Any]:
+        return await self._request("GET", "me/")
+
+    async def search(self, q: str, type: str = "track", limit: int = 10, market: str | None = None) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"q": q, "type": type, "limit": limit, "offset": 0}
+        if market:
+            params["market"] = market
+        return await self._request("GET", "search", params=params)
+
+    async def user_playlist_create(
+        self,
+        user: str,
+        name: str,
+        public: bool = True,
+        description: str = "",
+    ) -> Dict[str, Any]:
+        payload = {"name": name, "public": public, "collaborative": False, "description": description}
+        return await self._request("POST", f"users/{user}/playlists", payload=payload)
+
+    async def playlist_add_items(
+        self,
+        playlist_id: str,
+        items: List[str],
+        position: int | None = None,
+    ) -> Dict[str, Any]:
+        params = {"position": position} if position is not None else None
+        return await self._request("POST", f"playlists/{playlist_id}/items", params=params, payload=items)
+
+    async def playlist_change_details(
+        self,
+        playlist_id: str,
+        name: str | None = None,
+        public: bool | None = None,
+        collaborative: bool | None = None,
+        description: str | None = None,
+    ) -> Dict[str, Any]:
+        fields = {"name": name, "public": public, "collaborative": collaborative, "description": description}
+        payload = {key: value for key, value in fields.items() if value is not None}
+        return await self._request("PUT", f"playlists/{playlist_id}", payload=payload)
+
+    async def current_user_unfollow_playlist(self, playlist_id: str) -> Dict[str, Any]:
+        return await self._request("DELETE", f"playlists/{playlist_id}/followers")
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        payload: Any = None,
+    ) -> Dict[str, Any]:
+        if self.rate_limiter is None:
+            return await self._hedged_send(method, path, params, payload)
+        return await self.rate_limiter.call_async(
+            lambda: self._hedged_send(method, path, params, payload),
+            user_key=self.rate_limit_key,
+        )
+
+    async def _hedged_send(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]],
+        payload: Any,
+    ) -> Dict[str, Any]:
+        """One attempt, made after the rate limiter granted it; slow idempotent reads may be hedged."""
+        endpoint = endpoint_label(path)
+        if self.hedger is None or not self.hedger.hedges(method, endpoint):
+            return await self._send(method, path, params, payload)
+        return await self.hedger.call_async(
+            endpoint,
+            lambda: self._send(method, path, params, payload),
+            lambda: self._hedge_send(method, path, params, payload),
+            user_key=self.rate_limit_key,
+        )
+
+    async def _hedge_send(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]],
+        payload: Any,
+    ) -> Dict[str, Any]:
+        """Duplicate of a slow read: the hedger took its rate-limit token, and a 429 is not retried."""
+        try:
+            return await self._send(method, path, params, payload)
+        except SpotifyException as exc:
+            if exc.http_status == 429 and self.rate_limiter is not None:
+                self.rate_limiter.note_throttled(exc.headers)
+            raise
+
+    async def _send(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]],
+        payload: Any,
+    ) -> Dict[str, Any]:
+        url = self._api_base + path
+        endpoint = endpoint_label(path)
+        attempt = 0
+        while True:
+            with spotify_request_span(method, endpoint) as span:
+                response = await self._http.request(method, url, params=params, json=payload, headers=self._headers)
+                span.set(status=str(response.status_code))
+            if (
+                response.status_code in RETRY_STATUSES
+                and method in RETRY_METHODS
+                and attempt < self._retries
+            ):
+                attempt += 1
+                await asyncio.sleep(self._backoff_factor * (2 ** (attempt - 1)))
+                continue
+            break
+
+        if response.is_success:
+            if not response.content:
+                return {}
+            try:
+                return response.json()
+            except ValueError:
+                return {}
+
+        try:
+            error = response.json().get("error", {})
+            msg = error.get("message")
+            reason = error.get("reason")
+        except (ValueError, AttributeError):
+            msg = response.text or None
+            reason = None
+        logger.error("HTTP Error for %s to %s returned %s due to %s", method, url, response.status_code, msg)
+        raise SpotifyException(
+            response.status_code,
+            -1,
+            f"{response.url}:\n {msg}",
+            reason=reason,
+            headers=response.headers,
+        )
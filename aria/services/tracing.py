@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from .metrics import Histogram
+
+logger = logging.getLogger("aria.trace")
+
+SpanListener = Callable[["Span"], None]
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("aria_current_span", default=None)
+_listeners: List[SpanListener] = []
+
+
+class Span:
+    """
+    A timed operation (generation, agent step, model request, tool call, Spotify request).
+    Spans nest through a context variable; finished spans are logged on `aria.trace` at DEBUG,
+    handed to listeners, and observed into `metric` using the span attributes as labels.
+    """
+
+    def __init__(self, name: str, metric: Optional[Histogram] = None, **attributes: Any) -> None:
+        parent = _current_span.get()
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes: Dict[str, Any] = dict(attributes)
+        self.start_time = time.time()
+        self.duration: Optional[float] = None
+        self._started = time.perf_counter()
+        self._metric = metric
+        self._token: Optional[Token] = _current_span.set(self)
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None) -> float:
+        if self.duration is not None:
+            return self.duration
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.attributes.setdefault("error", error.__class__.__name__)
+        self.attributes.setdefault("outcome", "error" if "error" in self.attributes else "ok")
+        if self._token is not None:
+            try:
+                _current_span.reset(self._token)
+            except ValueError:
+                # Ended from another context (e.g. a worker thread); nothing to restore there.
+                pass
+            self._token = None
+
+        if self._metric is not None:
+            labels = {name: self.attributes.get(name, "") for name in self._metric.labelnames}
+            self._metric.observe(self.duration, **labels)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("span %s", json.dumps(self.to_dict(), default=str))
+        for listener in list(_listeners):
+            try:
+                listener(self)
+            except Exception:  # pragma: no cover - defensive
+                logger.exception("Span listener failed")
+        return self.duration
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": round((self.duration or 0.0) * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+def start_span(name: str, metric: Optional[Histogram] = None, **attributes: Any) -> Span:
+    """Open a span that the caller must `end()`; it becomes the parent of spans opened meanwhile."""
+    return Span(name, metric, **attributes)
+
+
+@contextmanager
+def trace_span(name: str, metric: Optional[Histogram] = None, **attributes: Any) -> Iterator[Span]:
+    span = Span(name, metric, **attributes)
+    try:
+        yield span
+    except BaseException as exc:
+        span.end(exc)
+        raise
+    span.end()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def add_span_listener(listener: SpanListener) -> None:
+    _listeners.append(listener)
+
+
+def remove_span_listener(listener: SpanListener) -> None:
+    try:
+        _listeners.remove(listener)
+    except ValueError:
+        pass
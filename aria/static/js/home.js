@@ -1,12 +1,4 @@
-const LOADING_STEPS = [
-    "Building your playlist...",
-    "Picking the tracks...",
-    "Adding songs to Spotify...",
-    "Almost ready..."
-];
-
-let loadingStepIndex = 0;
-let loadingInterval = null;
+const INITIAL_LOADING_MESSAGE = "Building your playlist...";
 
 const DEFAULT_BUTTON_LABEL = "Generate my playlist";
 const CONNECT_BUTTON_LABEL = "Connecting to Spotify...";
@@ -15,6 +7,11 @@ const AUTH_PROMPT_MESSAGE = "Connecting to Spotify...";
 const AUTH_WAIT_MESSAGE = "Authorize Aria in the Spotify window to continue...";
 const AUTH_CONFIRM_BUTTON_LABEL = "Approve the connection in the Spotify window...";
 const FINALISING_MESSAGE = "Aria is digging for gems...";
+// Automatic retries of a generation request refused with 429/503, within this total wait.
+const BUSY_MAX_RETRIES = 3;
+const BUSY_MAX_WAIT_SECONDS = 60;
+const JOB_POLL_INTERVAL_MS = 2000;
+const BUSY_DEFAULT_RETRY_SECONDS = 5;
 const AUTH_PENDING_STORAGE_KEY = "ariaSpotifyAuthPending";
 const AUTH_RESULT_STORAGE_KEY = "ariaSpotifyAuthResult";
 
@@ -146,41 +143,19 @@ function updateResultCard(agentResult) {
     }
 }
 
-function stopOverlayCycling() {
-    if (loadingInterval) {
-        clearInterval(loadingInterval);
-        loadingInterval = null;
-    }
-}
-
 function setOverlayMessage(message) {
     loaderStepEl.textContent = message;
 }
 
 function showOverlay(options = {}) {
-    const { message = null, cycling = true } = options;
+    const { message = null } = options;
 
     overlayEl.classList.add('active');
-    stopOverlayCycling();
-
-    if (message) {
-        loaderStepEl.textContent = message;
-    } else {
-        loaderStepEl.textContent = LOADING_STEPS[0];
-    }
-
-    if (cycling) {
-        loadingStepIndex = 0;
-        loadingInterval = setInterval(() => {
-            loadingStepIndex = (loadingStepIndex + 1) % LOADING_STEPS.length;
-            loaderStepEl.textContent = LOADING_STEPS[loadingStepIndex];
-        }, 10000);
-    }
+    loaderStepEl.textContent = message || INITIAL_LOADING_MESSAGE;
 }
 
 function hideOverlay() {
     overlayEl.classList.remove('active');
-    stopOverlayCycling();
 }
 
 function lockButton(label = GENERATING_BUTTON_LABEL) {
@@ -320,21 +295,188 @@ function waitForAuthCompletion(authUrl) {
 function buildPromptFormData(promptVal) {
     const formData = new FormData();
     formData.append('prompt', promptVal);
+    const freshEl = document.getElementById('fresh');
+    if (freshEl && freshEl.checked) {
+        formData.append('fresh', '1');
+    }
     return formData;
 }
 
 async function makeGenerateRequest(promptVal) {
-    try {
-        return await fetch('/generate_async', {
-            method: 'POST',
-            body: buildPromptFormData(promptVal),
-        });
-    } catch (networkErr) {
-        throw {
-            code: 'network',
-            message: "Connection lost during generation.",
+    return await fetchWithAdmission(async () => {
+        try {
+            return await fetch('/generate_async', {
+                method: 'POST',
+                body: buildPromptFormData(promptVal),
+            });
+        } catch (networkErr) {
+            throw {
+                code: 'network',
+                message: "Connection lost during generation.",
+            };
+        }
+    });
+}
+
+function retryAfterSeconds(res) {
+    const seconds = parseInt(res.headers.get('Retry-After') || "", 10);
+    return Number.isFinite(seconds) && seconds > 0 ? seconds : BUSY_DEFAULT_RETRY_SECONDS;
+}
+
+function sleep(ms) {
+    return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+// Retries a request the server shed (429: generations already running for this session,
+// 503: Aria is saturated) after its Retry-After, then gives up with a 'busy' error.
+async function fetchWithAdmission(doFetch) {
+    let waited = 0;
+    for (let attempt = 0; ; attempt++) {
+        const res = await doFetch();
+        if (res.status !== 429 && res.status !== 503) {
+            return res;
+        }
+        const delay = retryAfterSeconds(res);
+        if (attempt >= BUSY_MAX_RETRIES || waited + delay > BUSY_MAX_WAIT_SECONDS) {
+            throw {
+                code: 'busy',
+                message: res.status === 429
+                    ? "You already have playlists being generated. Wait for them to finish and try again."
+                    : `Aria is very busy right now. Try again in about ${delay} seconds.`,
+            };
+        }
+        for (let remaining = delay; remaining > 0; remaining--) {
+            setOverlayMessage(`Aria is busy, retrying in ${remaining}s...`);
+            await sleep(1000);
+        }
+        waited += delay;
+    }
+}
+
+function describeProgress(eventType, data) {
+    if (eventType === "cache_hit") {
+        return "Found a matching playlist, rebuilding it...";
+    }
+    if (eventType === "step_started") {
+        return data.step > 1 ? "Picking the tracks..." : INITIAL_LOADING_MESSAGE;
+    }
+    if (eventType === "tool_requested") {
+        if (data.name === "search_items" || data.name === "search_many") {
+            return "Searching Spotify...";
+        }
+        if (data.name === "add_tracks") {
+            return "Adding songs to Spotify...";
+        }
+        return null;
+    }
+    if (eventType === "playlist_created") {
+        return data.name ? `Playlist "${data.name}" created, filling it up...` : "Playlist created, filling it up...";
+    }
+    if (eventType === "playlist_updated") {
+        return data.name ? `Naming it "${data.name}"...` : null;
+    }
+    if (eventType === "text_delta" || eventType === "summary") {
+        return "Almost ready...";
+    }
+    return null;
+}
+
+async function fetchJobResult(statusUrl) {
+    const res = await fetch(statusUrl, {
+        headers: {
+            'Accept': 'application/json',
+        },
+    });
+    if (!res.ok) {
+        throw new Error("Job status unavailable");
+    }
+    const job = await res.json();
+    if (job.status === "succeeded") {
+        return job.result;
+    }
+    if (job.status === "failed") {
+        throw new Error(job.error || "Generation failed");
+    }
+    return null;
+}
+
+// Used when the progress stream is refused (the server caps open streams) or drops for good.
+async function pollJob(statusUrl) {
+    for (;;) {
+        const result = await fetchJobResult(statusUrl);
+        if (result) {
+            return result;
+        }
+        await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+}
+
+function streamJob(job) {
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(job.stream_url);
+        let settled = false;
+
+        const finish = (callback, value) => {
+            if (settled) {
+                return;
+            }
+            settled = true;
+            source.close();
+            callback(value);
         };
+
+        const onProgress = (event) => {
+            let data = {};
+            try {
+                data = JSON.parse(event.data);
+            } catch (parseErr) {
+                console.warn("Unreadable progress event", parseErr);
+            }
+            const message = describeProgress(event.type, data);
+            if (message) {
+                setOverlayMessage(message);
+            }
+        };
+
+        ["cache_hit", "step_started", "tool_requested", "tool_finished", "playlist_created", "playlist_updated", "text_delta", "summary"].forEach((eventType) => {
+            source.addEventListener(eventType, onProgress);
+        });
+
+        source.addEventListener("done", (event) => {
+            finish(resolve, JSON.parse(event.data));
+        });
+
+        source.addEventListener("failed", (event) => {
+            let message = "Generation failed";
+            try {
+                message = JSON.parse(event.data).error || message;
+            } catch (parseErr) {
+                console.warn("Unreadable failure event", parseErr);
+            }
+            finish(reject, new Error(message));
+        });
+
+        source.addEventListener("error", () => {
+            if (source.readyState !== EventSource.CLOSED) {
+                return; // the browser reconnects on its own and resumes from the last event id
+            }
+            source.close();
+            pollJob(job.status_url)
+                .then((result) => finish(resolve, result))
+                .catch((err) => finish(reject, err));
+        });
+    });
+}
+
+async function readGenerationResponse(res) {
+    if (res.status === 202) {
+        const job = await res.json();
+        if (job.status === "queued" && job.estimated_wait_seconds >= 1) {
+            setOverlayMessage(`Waiting for a free spot (about ${Math.ceil(job.estimated_wait_seconds)}s)...`);
+        }
+        return await streamJob(job);
     }
+    return await res.json();
 }
 
 async function fetchLatestResult() {
@@ -362,15 +504,15 @@ async function fetchLatestResult() {
 
 async function finishPendingGeneration() {
     lockButton(GENERATING_BUTTON_LABEL);
-    showOverlay({ message: FINALISING_MESSAGE, cycling: true });
+    showOverlay({ message: FINALISING_MESSAGE });
 
     try {
-        const res = await fetch('/finish_generation', {
+        const res = await fetchWithAdmission(() => fetch('/finish_generation', {
             method: 'POST',
             headers: {
                 'Accept': 'application/json',
             },
-        });
+        }));
 
         if (res.status === 400) {
             window.ARIA_PENDING_PROMPT = "";
@@ -392,17 +534,22 @@ async function finishPendingGeneration() {
             throw new Error("Server error");
         }
 
-        let data = null;
-        try {
-            data = await res.json();
-        } catch (jsonErr) {
-            console.error("finish_generation response parse failed", jsonErr);
-        }
-        if (!data || data.ok !== true) {
-            throw new Error("Invalid server response");
+        let agentResult = null;
+        if (res.status === 202) {
+            agentResult = await readGenerationResponse(res);
+        } else {
+            let data = null;
+            try {
+                data = await res.json();
+            } catch (jsonErr) {
+                console.error("finish_generation response parse failed", jsonErr);
+            }
+            if (!data || data.ok !== true) {
+                throw new Error("Invalid server response");
+            }
+            agentResult = data.result || null;
         }
 
-        const agentResult = data.result || null;
         if (agentResult) {
             updateResultCard(agentResult);
         }
@@ -433,6 +580,8 @@ async function resumePendingGenerationIfNeeded() {
         console.error("Failed to resume pending generation", err);
         if (err && err.code === 'auth_error') {
             alert(err.message || "Spotify connection expired. Please generate again.");
+        } else if (err && err.code === 'busy') {
+            alert(err.message);
         } else {
             alert("We connected to Spotify, but finishing your playlist failed. Please click Generate again.");
         }
@@ -440,7 +589,6 @@ async function resumePendingGenerationIfNeeded() {
 }
 
 async function runAuthFlow(authUrl, promptVal) {
-    stopOverlayCycling();
     setOverlayMessage(AUTH_WAIT_MESSAGE);
     btnEl.textContent = AUTH_CONFIRM_BUTTON_LABEL;
 
@@ -462,7 +610,7 @@ async function runAuthFlow(authUrl, promptVal) {
         throw new Error("Server error");
     }
 
-    return await res.json();
+    return await readGenerationResponse(res);
 }
 
 async function handleSubmit(e) {
@@ -480,8 +628,7 @@ async function handleSubmit(e) {
 
     lockButton(wasConnected ? GENERATING_BUTTON_LABEL : CONNECT_BUTTON_LABEL);
     showOverlay({
-        message: wasConnected ? LOADING_STEPS[0] : AUTH_PROMPT_MESSAGE,
-        cycling: wasConnected,
+        message: wasConnected ? INITIAL_LOADING_MESSAGE : AUTH_PROMPT_MESSAGE,
     });
 
     try {
@@ -510,7 +657,7 @@ async function handleSubmit(e) {
             throw new Error("Server error");
         }
 
-        const data = await res.json();
+        const data = await readGenerationResponse(res);
         updateResultCard(data);
     } catch (err) {
         console.error(err);
@@ -518,7 +665,7 @@ async function handleSubmit(e) {
             alert("Spotify sign-in was cancelled before approval.");
         } else if (err && err.code === 'auth_error') {
             alert(err.message || "Could not finish connecting to Spotify. Try again.");
-        } else if (err && err.code === 'network') {
+        } else if (err && (err.code === 'network' || err.code === 'busy')) {
             alert(err.message || "Connection lost during generation. Check your connection and try again.");
         } else if (err && err.code === 'navigation') {
             // the tab was redirected to Spotify, nothing else to do here
@@ -0,0 +1,639 @@
+"""
+Local stand-ins for the Spotify Web API, the Spotify accounts service, the OpenAI
+Responses API and a Redis server, so generations can be benchmarked without network
+access or credentials.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+_PLAYLIST_PATH_RE = re.compile(r"^/v1/users/([^/]+)/playlists$")
+_PLAYLIST_ITEMS_RE = re.compile(r"^/v1/playlists/([^/]+)/(?:items|tracks)$")
+_PLAYLIST_RE = re.compile(r"^/v1/playlists/([^/]+)$")
+_PLAYLIST_FOLLOWERS_RE = re.compile(r"^/v1/playlists/([^/]+)/followers$")
+_HANDLE_RE = re.compile(r"^t\d+$")
+
+
+@dataclass
+class Latency:
+    """Fixed delay plus uniform jitter, in milliseconds, and an optional slow tail."""
+
+    base_ms: float = 0.0
+    jitter_ms: float = 0.0
+    # Share of requests delayed by `tail_ms` more.
+    tail_rate: float = 0.0
+    tail_ms: float = 0.0
+
+    def sleep(self) -> None:
+        delay = self.base_ms + (random.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+        if self.tail_rate and random.random() < self.tail_rate:
+            delay += self.tail_ms
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        """`"80"`, `"80+40"` (base plus jitter) or `"80+40@0.02:2000"` (2% of requests 2000 ms slower)."""
+        spec, _, tail = spec.partition("@")
+        base, _, jitter = spec.partition("+")
+        rate, _, tail_ms = tail.partition(":")
+        return cls(float(base or 0), float(jitter or 0), float(rate or 0), float(tail_ms or 0))
+
+
+@dataclass
+class ModelScript:
+    """
+    Scripted tool-calling behaviour of the fake model. Step 1 creates the playlist and runs
+    the first searches, the next `search_rounds - 1` steps search again, then one step adds
+    `tracks_per_playlist` tracks and a last step writes the summary. With `create_alone`,
+    create_playlist gets a step of its own first, as models often do. When the request
+    offers name_playlist instead of create_playlist (speculative creation), step 1 names
+    the prepared playlist alongside its searches.
+    """
+
+    search_rounds: int = 1
+    create_alone: bool = False
+    queries_per_round: int = 3
+    batch_searches: bool = True
+    tracks_per_playlist: int = 20
+    summary_words: int = 40
+
+
+class _CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self, handler: type, latency: Latency) -> None:
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.counts: Counter = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] += 1
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.counts.clear()
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: _CountingServer
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002 - stdlib signature
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeSpotifyServer(_CountingServer):
+    """Serves /v1/me, /v1/search, playlist creation, renaming, deletion and item insertion."""
+
+    def __init__(self, latency: Latency, throttle_rate: float = 0.0, retry_after: int = 1) -> None:
+        super().__init__(_SpotifyHandler, latency)
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+
+
+class _SpotifyHandler(_JsonHandler):
+    server: FakeSpotifyServer
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if self._throttled():
+            return
+        self.server.latency.sleep()
+        if url.path.rstrip("/") == "/v1/me":
+            self.server.count("me")
+            # One simulated user per access token, so per-user rate limits apply as in production.
+            token = self.headers.get("Authorization", "")
+            user_id = "bench-" + hashlib.sha1(token.encode("utf-8")).hexdigest()[:12]
+            self._json(200, {"id": user_id, "display_name": user_id})
+        elif url.path == "/v1/search":
+            self.server.count("search")
+            params = parse_qs(url.query)
+            query = params.get("q", [""])[0]
+            types = params.get("type", ["track"])[0].split(",")
+            limit = int(params.get("limit", ["10"])[0])
+            self._json(200, fake_search_results(query, types, limit))
+        else:
+            self._json(404, {"error": {"status": 404, "message": "not found"}})
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        body = self._body()
+        if self._throttled():
+            return
+        self.server.latency.sleep()
+        if _PLAYLIST_PATH_RE.match(url.path):
+            self.server.count("create_playlist")
+            payload = json.loads(body or b"{}")
+            playlist_id = uuid.uuid4().hex[:22]
+            self._json(201, {
+                "id": playlist_id,
+                "name": payload.get("name", ""),
+                "description": payload.get("description", ""),
+                "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"},
+            })
+        elif _PLAYLIST_ITEMS_RE.match(url.path):
+            self.server.count("add_items")
+            self._json(201, {"snapshot_id": uuid.uuid4().hex})
+        else:
+            self._json(404, {"error": {"status": 404, "message": "not found"}})
+
+    def do_PUT(self) -> None:
+        url = urlparse(self.path)
+        self._body()
+        if self._throttled():
+            return
+        self.server.latency.sleep()
+        if _PLAYLIST_RE.match(url.path):
+            self.server.count("change_playlist")
+            self._json(200, {})
+        else:
+            self._json(404, {"error": {"status": 404, "message": "not found"}})
+
+    def do_DELETE(self) -> None:
+        url = urlparse(self.path)
+        self._body()
+        if self._throttled():
+            return
+        self.server.latency.sleep()
+        if _PLAYLIST_FOLLOWERS_RE.match(url.path):
+            self.server.count("delete_playlist")
+            self._json(200, {})
+        else:
+            self._json(404, {"error": {"status": 404, "message": "not found"}})
+
+    def _throttled(self) -> bool:
+        if self.server.throttle_rate and random.random() < self.server.throttle_rate:
+            self.server.count("throttled")
+            self._json(
+                429,
+                {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                {"Retry-After": str(self.server.retry_after)},
+            )
+            return True
+        return False
+
+
+class FakeAccountsServer(_CountingServer):
+    """Serves the OAuth token endpoint for both the code exchange and refresh grants."""
+
+    def __init__(self, latency: Latency, expires_in: int = 3600) -> None:
+        super().__init__(_AccountsHandler, latency)
+        self.expires_in = expires_in
+
+
+class _AccountsHandler(_JsonHandler):
+    server: FakeAccountsServer
+
+    def do_POST(self) -> None:
+        form = parse_qs(self._body().decode("utf-8"))
+        self.server.latency.sleep()
+        if urlparse(self.path).path != "/api/token":
+            self._json(404, {"error": "not_found"})
+            return
+        grant = form.get("grant_type", [""])[0]
+        self.server.count(grant or "unknown_grant")
+        payload = {
+            "access_token": "bench-" + uuid.uuid4().hex,
+            "token_type": "Bearer",
+            "expires_in": self.server.expires_in,
+            "scope": "playlist-modify-public playlist-modify-private",
+        }
+        if grant == "authorization_code":
+            payload["refresh_token"] = "bench-refresh-" + uuid.uuid4().hex
+        self._json(200, payload)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """
+    In-memory server speaking the Redis protocol for the commands the session store uses:
+    PING, AUTH, SELECT, HGETALL, HGET, HSET, HSETNX, HDEL, EXPIRE, DEL and MULTI/EXEC.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _RedisHandler)
+        self.lock = threading.Lock()
+        self.hashes: Dict[str, Dict[str, str]] = {}
+        self.expires: Dict[str, float] = {}
+        self.counts: Counter = Counter()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.counts.clear()
+
+    def execute(self, args: List[str]) -> Any:
+        name = args[0].upper()
+        with self.lock:
+            self.counts[name.lower()] += 1
+            key = args[1] if len(args) > 1 else ""
+            if key and self.expires.get(key, float("inf")) <= time.time():
+                self.hashes.pop(key, None)
+                self.expires.pop(key, None)
+            if name in ("PING", "AUTH", "SELECT"):
+                return "+OK" if name != "PING" else "+PONG"
+            if name == "HGETALL":
+                return [part for item in self.hashes.get(key, {}).items() for part in item]
+            if name == "HGET":
+                return self.hashes.get(key, {}).get(args[2])
+            if name == "HSETNX":
+                fields = self.hashes.setdefault(key, {})
+                if args[2] in fields:
+                    return 0
+                fields[args[2]] = args[3]
+                return 1
+            if name == "HSET":
+                fields = self.hashes.setdefault(key, {})
+                added = sum(1 for field in args[2::2] if field not in fields)
+                fields.update(zip(args[2::2], args[3::2]))
+                return added
+            if name == "HDEL":
+                fields = self.hashes.get(key, {})
+                removed = sum(1 for field in args[2:] if fields.pop(field, None) is not None)
+                if key in self.hashes and not fields:
+                    del self.hashes[key]
+                    self.expires.pop(key, None)
+                return removed
+            if name == "EXPIRE":
+                if key not in self.hashes:
+                    return 0
+                self.expires[key] = time.time() + int(args[2])
+                return 1
+            if name == "DEL":
+                self.expires.pop(key, None)
+                return 1 if self.hashes.pop(key, None) is not None else 0
+        return ValueError(f"ERR unknown command '{name}'")
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+    server: FakeRedisServer
+
+    def handle(self) -> None:
+        queued: Optional[List[List[str]]] = None
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            name = args[0].upper()
+            if name == "MULTI":
+                queued = []
+                self._write("+OK")
+            elif name == "EXEC" and queued is not None:
+                self._write([self.server.execute(command) for command in queued])
+                queued = None
+            elif queued is not None:
+                queued.append(args)
+                self._write("+QUEUED")
+            else:
+                self._write(self.server.execute(args))
+
+    def _read_command(self) -> Optional[List[str]]:
+        line = self.rfile.readline()
+        if not line.startswith(b"*"):
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def _write(self, reply: Any) -> None:
+        self.wfile.write(_encode_reply(reply))
+
+
+def _encode_reply(reply: Any) -> bytes:
+    if isinstance(reply, ValueError):
+        return f"-{reply}\r\n".encode("utf-8")
+    if isinstance(reply, str) and reply[:1] == "+":
+        return reply.encode("utf-8") + b"\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(
+            _encode_reply(item) if not isinstance(item, str) else _bulk(item) for item in reply
+        )
+    return _bulk(reply)
+
+
+def _bulk(value: Optional[str]) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    data = value.encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+@dataclass
+class _Conversation:
+    prompt: str = ""
+    playlist_id: str = ""
+    tracks: List[str] = field(default_factory=list)
+    input_bytes: int = 0
+
+
+class FakeOpenAIServer(_CountingServer):
+    """
+    Serves POST /v1/responses, streamed or not, following a ModelScript. Conversations are
+    remembered by response id so chained requests (previous_response_id) work like the API.
+    Requests for `fast_model` are answered after `fast_latency` instead.
+    """
+
+    def __init__(
+        self,
+        latency: Latency,
+        script: ModelScript,
+        stream_chunk_delay_ms: float = 0.0,
+        fast_model: Optional[str] = None,
+        fast_latency: Optional[Latency] = None,
+    ) -> None:
+        super().__init__(_OpenAIHandler, latency)
+        self.script = script
+        self.stream_chunk_delay_ms = stream_chunk_delay_ms
+        self.fast_model = fast_model
+        self.fast_latency = fast_latency
+        self._conversations: Dict[str, _Conversation] = {}
+        self.usage: Counter = Counter()
+
+    def respond(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        items = request.get("input") or []
+        if isinstance(items, str):
+            items = [{"role": "user", "content": items}]
+        request_bytes = len(json.dumps(items))
+
+        previous = request.get("previous_response_id")
+        with self.lock:
+            if previous and previous not in self._conversations:
+                return {"error": {"message": f"Previous response with id '{previous}' not found.", "type": "invalid_request_error"}}
+            base = self._conversations.get(previous) if previous else None
+        conversation = _Conversation(
+            prompt=base.prompt if base else _first_user_text(items),
+            playlist_id=base.playlist_id if base else "",
+            tracks=list(base.tracks) if base else [],
+            input_bytes=(base.input_bytes if base else 0) + request_bytes,
+        )
+
+        # A chained request carries the last step's outputs, a full replay carries all of them.
+        outputs = [item for item in items if isinstance(item, dict) and item.get("type") == "function_call_output"]
+        step = 1 + max((_step_of(item.get("call_id", "")) for item in outputs), default=0)
+        for item in outputs:
+            _collect_outputs(item.get("output", ""), conversation)
+
+        tool_names = {tool.get("name") for tool in request.get("tools") or [] if isinstance(tool, dict)}
+        speculative = "name_playlist" in tool_names
+        output = self._script_step(step, conversation.prompt or "benchmark", conversation, speculative)
+
+        response_id = "resp_" + uuid.uuid4().hex
+        with self.lock:
+            self._conversations[response_id] = conversation
+            self.usage["input_tokens"] += conversation.input_bytes // 4
+            self.usage["cached_tokens"] += (conversation.input_bytes - request_bytes) // 4
+        return {
+            "id": response_id,
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": request.get("model", "fake-model"),
+            "status": "completed",
+            "output": output,
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": conversation.input_bytes // 4,
+                "input_tokens_details": {"cached_tokens": (conversation.input_bytes - request_bytes) // 4},
+                "output_tokens": len(json.dumps(output)) // 4,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": (conversation.input_bytes + len(json.dumps(output))) // 4,
+            },
+        }
+
+    def _script_step(
+        self,
+        step: int,
+        prompt: str,
+        conversation: _Conversation,
+        speculative: bool = False,
+    ) -> List[Dict[str, Any]]:
+        script = self.script
+        words = [w for w in re.findall(r"\w+", prompt.lower()) if len(w) > 2] or ["music"]
+        calls: List[Tuple[str, Dict[str, Any]]] = []
+        details = {"name": f"Bench {words[0]}", "description": prompt[:200]}
+        # Playlist-only first step, shifting the searches by one.
+        offset = 1 if script.create_alone and not speculative else 0
+
+        if offset and step == 1:
+            calls.append(("create_playlist", dict(details, public=True)))
+        elif step - offset <= script.search_rounds:
+            if step == 1:
+                if speculative:
+                    calls.append(("name_playlist", details))
+                else:
+                    calls.append(("create_playlist", dict(details, public=True)))
+            queries = [
+                {"query": f"{words[(step + i) % len(words)]} {i}", "item_types": ["track"], "limit": 10}
+                for i in range(script.queries_per_round)
+            ]
+            if script.batch_searches:
+                calls.append(("search_many", {"queries": queries}))
+            else:
+                calls.extend(("search_items", query) for query in queries)
+        elif step - offset == script.search_rounds + 1:
+            calls.append(("add_tracks", {
+                "playlist_id": "current" if speculative else conversation.playlist_id,
+                "uris": conversation.tracks[: script.tracks_per_playlist],
+                "position": None,
+            }))
+        else:
+            text = " ".join(random.choice(words) for _ in range(script.summary_words))
+            return [{
+                "type": "message",
+                "id": "msg_" + uuid.uuid4().hex,
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }]
+
+        return [
+            {
+                "type": "function_call",
+                "id": "fc_" + uuid.uuid4().hex,
+                "call_id": f"call_{step}_{index}_{uuid.uuid4().hex[:8]}",
+                "name": name,
+                "arguments": json.dumps(args),
+                "status": "completed",
+            }
+            for index, (name, args) in enumerate(calls)
+        ]
+
+
+class _OpenAIHandler(_JsonHandler):
+    server: FakeOpenAIServer
+
+    def do_POST(self) -> None:
+        request = json.loads(self._body() or b"{}")
+        if urlparse(self.path).path != "/v1/responses":
+            self._json(404, {"error": {"message": "not found"}})
+            return
+        self.server.count("responses")
+        if self.server.fast_model and request.get("model") == self.server.fast_model:
+            self.server.count("fast_responses")
+            (self.server.fast_latency or self.server.latency).sleep()
+        else:
+            self.server.latency.sleep()
+        response = self.server.respond(request)
+        if "error" in response:
+            self._json(400, response)
+        elif request.get("stream"):
+            self._stream(response)
+        else:
+            self._json(200, response)
+
+    def _stream(self, response: Dict[str, Any]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        sequence = 0
+
+        def send(event: Dict[str, Any]) -> None:
+            nonlocal sequence
+            event["sequence_number"] = sequence
+            sequence += 1
+            self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        in_progress = dict(response, status="in_progress", output=[])
+        send({"type": "response.created", "response": in_progress})
+        for index, item in enumerate(response["output"]):
+            if self.server.stream_chunk_delay_ms:
+                time.sleep(self.server.stream_chunk_delay_ms / 1000)
+            if item["type"] == "message":
+                for word in item["content"][0]["text"].split():
+                    send({
+                        "type": "response.output_text.delta",
+                        "item_id": item["id"],
+                        "output_index": index,
+                        "content_index": 0,
+                        "delta": word + " ",
+                        "logprobs": [],
+                    })
+            send({"type": "response.output_item.done", "output_index": index, "item": item})
+        send({"type": "response.completed", "response": response})
+
+
+def _step_of(call_id: str) -> int:
+    parts = call_id.split("_")
+    if len(parts) >= 2 and parts[0] == "call" and parts[1].isdigit():
+        return int(parts[1])
+    return 0
+
+
+def _collect_outputs(raw_output: str, conversation: _Conversation) -> None:
+    """Remember the created playlist and every track reference returned by a search."""
+    try:
+        output = json.loads(raw_output or "{}")
+    except ValueError:
+        return
+    if not isinstance(output, dict):
+        return
+    if "url" in output and "id" in output:
+        conversation.playlist_id = output["id"]
+        return
+    table = output.get("tracks")
+    if isinstance(table, str):
+        refs = [line.split("|", 1)[0] for line in table.splitlines()[1:]]
+        refs = [ref for ref in refs if _HANDLE_RE.match(ref)]
+    elif isinstance(table, list):
+        refs = [track.get("uri") for track in table if isinstance(track, dict) and track.get("uri")]
+    else:
+        return
+    for ref in refs:
+        if ref not in conversation.tracks:
+            conversation.tracks.append(ref)
+
+
+def _first_user_text(items: List[Any]) -> str:
+    for item in items:
+        if isinstance(item, dict) and item.get("role") == "user":
+            content = item.get("content")
+            if isinstance(content, str):
+                return content
+    return ""
+
+
+def fake_search_results(query: str, types: List[str], limit: int) -> Dict[str, Any]:
+    """Deterministic search payload: the same query always returns the same items."""
+    limit = max(1, min(int(limit), 50))
+    results: Dict[str, Any] = {}
+    for kind in types:
+        items = []
+        for index in range(limit):
+            digest = hashlib.sha1(f"{kind}:{query}:{index}".encode("utf-8")).hexdigest()
+            item_id = _base62(int(digest, 16))[:22].rjust(22, "0")
+            name = f"{query.title()} {index + 1}"
+            if kind == "track":
+                items.append({
+                    "id": item_id,
+                    "uri": f"spotify:track:{item_id}",
+                    "name": name,
+                    "artists": [{"name": f"Artist {digest[:4]}"}],
+                    "album": {"name": f"Album {digest[4:8]}"},
+                })
+            elif kind == "artist":
+                items.append({"id": item_id, "name": f"Artist {digest[:4]}", "genres": ["bench", query.split()[0] if query else "pop"]})
+            elif kind == "album":
+                items.append({"id": item_id, "name": f"Album {digest[4:8]}", "artists": [{"name": f"Artist {digest[:4]}"}]})
+        results[kind + "s"] = {"items": items, "limit": limit, "offset": 0, "total": limit}
+    return results
+
+
+def _base62(value: int) -> str:
+    alphabet = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    out = []
+    while value:
+        value, rem = divmod(value, 62)
+        out.append(alphabet[rem])
+    return "".join(out) or "0"
@@ -0,0 +1,166 @@
+"""
+Replay recorded generations offline. Cassettes are written by the app when CASSETTE_DIR is set
+(or by `python -m benchmarks.run --record DIR`); each replay runs `run_agent_for_user` against
+the recorded model outputs and Spotify responses, and reports where every agent step spent its
+time:
+
+    python -m benchmarks.replay cassettes/*.json.gz
+    python -m benchmarks.replay run.json.gz --latency zero --repeat 20
+    python -m benchmarks.replay run.json.gz --latency 0.5 --json profile.json
+
+Latency:
+    real    sleep for each call's recorded duration (and stream events at their offsets)
+    zero    no waits: only the app's own CPU and serialisation work remains
+    <x>     recorded durations scaled by x
+
+Per step: wall and process CPU time, serialisation (request encoding, response and event
+parsing, Spotify JSON decoding), simulated model and Spotify waits, and call counts. Exits
+with status 1 when a replay fails or asks for a call the cassette does not hold.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from aria.agent import run_agent_for_user
+from aria.services.cassette import CassettePlayer, load_cassette, replay_clients, replay_options
+
+PROFILE_FIELDS = (
+    "wall_seconds",
+    "cpu_seconds",
+    "serialise_seconds",
+    "model_wait_seconds",
+    "spotify_wait_seconds",
+)
+
+
+def replay(cassette: Dict[str, Any], time_scale: float) -> Dict[str, Any]:
+    """Run one replay of `cassette` and return its report."""
+    player = CassettePlayer(cassette, time_scale)
+    started_wall, started_cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        run_agent_for_user(**replay_clients(player), **replay_options(cassette))
+    except Exception as exc:
+        error = f"{exc.__class__.__name__}: {exc}"
+    steps = player.profiler.finish()
+    return {
+        "wall_seconds": round(time.perf_counter() - started_wall, 6),
+        "cpu_seconds": round(time.process_time() - started_cpu, 6),
+        "error": error,
+        "misses": player.misses,
+        "mismatches": player.mismatches,
+        "unused": player.unused(),
+        "steps": [step.to_dict() for step in steps],
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parse_args(argv)
+    if not args.verbose:
+        logging.basicConfig(level=logging.WARNING)
+        logging.getLogger("aria").setLevel(logging.WARNING)
+    time_scale = _time_scale(args.latency)
+
+    results = []
+    failed = False
+    for path in args.cassettes:
+        cassette = load_cassette(path)
+        runs = [replay(cassette, time_scale) for _ in range(max(1, args.repeat))]
+        failed = failed or any(run["error"] or run["misses"] for run in runs)
+        result = {
+            "cassette": path,
+            "prompt": cassette["prompt"],
+            "recorded_seconds": cassette["duration"],
+            "recorded_outcome": cassette["outcome"],
+            "runs": runs,
+        }
+        results.append(result)
+        _print_result(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+    return 1 if failed else 0
+
+
+def _time_scale(latency: str) -> float:
+    if latency == "real":
+        return 1.0
+    if latency == "zero":
+        return 0.0
+    try:
+        scale = float(latency)
+    except ValueError:
+        raise SystemExit(f"--latency must be real, zero or a number, got {latency!r}")
+    if scale < 0:
+        raise SystemExit(f"--latency must be >= 0, got {scale}")
+    return scale
+
+
+def _print_result(result: Dict[str, Any]) -> None:
+    runs = result["runs"]
+    print(f"cassette       {result['cassette']}")
+    print(f"prompt         {result['prompt']}")
+    print(f"recorded       {result['recorded_seconds']:.2f}s ({result['recorded_outcome']})")
+    walls = [run["wall_seconds"] for run in runs]
+    cpus = [run["cpu_seconds"] for run in runs]
+    print(
+        f"replayed       {len(runs)} run(s), wall median {statistics.median(walls):.3f}s,"
+        f" cpu median {statistics.median(cpus):.3f}s"
+    )
+    header = f"  {'step':>4}  {'wall':>8}  {'cpu':>8}  {'serialise':>9}  {'model':>8}  {'spotify':>8}  calls m/s/t"
+    print(header)
+    for step in _median_steps(runs):
+        print(
+            f"  {step['step']:>4}  {step['wall_seconds']:>8.4f}  {step['cpu_seconds']:>8.4f}"
+            f"  {step['serialise_seconds']:>9.4f}  {step['model_wait_seconds']:>8.4f}"
+            f"  {step['spotify_wait_seconds']:>8.4f}"
+            f"  {step['model_calls']}/{step['spotify_calls']}/{step['tool_calls']}"
+        )
+    for run in runs:
+        if run["error"]:
+            print(f"error          {run['error']}")
+        for miss in run["misses"][:5]:
+            print(f"miss           {miss}")
+        for mismatch in run["mismatches"][:5]:
+            print(f"mismatch       {mismatch}")
+    unused = runs[-1]["unused"]
+    if any(unused.values()):
+        print(f"unused         {unused['model_calls']} model call(s), {unused['spotify_calls']} Spotify call(s)")
+    print()
+
+
+def _median_steps(runs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Per-step medians across repeated replays (steps matched by number)."""
+    by_step: Dict[int, List[Dict[str, Any]]] = {}
+    for run in runs:
+        for step in run["steps"]:
+            by_step.setdefault(step["step"], []).append(step)
+    merged = []
+    for number in sorted(by_step):
+        steps = by_step[number]
+        row = {key: statistics.median(step[key] for step in steps) for key in PROFILE_FIELDS}
+        row.update({key: steps[0][key] for key in ("step", "model_calls", "spotify_calls", "tool_calls")})
+        merged.append(row)
+    return merged
+
+
+def _parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cassettes", nargs="+", help="cassette files (*.json.gz)")
+    parser.add_argument("--latency", default="real", help="real, zero, or a scale factor for recorded durations")
+    parser.add_argument("--repeat", type=int, default=1, help="replays per cassette; the table shows medians")
+    parser.add_argument("--json", help="also write every replay's profile to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's INFO logs")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
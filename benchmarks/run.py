@@ -0,0 +1,501 @@
+"""
+Offline load test for Aria. Starts fake Spotify, accounts and OpenAI servers, points
+`create_app()` at them and drives generations with concurrent simulated users:
+
+    python -m benchmarks.run --scenario jobs --users 16 --generations 200
+    python -m benchmarks.run --scenario finish --openai-latency 400+200 --spotify-latency 80+40
+    python -m benchmarks.run --scenario direct --max-p95 3 --min-throughput 5
+
+Scenarios:
+    jobs    log in once per user, then POST /generate_async and follow the SSE stream
+    finish  the first-visit flow: /generate_async (401), OAuth callback, /finish_generation
+    direct  call run_agent_for_user in-process, without the HTTP layer
+
+`--record DIR` keeps a cassette of every generation, for `python -m benchmarks.replay`.
+
+Exits with status 1 when a --max-* / --min-* threshold is breached.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+from werkzeug.serving import make_server
+
+from .fake_services import (
+    FakeAccountsServer,
+    FakeOpenAIServer,
+    FakeRedisServer,
+    FakeSpotifyServer,
+    Latency,
+    ModelScript,
+)
+
+PROMPTS = [
+    "late night jazz for a rainy city walk",
+    "high energy running mix with french rap",
+    "calm acoustic songs for a sunday breakfast",
+    "nineties eurodance party classics",
+    "ambient electronic music to focus on code",
+    "road trip indie rock singalongs",
+    "melancholic piano pieces for winter evenings",
+    "latin summer hits for a beach barbecue",
+]
+
+
+@dataclass
+class Sample:
+    latency: float
+    outcome: str
+    detail: str = ""
+
+
+@dataclass
+class Report:
+    scenario: str
+    users: int
+    generations: int
+    succeeded: int
+    failed: int
+    rejected: int
+    wall_seconds: float
+    throughput: float
+    latency: Dict[str, float]
+    round_trips_per_generation: Dict[str, float]
+    tokens_per_generation: Dict[str, float]
+    errors: List[str] = field(default_factory=list)
+    hedges: Dict[str, int] = field(default_factory=dict)
+
+
+class FakeStack:
+    """The fake services (plus a Redis stand-in for `--session-backend redis`), each served from its own thread."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        script = ModelScript(
+            search_rounds=args.search_rounds,
+            queries_per_round=args.queries_per_round,
+            batch_searches=not args.single_searches,
+            create_alone=args.create_alone,
+            tracks_per_playlist=args.tracks,
+        )
+        self.spotify = FakeSpotifyServer(Latency.parse(args.spotify_latency), throttle_rate=args.throttle_rate)
+        self.accounts = FakeAccountsServer(Latency.parse(args.accounts_latency))
+        self.openai = FakeOpenAIServer(
+            Latency.parse(args.openai_latency),
+            script,
+            stream_chunk_delay_ms=args.stream_item_delay,
+            fast_model=args.fast_model,
+            fast_latency=Latency.parse(args.fast_openai_latency),
+        )
+        self._servers = [self.spotify, self.accounts, self.openai]
+        self.redis = FakeRedisServer() if args.session_backend == "redis" else None
+        if self.redis is not None:
+            self._servers.append(self.redis)
+        self._session_backend = args.session_backend
+        self._prompt_cache = args.prompt_cache
+        self._fast_model = args.fast_model
+        self._record = args.record
+        self._hedge = args.hedge
+        self._stream_responses = args.stream_responses
+
+    def start(self) -> None:
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+    def reset_counts(self) -> None:
+        for server in self._servers:
+            server.reset_counts()
+        self.openai.usage.clear()
+
+    def environment(self, workdir: str) -> Dict[str, str]:
+        env = {
+            "SPOTIFY_CLIENT_ID": "bench-client",
+            "SPOTIFY_CLIENT_SECRET": "bench-secret",
+            "SPOTIFY_API_BASE": self.spotify.base_url + "/v1/",
+            "SPOTIFY_ACCOUNTS_BASE": self.accounts.base_url,
+            "OPENAI_API_KEY": "bench-key",
+            "OPENAI_BASE_URL": self.openai.base_url + "/v1",
+            "FORCE_HTTPS": "0",
+            "TRUST_PROXY_HEADERS": "0",
+            "SEARCH_CACHE_PATH": os.path.join(workdir, "search_cache.sqlite3"),
+            "CATALOG_PATH": os.path.join(workdir, "catalog.sqlite3"),
+            # Off by default: repeated benchmark prompts would otherwise skip the agent loop.
+            "PROMPT_CACHE_ENABLED": "1" if self._prompt_cache else "0",
+            "SESSION_BACKEND": self._session_backend,
+            "SESSION_PATH": os.path.join(workdir, "sessions.sqlite3"),
+        }
+        if self.redis is not None:
+            env["SESSION_REDIS_URL"] = self.redis.url
+        if self._fast_model:
+            env["OPENAI_FAST_MODEL"] = self._fast_model
+        if self._hedge:
+            env["SPOTIFY_HEDGE_ENABLED"] = "1"
+        if self._stream_responses:
+            env["AGENT_STREAM_RESPONSES"] = "1"
+        if self._record:
+            env["CASSETTE_DIR"] = os.path.abspath(self._record)
+        return env
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parse_args(argv)
+    fakes = FakeStack(args)
+    fakes.start()
+    with tempfile.TemporaryDirectory(prefix="aria-bench-") as workdir:
+        for key, value in fakes.environment(workdir).items():
+            if key in args.keep_env:
+                os.environ.setdefault(key, value)
+            else:
+                os.environ[key] = value
+
+        from aria import create_app
+
+        app = create_app()
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.getLogger("aria").setLevel(logging.WARNING)
+            app.logger.setLevel(logging.WARNING)
+
+        try:
+            report = run_scenario(app, fakes, args)
+        finally:
+            fakes.stop()
+            app.extensions["job_manager"].shutdown(wait=False)
+
+    _print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(asdict(report), fp, indent=2)
+    return 1 if _breaches(report, args) else 0
+
+
+def run_scenario(app: Any, fakes: FakeStack, args: argparse.Namespace) -> Report:
+    if args.scenario == "direct":
+        server = None
+        worker = _direct_worker(app)
+    else:
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        worker = _jobs_worker(base_url) if args.scenario == "jobs" else _finish_worker(base_url)
+
+    try:
+        for index in range(args.warmup):
+            worker(index, PROMPTS[index % len(PROMPTS)])
+        fakes.reset_counts()
+        hedger = app.extensions.get("spotify_hedger")
+        hedges_before = hedger.stats()["outcomes"] if hedger is not None else {}
+
+        samples: List[Sample] = []
+        samples_lock = threading.Lock()
+        counter = iter(range(args.generations))
+        counter_lock = threading.Lock()
+
+        def user_loop(user: int) -> None:
+            while True:
+                with counter_lock:
+                    index = next(counter, None)
+                if index is None:
+                    return
+                prompt = PROMPTS[index % min(args.prompts, len(PROMPTS))]
+                if args.prompts > len(PROMPTS):
+                    prompt = f"{prompt} #{index % args.prompts}"
+                sample = worker(user, prompt)
+                with samples_lock:
+                    samples.append(sample)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users, thread_name_prefix="bench-user") as pool:
+            for future in [pool.submit(user_loop, user) for user in range(args.users)]:
+                future.result()
+        wall = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    report = _build_report(args, fakes, samples, wall)
+    if hedger is not None:
+        report.hedges = {
+            outcome: count - hedges_before.get(outcome, 0) for outcome, count in hedger.stats()["outcomes"].items()
+        }
+    return report
+
+
+def _jobs_worker(base_url: str) -> Callable[[int, str], Sample]:
+    sessions: Dict[int, requests.Session] = {}
+    lock = threading.Lock()
+
+    def get_session(user: int) -> requests.Session:
+        with lock:
+            session = sessions.get(user)
+        if session is None:
+            session = requests.Session()
+            session.get(f"{base_url}/callback", params={"code": f"bench-{user}"}, timeout=30).raise_for_status()
+            with lock:
+                sessions[user] = session
+        return session
+
+    def work(user: int, prompt: str) -> Sample:
+        session = get_session(user)
+        started = time.perf_counter()
+        response = session.post(f"{base_url}/generate_async", data={"prompt": prompt}, timeout=30)
+        return _follow_job(session, base_url, response, started)
+
+    return work
+
+
+def _finish_worker(base_url: str) -> Callable[[int, str], Sample]:
+    def work(user: int, prompt: str) -> Sample:
+        session = requests.Session()
+        started = time.perf_counter()
+        first = session.post(f"{base_url}/generate_async", data={"prompt": prompt}, timeout=30)
+        if first.status_code != 401:
+            return _follow_job(session, base_url, first, started)
+        session.get(f"{base_url}/callback", params={"code": f"bench-{user}"}, timeout=30).raise_for_status()
+        response = session.post(f"{base_url}/finish_generation", timeout=30)
+        return _follow_job(session, base_url, response, started)
+
+    return work
+
+
+def _follow_job(session: requests.Session, base_url: str, response: requests.Response, started: float) -> Sample:
+    if response.status_code in (429, 503):
+        return Sample(time.perf_counter() - started, "rejected", str(response.status_code))
+    if response.status_code == 200 and response.json().get("ok"):
+        return Sample(time.perf_counter() - started, "succeeded")
+    if response.status_code != 202:
+        return Sample(time.perf_counter() - started, "failed", f"HTTP {response.status_code}")
+
+    job = response.json()
+    stream_url = base_url + job["stream_url"]
+    event_type = None
+    with session.get(stream_url, stream=True, timeout=600) as stream:
+        if stream.status_code == 429:
+            # Too many open streams: poll the job like the page does.
+            return _poll_job(session, base_url + job["status_url"], started)
+        for line in stream.iter_lines(decode_unicode=True):
+            if line and line.startswith("event: "):
+                event_type = line[len("event: "):]
+            elif line and line.startswith("data: ") and event_type in ("done", "failed"):
+                outcome = "succeeded" if event_type == "done" else "failed"
+                detail = "" if event_type == "done" else json.loads(line[len("data: "):]).get("error", "")
+                return Sample(time.perf_counter() - started, outcome, detail)
+    return Sample(time.perf_counter() - started, "failed", "stream ended early")
+
+
+def _poll_job(session: requests.Session, status_url: str, started: float) -> Sample:
+    while True:
+        job = session.get(status_url, timeout=30).json()
+        if job.get("status") == "succeeded":
+            return Sample(time.perf_counter() - started, "succeeded")
+        if job.get("status") == "failed":
+            return Sample(time.perf_counter() - started, "failed", job.get("error") or "")
+        time.sleep(0.2)
+
+
+def _direct_worker(app: Any) -> Callable[[int, str], Sample]:
+    from aria.agent import run_agent_for_user
+    from aria.services.cassette import record_generation
+    from aria.services.spotify import build_spotify_client_from_session
+
+    config = app.config["APP_CONFIG"]
+    options = {
+        "openai_client": app.extensions["openai_client"],
+        "model_name": config.openai.model,
+        "fast_model_name": config.openai.fast_model,
+        "tool_concurrency": config.agent.tool_concurrency,
+        "stream_responses": config.agent.stream_responses,
+        "chain_responses": config.agent.chain_responses,
+        "compact_results": config.agent.compact_results,
+        "search_cache": app.extensions.get("search_cache"),
+        "catalog": app.extensions.get("track_catalog"),
+        "catalog_first": config.catalog.serve_searches,
+    }
+
+    def work(user: int, prompt: str) -> Sample:
+        user_id = f"bench-direct-{user}"
+        sp = build_spotify_client_from_session({"access_token": user_id, "spotify_user_id": user_id}, config.spotify)
+        started = time.perf_counter()
+        try:
+            record_generation(
+                config.cassettes,
+                prompt,
+                sp,
+                {**options, "user_id": user_id},
+                None,
+                lambda sp, run_options, on_event: run_agent_for_user(
+                    user_prompt=prompt, sp=sp, on_event=on_event, **run_options
+                ),
+            )
+        except Exception as exc:
+            return Sample(time.perf_counter() - started, "failed", str(exc) or exc.__class__.__name__)
+        return Sample(time.perf_counter() - started, "succeeded")
+
+    return work
+
+
+def _build_report(args: argparse.Namespace, fakes: FakeStack, samples: List[Sample], wall: float) -> Report:
+    succeeded = [s for s in samples if s.outcome == "succeeded"]
+    per_generation = max(1, len(succeeded))
+    latencies = sorted(s.latency for s in succeeded)
+
+    round_trips: Dict[str, float] = {"openai_responses": fakes.openai.counts["responses"] / per_generation}
+    for endpoint, count in sorted(fakes.spotify.counts.items()):
+        round_trips[f"spotify_{endpoint}"] = count / per_generation
+    for grant, count in sorted(fakes.accounts.counts.items()):
+        round_trips[f"accounts_{grant}"] = count / per_generation
+    round_trips["total"] = sum(round_trips.values())
+    if fakes.openai.counts["fast_responses"]:
+        # Part of openai_responses, so reported after the total.
+        round_trips["openai_fast_responses"] = fakes.openai.counts["fast_responses"] / per_generation
+
+    return Report(
+        scenario=args.scenario,
+        users=args.users,
+        generations=len(samples),
+        succeeded=len(succeeded),
+        failed=sum(1 for s in samples if s.outcome == "failed"),
+        rejected=sum(1 for s in samples if s.outcome == "rejected"),
+        wall_seconds=round(wall, 3),
+        throughput=round(len(succeeded) / wall, 3) if wall else 0.0,
+        latency={
+            "mean": round(statistics.fmean(latencies), 3) if latencies else 0.0,
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "max": round(latencies[-1], 3) if latencies else 0.0,
+        },
+        round_trips_per_generation={key: round(value, 2) for key, value in round_trips.items()},
+        tokens_per_generation={
+            key: round(value / per_generation, 1) for key, value in sorted(fakes.openai.usage.items())
+        },
+        errors=sorted({s.detail for s in samples if s.outcome == "failed" and s.detail})[:10],
+    )
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * pct // 100))
+    return round(values[int(rank) - 1], 3)
+
+
+def _print_report(report: Report) -> None:
+    print(f"scenario       {report.scenario} ({report.users} users)")
+    print(
+        f"generations    {report.generations} total, {report.succeeded} ok, "
+        f"{report.failed} failed, {report.rejected} rejected"
+    )
+    print(f"wall time      {report.wall_seconds:.2f}s")
+    print(f"throughput     {report.throughput:.2f} generations/s")
+    latency = report.latency
+    print(
+        f"latency        p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  "
+        f"p99 {latency['p99']:.3f}s  max {latency['max']:.3f}s"
+    )
+    print("round trips per generation")
+    for key, value in report.round_trips_per_generation.items():
+        print(f"  {key:<28}{value:>8.2f}")
+    if report.hedges:
+        print("spotify hedges " + ", ".join(f"{count} {outcome}" for outcome, count in report.hedges.items()))
+    if report.tokens_per_generation:
+        print("model tokens per generation")
+        for key, value in report.tokens_per_generation.items():
+            print(f"  {key:<28}{value:>8.1f}")
+    for error in report.errors:
+        print(f"error          {error}")
+
+
+def _breaches(report: Report, args: argparse.Namespace) -> bool:
+    breaches = []
+    if args.max_p95 is not None and report.latency["p95"] > args.max_p95:
+        breaches.append(f"p95 {report.latency['p95']:.3f}s > {args.max_p95}s")
+    if args.max_p99 is not None and report.latency["p99"] > args.max_p99:
+        breaches.append(f"p99 {report.latency['p99']:.3f}s > {args.max_p99}s")
+    if args.min_throughput is not None and report.throughput < args.min_throughput:
+        breaches.append(f"throughput {report.throughput:.2f}/s < {args.min_throughput}/s")
+    if args.max_round_trips is not None and report.round_trips_per_generation["total"] > args.max_round_trips:
+        breaches.append(f"round trips {report.round_trips_per_generation['total']:.2f} > {args.max_round_trips}")
+    if report.failed and not args.allow_failures:
+        breaches.append(f"{report.failed} failed generation(s)")
+    for breach in breaches:
+        print(f"REGRESSION     {breach}", file=sys.stderr)
+    return bool(breaches)
+
+
+def _parse_args(argv: Optional[List[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=("jobs", "finish", "direct"), default="jobs")
+    parser.add_argument("--users", type=int, default=8, help="concurrent simulated users")
+    parser.add_argument("--generations", type=int, default=64, help="total generations to run")
+    parser.add_argument("--warmup", type=int, default=1, help="generations run before measuring")
+    parser.add_argument("--prompts", type=int, default=len(PROMPTS), help="distinct prompts (cache hit ratio)")
+    parser.add_argument("--prompt-cache", action="store_true", help="let repeated prompts reuse earlier results")
+    parser.add_argument(
+        "--session-backend",
+        choices=("sqlite", "redis", "memory", "cookie"),
+        default="sqlite",
+        help="where sessions are kept; redis uses a local Redis-protocol stand-in",
+    )
+    parser.add_argument("--openai-latency", default="300+100", help="ms per Responses call, BASE+JITTER")
+    parser.add_argument("--fast-model", help="route search turns to this model (OPENAI_FAST_MODEL)")
+    parser.add_argument("--fast-openai-latency", default="100+40", help="ms per Responses call on --fast-model")
+    parser.add_argument(
+        "--spotify-latency",
+        default="60+40",
+        help="ms per Spotify API call, BASE+JITTER, optionally @RATE:MS for a slow tail (60+40@0.02:2000)",
+    )
+    parser.add_argument("--hedge", action="store_true", help="hedge slow Spotify searches (SPOTIFY_HEDGE_ENABLED)")
+    parser.add_argument("--accounts-latency", default="50", help="ms per token call, BASE+JITTER")
+    parser.add_argument(
+        "--stream-responses", action="store_true", help="stream model responses (AGENT_STREAM_RESPONSES)"
+    )
+    parser.add_argument("--stream-item-delay", type=float, default=50.0, help="ms between streamed output items")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of Spotify calls answered with 429")
+    parser.add_argument("--search-rounds", type=int, default=1, help="model steps that search before adding tracks")
+    parser.add_argument("--queries-per-round", type=int, default=3)
+    parser.add_argument("--single-searches", action="store_true", help="use search_items instead of search_many")
+    parser.add_argument(
+        "--create-alone",
+        action="store_true",
+        help="the fake model spends its first step on create_playlist alone (without speculative creation)",
+    )
+    parser.add_argument("--tracks", type=int, default=20, help="tracks added per playlist")
+    parser.add_argument("--max-p95", type=float, help="fail when p95 latency (s) is above this")
+    parser.add_argument("--max-p99", type=float, help="fail when p99 latency (s) is above this")
+    parser.add_argument("--min-throughput", type=float, help="fail when generations/s is below this")
+    parser.add_argument("--max-round-trips", type=float, help="fail when round trips per generation exceed this")
+    parser.add_argument("--allow-failures", action="store_true", help="do not fail on failed generations")
+    parser.add_argument(
+        "--keep-env",
+        nargs="*",
+        default=[],
+        metavar="VAR",
+        help="fake-stack variables to leave alone when already set in the environment",
+    )
+    parser.add_argument("--record", metavar="DIR", help="record every generation to a cassette in DIR (CASSETTE_DIR)")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's INFO logs")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import json
+from types import SimpleNamespace
+
+from aria.agent import run_agent_for_user
+
+
+def _call(call_id, tool, **arguments):
+    return SimpleNamespace(type="function_call", call_id=call_id, name=tool, arguments=json.dumps(arguments))
+
+
+def _text(text):
+    return SimpleNamespace(type="message", content=[SimpleNamespace(type="output_text", text=text)])
+
+
+def _response(response_id, *items):
+    return SimpleNamespace(id=response_id, output=list(items), status="completed", usage=None, incomplete_details=None)
+
+
+class ScriptedOpenAI:
+    """Streams the scripted responses in order, one per request, and records the requests."""
+
+    def __init__(self, *responses):
+        self._responses = list(responses)
+        self.requests = []
+        self.responses = SimpleNamespace(create=self._create)
+
+    def _create(self, stream=False, **request):
+        self.requests.append(request)
+        response = self._responses.pop(0)
+        assert stream
+        events = [
+            SimpleNamespace(type="response.output_item.done", item=item)
+            for item in response.output
+            if item.type == "function_call"
+        ]
+        return iter(events + [SimpleNamespace(type="response.completed", response=response)])
+
+
+class FakeSpotify:
+    def __init__(self):
+        self.added = []
+
+    def current_user(self):
+        return {"id": "me"}
+
+    def user_playlist_create(self, user, name, public, description):
+        return {"id": "p1", "external_urls": {"spotify": "https://open.spotify.com/playlist/p1"}, "name": name}
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        self.added.append(list(items))
+        return {"snapshot_id": "s1"}
+
+    def search(self, q, type, limit):
+        return {"tracks": {"items": []}}
+
+
+def test_streamed_fast_turn_does_not_run_tools_it_was_not_offered():
+    uri = "spotify:track:4uLU6hMCjMI75M1A2tKUQC"
+    openai = ScriptedOpenAI(
+        _response("r1", _call("c1", "create_playlist", name="Rain", description="", public=True)),
+        # The fast model reaches for add_tracks, which search turns do not offer.
+        _response("r2", _call("c2", "add_tracks", playlist_id="p1", uris=[uri], position=None)),
+        _response("r3", _text("A rainy evening.")),
+    )
+    sp = FakeSpotify()
+
+    payload = run_agent_for_user(
+        "rainy evening jazz",
+        sp,
+        openai,
+        model_name="main",
+        fast_model_name="fast",
+        stream_responses=True,
+    )
+
+    assert [request["model"] for request in openai.requests] == ["main", "fast", "main"]
+    assert "add_tracks" not in {tool["name"] for tool in openai.requests[1]["tools"]}
+    assert sp.added == []
+    assert payload["summary"] == "A rainy evening."
+    assert payload["playlist_name"] == "Rain"
@@ -0,0 +1,70 @@
+import asyncio
+
+from flask import Flask
+
+from aria import asgi
+from aria.config import load_config
+
+
+def _asgi_app(monkeypatch):
+    monkeypatch.setenv("SPOTIFY_CLIENT_ID", "client")
+    monkeypatch.setenv("SPOTIFY_CLIENT_SECRET", "secret")
+    monkeypatch.setenv("OPENAI_API_KEY", "key")
+    flask_app = Flask(__name__)
+    flask_app.config["APP_CONFIG"] = load_config()
+    return asgi.AsyncGenerationApp(flask_app)
+
+
+def test_stream_cancels_the_generation_when_the_client_disconnects(monkeypatch):
+    cancelled = []
+
+    async def generation(prompt, sp, on_event, **options):
+        on_event("step", {"step": 1})
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(prompt)
+            raise
+
+    monkeypatch.setattr(asgi, "run_agent_for_user_async", generation)
+    app = _asgi_app(monkeypatch)
+    sent = []
+    first_chunk = asyncio.Event()
+
+    async def receive():
+        await first_chunk.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+        if message.get("body"):
+            first_chunk.set()
+
+    async def scenario():
+        await asyncio.wait_for(app._stream(receive, send, "rainy jazz", None, {}, []), timeout=5)
+
+    asyncio.run(scenario())
+
+    assert cancelled == ["rainy jazz"]
+    bodies = [m["body"] for m in sent if m["type"] == "http.response.body"]
+    assert len(bodies) == 1 and b"event: step" in bodies[0]
+
+
+def test_stream_ends_the_response_after_done(monkeypatch):
+    async def generation(prompt, sp, on_event, **options):
+        return {"playlist_name": "Rain"}
+
+    monkeypatch.setattr(asgi, "run_agent_for_user_async", generation)
+    app = _asgi_app(monkeypatch)
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(60)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asyncio.wait_for(app._stream(receive, send, "rainy jazz", None, {}, []), timeout=5))
+
+    assert b"event: done" in sent[1]["body"]
+    assert sent[-1] == {"type": "http.response.body", "body": b"", "more_body": False}
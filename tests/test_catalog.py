@@ -0,0 +1,86 @@
+import pytest
+
+from aria.services.catalog import TrackCatalog, UnsupportedQuery, build_fts_query
+
+
+def _track(track_id, name, artist, album="Album"):
+    return {
+        "id": track_id,
+        "uri": f"spotify:track:{track_id}",
+        "name": name,
+        "artists": [{"name": artist}],
+        "album": {"name": album},
+    }
+
+
+def _page(kind, *items):
+    return {kind: {"items": list(items)}}
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return TrackCatalog(str(tmp_path / "catalog.sqlite3"))
+
+
+def _index(catalog, results):
+    catalog.index_search_results(results)
+    assert catalog.flush(timeout=5)
+
+
+def test_indexed_tracks_are_found_by_title_artist_and_album(catalog):
+    _index(catalog, _page(
+        "tracks",
+        _track("1", "Blue in Green", "Miles Davis", "Kind of Blue"),
+        _track("2", "Naima", "John Coltrane", "Giant Steps"),
+    ))
+
+    assert [t["id"] for t in catalog.search("blue green", 10)] == ["1"]
+    assert [t["id"] for t in catalog.search('artist:"john coltrane"', 10)] == ["2"]
+    assert [t["id"] for t in catalog.search("album:giant", 10)] == ["2"]
+    assert catalog.search("track:naima artist:davis", 10) == []
+    assert catalog.search("naima", 10)[0] == {
+        "id": "2",
+        "uri": "spotify:track:2",
+        "name": "Naima",
+        "artists": "John Coltrane",
+        "album": "Giant Steps",
+        "genres": "",
+    }
+
+
+def test_reindexing_a_track_updates_it_in_place(catalog):
+    _index(catalog, _page("tracks", _track("1", "So What", "Miles Davis")))
+    _index(catalog, _page("tracks", _track("1", "So What (Live)", "Miles Davis")))
+
+    assert catalog.stats()["tracks"] == 1
+    assert [t["name"] for t in catalog.search("so what", 10)] == ["So What (Live)"]
+
+
+def test_artist_genres_apply_to_tracks_indexed_earlier(catalog):
+    _index(catalog, _page("tracks", _track("1", "Blue Suede Shoes", "Carl Perkins")))
+    assert catalog.search("genre:rockabilly", 10) == []
+
+    _index(catalog, _page("artists", {"name": "Carl Perkins", "genres": ["rockabilly"]}))
+
+    assert [t["id"] for t in catalog.search("genre:rockabilly", 10)] == ["1"]
+
+
+def test_genre_filter_matches_whole_words_only(catalog):
+    _index(catalog, {
+        "artists": {"items": [{"name": "Carl Perkins", "genres": ["rockabilly"]}]},
+        "tracks": {"items": [_track("1", "Blue Suede Shoes", "Carl Perkins")]},
+    })
+
+    assert catalog.search("genre:rock", 10) == []
+
+
+def test_results_respect_the_limit(catalog):
+    _index(catalog, _page("tracks", *(_track(str(i), f"Rain Song {i}", "Band") for i in range(5))))
+
+    assert len(catalog.search("rain", 3)) == 3
+
+
+@pytest.mark.parametrize("query", ["year:1999", "tag:new", "   "])
+def test_filters_the_index_cannot_answer_are_refused(query):
+    with pytest.raises(UnsupportedQuery):
+        build_fts_query(query)
@@ -0,0 +1,31 @@
+import pytest
+
+from aria.config import ConfigError, load_config
+
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setenv("SPOTIFY_CLIENT_ID", "client")
+    monkeypatch.setenv("SPOTIFY_CLIENT_SECRET", "secret")
+    monkeypatch.setenv("OPENAI_API_KEY", "key")
+    return monkeypatch
+
+
+def test_zero_queue_wait_disables_the_check(env):
+    env.setenv("JOB_MAX_QUEUE_WAIT", "0")
+
+    assert load_config().jobs.max_queue_wait == 0
+
+
+def test_negative_queue_wait_is_rejected(env):
+    env.setenv("JOB_MAX_QUEUE_WAIT", "-1")
+
+    with pytest.raises(ConfigError, match="JOB_MAX_QUEUE_WAIT"):
+        load_config()
+
+
+def test_other_float_settings_still_require_a_positive_value(env):
+    env.setenv("AGENT_DEADLINE_SECONDS", "0")
+
+    with pytest.raises(ConfigError, match="AGENT_DEADLINE_SECONDS"):
+        load_config()
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+from collections import namedtuple
+
+import pytest
+
+from aria.executor import AsyncToolExecutor, ToolExecutor
+
+Call = namedtuple("Call", "call_id name")
+
+
+class Recorder:
+    """Run calls with per-tool delays and record when each starts and ends."""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.log = []
+        self._lock = threading.Lock()
+
+    def _note(self, event, call):
+        with self._lock:
+            self.log.append((event, call.call_id))
+
+    def run(self, call):
+        self._note("start", call)
+        time.sleep(self.delays.get(call.name, 0))
+        self._note("end", call)
+        return {"id": call.call_id}
+
+    async def run_async(self, call):
+        self._note("start", call)
+        await asyncio.sleep(self.delays.get(call.name, 0))
+        self._note("end", call)
+        return {"id": call.call_id}
+
+    def index(self, event, call_id):
+        return self.log.index((event, call_id))
+
+
+STEP = [
+    Call("add1", "add_tracks"),
+    Call("search1", "search_tracks"),
+    Call("create", "create_playlist"),
+    Call("add2", "add_tracks"),
+    Call("search2", "search_tracks"),
+]
+
+
+def _run_sync(recorder, calls):
+    with ToolExecutor(recorder.run, max_workers=8) as executor:
+        return executor.run_all(calls)
+
+
+def _run_async(recorder, calls):
+    async def main():
+        async with AsyncToolExecutor(recorder.run_async, max_concurrency=8) as executor:
+            return await executor.run_all(calls)
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(params=[_run_sync, _run_async], ids=["threads", "asyncio"])
+def run_step(request):
+    return request.param
+
+
+def test_results_come_back_in_call_order(run_step):
+    recorder = Recorder({"create_playlist": 0.05})
+
+    assert run_step(recorder, STEP) == [{"id": call.call_id} for call in STEP]
+
+
+def test_track_adds_wait_for_the_playlist_and_keep_their_order(run_step):
+    recorder = Recorder({"create_playlist": 0.05, "add_tracks": 0.02})
+
+    run_step(recorder, STEP)
+
+    assert recorder.index("end", "create") < recorder.index("start", "add1")
+    assert recorder.index("end", "add1") < recorder.index("start", "add2")
+
+
+def test_searches_do_not_wait_for_playlist_writes(run_step):
+    recorder = Recorder({"create_playlist": 0.05, "add_tracks": 0.05})
+
+    run_step(recorder, STEP)
+
+    assert recorder.index("end", "search1") < recorder.index("end", "create")
+    assert recorder.index("end", "search2") < recorder.index("end", "create")
+
+
+def test_writes_submitted_in_later_steps_follow_earlier_ones():
+    recorder = Recorder({"add_tracks": 0.05})
+    with ToolExecutor(recorder.run, max_workers=4) as executor:
+        first = executor.submit(Call("add1", "add_tracks"))
+        second = executor.submit(Call("add2", "add_tracks"))
+        second.result(timeout=5)
+        assert first.done()
+
+    assert recorder.index("end", "add1") < recorder.index("start", "add2")
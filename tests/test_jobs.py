@@ -0,0 +1,89 @@
+import threading
+
+from aria.services.jobs import JOB_SUCCEEDED, JobManager, flight_key
+from aria.services.session_store import SqliteSessionStore
+
+
+def _blocking_run(release):
+    calls = []
+
+    def fn(emit):
+        calls.append(1)
+        release.wait(5)
+        return {"ok": len(calls)}
+
+    return fn, calls
+
+
+def test_flight_key_ignores_case_and_spacing_but_not_owner():
+    assert flight_key("sid", "Rainy  Jazz ") == flight_key("sid", "rainy jazz")
+    assert flight_key("sid", "rainy jazz") != flight_key("other", "rainy jazz")
+    assert flight_key("sid", "rainy jazz") != flight_key("sid", "rainy blues")
+
+
+def test_duplicate_submit_attaches_to_the_run_in_flight():
+    manager = JobManager(max_workers=2)
+    release = threading.Event()
+    fn, calls = _blocking_run(release)
+    key = flight_key("sid", "rainy jazz")
+
+    first = manager.submit("sid", "rainy jazz", fn, flight_key=key)
+    second = manager.submit("sid", "Rainy Jazz", fn, flight_key=key)
+    release.set()
+
+    assert second is first
+    assert manager.wait(first).status == JOB_SUCCEEDED
+    assert calls == [1]
+    manager.shutdown(wait=True)
+
+
+def test_finished_flight_lets_the_next_submit_run_again():
+    manager = JobManager(max_workers=1)
+    release = threading.Event()
+    release.set()
+    fn, calls = _blocking_run(release)
+    key = flight_key("sid", "rainy jazz")
+
+    first = manager.run("sid", "rainy jazz", fn, flight_key=key)
+    second = manager.run("sid", "rainy jazz", fn, flight_key=key)
+
+    assert second.id != first.id
+    assert calls == [1, 1]
+    manager.shutdown(wait=True)
+
+
+def test_runs_without_a_flight_key_are_independent():
+    manager = JobManager(max_workers=2)
+    release = threading.Event()
+    fn, calls = _blocking_run(release)
+
+    first = manager.submit("sid", "rainy jazz", fn)
+    second = manager.submit("sid", "rainy jazz", fn)
+    release.set()
+
+    assert second.id != first.id
+    manager.wait(first)
+    manager.wait(second)
+    assert calls == [1, 1]
+    manager.shutdown(wait=True)
+
+
+def test_workers_sharing_a_store_run_one_generation(tmp_path):
+    store = SqliteSessionStore(str(tmp_path / "sessions.sqlite3"))
+    worker_a = JobManager(max_workers=1, state_store=store)
+    worker_b = JobManager(max_workers=1, state_store=store)
+    release = threading.Event()
+    fn, calls = _blocking_run(release)
+    key = flight_key("sid", "rainy jazz")
+
+    leader = worker_a.submit("sid", "rainy jazz", fn, flight_key=key)
+    follower = worker_b.submit("sid", "rainy jazz", fn, flight_key=key)
+    release.set()
+
+    assert follower.id == leader.id
+    finished = worker_b.wait(follower, poll=0.01)
+    assert finished.status == JOB_SUCCEEDED
+    assert finished.result == {"ok": 1}
+    assert calls == [1]
+    worker_a.shutdown(wait=True)
+    worker_b.shutdown(wait=True)
@@ -0,0 +1,70 @@
+import pytest
+
+from aria.config import PromptCacheSettings
+from aria.services.prompt_cache import CachedResult, PromptCache, create_prompt_cache
+
+
+def _result(prompt: str) -> CachedResult:
+    return CachedResult(
+        name=f"Playlist for {prompt}",
+        description="",
+        public=True,
+        tracks=["spotify:track:4uLU6hMCjMI75M1A2tKUQC"],
+        summary="summary",
+        prompt=prompt,
+    )
+
+
+def test_disabled_by_default():
+    assert create_prompt_cache(PromptCacheSettings()) is None
+
+
+def test_exact_hit_ignores_case_punctuation_and_filler_words():
+    cache = PromptCache()
+    cache.set("Workout music!", _result("Workout music!"))
+    assert cache.get("make me a workout playlist please").prompt == "Workout music!"
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.parametrize(
+    "cached, asked",
+    [
+        ("chill lofi beats for studying late at night", "late at night lofi beats for studying, chill"),
+        (
+            "upbeat electro workout songs for running in the morning",
+            "upbeat electro wrkout songs for running in the morning",
+        ),
+    ],
+)
+def test_reordered_or_misspelled_prompt_is_a_near_hit(cached, asked):
+    cache = PromptCache()
+    cache.set(cached, _result(cached))
+    hit = cache.get(asked)
+    assert hit is not None and hit.prompt == cached
+
+
+@pytest.mark.parametrize(
+    "cached, asked",
+    [
+        (
+            "chill lofi beats for studying late at night with rain sounds",
+            "chill lofi beats for studying late at night without rain sounds",
+        ),
+        ("best rock anthems from 1985", "best rock anthems from 1986"),
+        ("happy indie folk for a sunny road trip", "unhappy indie folk for a sunny road trip"),
+        ("calm piano for sleeping", "calm piano for sleeping and reading"),
+        ("sad songs about summer love", "mad songs about summer love"),
+        ("90s hip hop classics", "80s hip hop classics"),
+    ],
+)
+def test_prompts_with_different_intent_do_not_collide(cached, asked):
+    cache = PromptCache()
+    cache.set(cached, _result(cached))
+    assert cache.get(asked) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_entries_expire():
+    cache = PromptCache(ttl=0)
+    cache.set("jazz for a rainy day", _result("jazz for a rainy day"))
+    assert cache.get("jazz for a rainy day") is None
@@ -0,0 +1,68 @@
+import sqlite3
+
+from aria.services.search_cache import SqliteSearchCache
+
+
+def _scan(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM search_cache").fetchone()
+
+
+def test_totals_follow_inserts_replacements_and_evictions(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SqliteSearchCache(path, max_entries=3)
+
+    for i in range(5):
+        cache.set(f"k{i}", {"tracks": ["x" * i]})
+    cache.set("k4", {"tracks": ["a much longer payload than before"]})
+
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"]) == _scan(path)
+    assert stats["entries"] == 3
+    assert stats["evictions"] == 2
+    assert cache.get("k0") is None
+    assert cache.get("k4") == {"tracks": ["a much longer payload than before"]}
+
+
+def test_totals_are_rebuilt_for_an_existing_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    SqliteSearchCache(path).set("k", {"tracks": []})
+    with sqlite3.connect(path) as conn:
+        conn.execute("DROP TABLE search_cache_totals")
+
+    stats = SqliteSearchCache(path).stats()
+
+    assert (stats["entries"], stats["bytes"]) == _scan(path)
+
+
+def test_expired_entries_are_dropped_on_write(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SqliteSearchCache(path, ttl=60)
+    clock = [1000.0]
+    monkeypatch.setattr("aria.services.search_cache.time.time", lambda: clock[0])
+    cache.set("old", {"tracks": []})
+    clock[0] += 60
+    cache.set("new", {"tracks": []})
+
+    assert cache.get("old") is None
+    assert cache.stats()["entries"] == 1 == _scan(path)[0]
+
+
+def test_hits_only_touch_entries_after_the_interval(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SqliteSearchCache(path)
+    clock = [1000.0]
+    monkeypatch.setattr("aria.services.search_cache.time.time", lambda: clock[0])
+    cache.set("k", {"tracks": []})
+
+    def accessed_at():
+        with sqlite3.connect(path) as conn:
+            return conn.execute("SELECT accessed_at FROM search_cache WHERE key = 'k'").fetchone()[0]
+
+    clock[0] += SqliteSearchCache.TOUCH_INTERVAL - 1
+    assert cache.get("k") == {"tracks": []}
+    assert accessed_at() == 1000.0
+
+    clock[0] += 1
+    cache.get("k")
+    assert accessed_at() == clock[0]
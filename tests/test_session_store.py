@@ -0,0 +1,143 @@
+import os
+import stat
+
+import pytest
+from flask import Flask, jsonify, session
+
+from aria.services.session_store import (
+    MemorySessionStore,
+    ServerSideSessionInterface,
+    SqliteSessionStore,
+    regenerate_session,
+    session_key,
+)
+
+
+def _app(store):
+    app = Flask(__name__)
+    app.secret_key = "test-secret"
+    app.session_interface = ServerSideSessionInterface(store)
+
+    @app.post("/visit")
+    def visit():
+        session["pending_prompt"] = "rainy jazz"
+        return jsonify(sid=session.sid)
+
+    @app.post("/login")
+    def login():
+        session["token_info"] = {"access_token": "secret"}
+        regenerate_session(session)
+        return jsonify(sid=session.sid)
+
+    @app.post("/forget")
+    def forget():
+        session.pop("pending_prompt", None)
+        return jsonify(sid=session.sid)
+
+    @app.post("/history")
+    def history():
+        session.setdefault("history", []).append("rainy jazz")
+        return jsonify(sid=session.sid)
+
+    @app.get("/whoami")
+    def whoami():
+        return jsonify(sid=session.sid, data=dict(session))
+
+    return app
+
+
+def test_login_moves_the_session_to_a_new_id():
+    store = MemorySessionStore()
+    client = _app(store).test_client()
+    before = client.post("/visit").json["sid"]
+
+    after = client.post("/login").json["sid"]
+
+    assert after != before
+    assert store.load(session_key(before)) is None
+    assert store.load(session_key(after)) == {
+        "pending_prompt": "rainy jazz",
+        "token_info": {"access_token": "secret"},
+    }
+    assert client.get("/whoami").json["sid"] == after
+
+
+def test_planted_session_id_does_not_receive_tokens():
+    store = MemorySessionStore()
+    app = _app(store)
+    attacker = app.test_client()
+    attacker.post("/visit")
+    planted = attacker.get_cookie("session").value
+
+    victim = app.test_client()
+    victim.set_cookie("session", planted)
+    victim.post("/login")
+
+    seen = attacker.get("/whoami").json
+    assert "token_info" not in seen["data"]
+
+
+def test_sqlite_store_is_private_to_the_app_user(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+    SqliteSessionStore(path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SqliteSessionStore(str(tmp_path / "sessions.sqlite3"))
+    return MemorySessionStore()
+
+
+def test_request_only_writes_the_fields_it_changed(store):
+    app = _app(store)
+
+    @app.post("/slow")
+    def slow():
+        # A background job publishes its result while this request holds the older copy.
+        store.apply(session_key(session.sid), {"last_result": {"playlist": "Rain"}})
+        session["history"] = ["rainy jazz"]
+        return jsonify(sid=session.sid)
+
+    client = app.test_client()
+    sid = client.post("/visit").json["sid"]
+    store.apply(session_key(sid), {"last_result": None})
+
+    client.post("/slow")
+
+    assert store.load(session_key(sid)) == {
+        "pending_prompt": "rainy jazz",
+        "history": ["rainy jazz"],
+        "last_result": {"playlist": "Rain"},
+    }
+
+
+def test_removed_fields_are_deleted_and_the_rest_kept(store):
+    client = _app(store).test_client()
+    sid = client.post("/visit").json["sid"]
+    client.post("/history")
+
+    client.post("/forget")
+
+    assert store.load(session_key(sid)) == {"history": ["rainy jazz"]}
+
+
+def test_in_place_edits_are_persisted(store):
+    client = _app(store).test_client()
+    sid = client.post("/history").json["sid"]
+
+    client.post("/history")
+
+    assert store.load(session_key(sid))["history"] == ["rainy jazz", "rainy jazz"]
+
+
+def test_read_only_requests_do_not_write(store, monkeypatch):
+    client = _app(store).test_client()
+    client.post("/visit")
+    writes = []
+    monkeypatch.setattr(store, "apply", lambda *args, **kwargs: writes.append(args))
+
+    client.get("/whoami")
+
+    assert writes == []